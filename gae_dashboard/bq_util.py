@@ -1,22 +1,80 @@
 """Utilities for interacting with BigQuery."""
 
+import collections
+import contextlib
+import copy
 import datetime
+import hashlib
+import http.client
+import itertools
 import json
+import multiprocessing.dummy
 import os
 import pickle
 import random
+import re
+import socket
+import sqlite3
 import sys
 import subprocess
+import threading
+import time
 
 
 _DATA_DIRECTORY = os.path.join(os.getenv('HOME'), 'bq_data/')
 
+# How many rows we fetch from BigQuery at a time when paging through
+# query results.
+_PAGE_SIZE = 10000
+
+# When waiting for a query job to finish, how long we wait between
+# checks on it: we start with the minimum, and back off exponentially.
+_MIN_POLL_INTERVAL = 0.1
+_MAX_POLL_INTERVAL = 5
+
+# How many times we retry checking on a query job, if that fails.  The
+# job keeps running in BigQuery either way, so we'd much rather check
+# again than rerun (and pay for) the query.
+_POLL_RETRIES = 3
+
+# Pass this as the cache_ttl to query_bigquery() to cache its results
+# for as long as we have room for them.
+CACHE_FOREVER = float('inf')
+
+# How long we cache the results of queries over the streaming fastly
+# logs, by default.  Those tables fill in over a few minutes, so results
+# older than that may be missing data.
+_STREAMING_CACHE_TTL = 2 * 60
+
+# How much disk space cached query results may use, in total.  When we
+# go over, we evict the least-recently-used results.
+_CACHE_MAX_BYTES = 500 * 1024 * 1024
+
+# How big the query log may get before we start a new one; see
+# _log_query().  We keep one old log, so this uses at most twice as much.
+_QUERY_LOG_MAX_BYTES = 50 * 1024 * 1024
+
+# How many queries query_many() runs at the same time, by default.
+# BigQuery lets us run many more than this at once, but the scripts
+# that use this run on a small machine.
+_MAX_CONCURRENT_QUERIES = 5
+
 
 class BQException(Exception):
     """An error trying to fetch data from bigquery."""
     pass
 
 
+class BQTimeout(BQException):
+    """A query didn't finish by its deadline."""
+    pass
+
+
+class BQJobFailed(BQException):
+    """A query job ran, and BigQuery says it failed."""
+    pass
+
+
 def call_bq(subcommand_list, project, return_output=True,
             raise_exception=True, **kwargs):
     """subcommand_list is, e.g. ['query', '--allow_large_results', ...]."""
@@ -46,53 +104,505 @@ def call_bq(subcommand_list, project, return_output=True,
             return e.output
 
 
-def does_table_exist(table_name):
-    """Takes in a table name and checks if that table exists in BigQuery."""
-    result = call_bq(
-        ['show', table_name], project='khan-academy', raise_exception=False)
+def _api_value(value, field):
+    """Convert a cell from the BigQuery API into what `bq` would give us.
 
-    if "Not found: Table" in result:
-        return False
-    else:
+    The API sends everything as strings (or nested {'f': [{'v': ...}]}
+    records), which is what the `bq` tool prints in its json output too,
+    except for timestamps, which the API sends as seconds since the epoch.
+    """
+    if value is None:
+        return None
+    if field.get('mode') == 'REPEATED':
+        scalar_field = dict(field, mode='NULLABLE')
+        return [_api_value(v['v'], scalar_field) for v in value]
+    if field['type'] in ('RECORD', 'STRUCT'):
+        return _api_row_to_dict(value, field['fields'])
+    if field['type'] == 'TIMESTAMP':
+        return time.strftime('%Y-%m-%d %H:%M:%S',
+                             time.gmtime(float(value)))
+    return value
+
+
+def _api_row_to_dict(row, fields):
+    """Convert an API row, {'f': [{'v': ...}, ...]}, to a dict."""
+    return {field['name']: _api_value(cell['v'], field)
+            for (field, cell) in zip(fields, row['f'])}
+
+
+class _CommandLineBackend(object):
+    """Talks to BigQuery by running the `bq` tool in a subprocess.
+
+    This requires 'pip install bigquery' be run on this machine.  Every
+    call pays for starting up python, loading credentials and opening
+    a new connection, so it's pretty slow -- so we make as few as we
+    can.  Running a query is just one call: `bq query` runs it, waits
+    for it, and prints (up to a page of) the results, which we keep
+    until they're asked for.  We only go back to `bq` for more results
+    if that page was full.
+
+    `bq query` doesn't tell us the schema of the results, so their
+    types get guessed at, like in the old days; nor does it tell us how
+    many bytes the query scanned.
+    """
+    def __init__(self):
+        # Job id -> the rows `bq query` printed for it, until they're
+        # asked for.
+        self._first_pages = {}
+
+    def _call_bq(self, subcommand_list, project, **kwargs):
+        try:
+            # call_bq can return None when there are no results for
+            # the query.  We map that to [].
+            return call_bq(subcommand_list, project=project, **kwargs) or []
+        except subprocess.CalledProcessError as why:
+            raise BQException("bq failed with retcode %d: %s"
+                              % (why.returncode, why.output))
+
+    def start_query(self, sql_query, job_id, project, gdrive=False,
+                    timeout=None):
+        """Run the query, and wait for it to finish.
+
+        If it hasn't finished after `timeout` seconds, we raise a
+        BQTimeout; the query keeps running in BigQuery.
+        """
+        try:
+            self._first_pages[job_id] = self._call_bq(
+                ['--job_id', job_id] +
+                (['--enable_gdrive'] if gdrive else []) +
+                ['query', '--max_rows=%d' % _PAGE_SIZE, sql_query],
+                project=project, timeout=timeout)
+        except subprocess.TimeoutExpired:
+            raise BQTimeout("Query job %s did not finish in %ss"
+                            % (job_id, timeout))
+
+    def get_job(self, job_id, project):
+        """Return the BigQuery job resource for the job."""
+        if job_id in self._first_pages:
+            # start_query() waited for it to finish.
+            return {'jobReference': {'projectId': project, 'jobId': job_id},
+                    'status': {'state': 'DONE'}}
+        return self._call_bq(['show', '-j', job_id], project=project)
+
+    def iter_result_pages(self, job_id, project, page_size=_PAGE_SIZE,
+                          start_row=0):
+        """Yield the results of a finished query job, a page at a time.
+
+        Each page is a pair (fields, rows): fields is the schema of the
+        results, which we don't know (so it's None), and rows is a list of
+        rows (each row is a dict).  We start at row `start_row`.  There's
+        always at least one page, even if it has no rows.
+        """
+        first_page = self._first_pages.pop(job_id, None)
+        if first_page is not None:
+            for i in range(start_row, max(len(first_page), 1), page_size):
+                yield (None, first_page[i:i + page_size])
+            if len(first_page) < _PAGE_SIZE:
+                return
+            start_row = max(start_row, len(first_page))
+
+        # The rest of the results are in the (temporary) table that the
+        # query job wrote to.
+        table = self._call_bq(['show', '-j', job_id], project=project)[
+            'configuration']['query']['destinationTable']
+        table_name = '%(projectId)s:%(datasetId)s.%(tableId)s' % table
+        while True:
+            page = self._call_bq(['head', '--start_row=%d' % start_row,
+                                  '--max_rows=%d' % page_size, table_name],
+                                 project=project)
+            yield (None, page)
+            start_row += len(page)
+            if len(page) < page_size:
+                return
+
+    def cancel(self, job_id, project):
+        try:
+            call_bq(['--nosync', 'cancel', job_id],
+                    project=project, return_output=False)
+        except subprocess.CalledProcessError as why:
+            raise BQException("bq cancel failed with retcode %d"
+                              % why.returncode)
+
+    def table_exists(self, table_name, project):
+        result = call_bq(
+            ['show', table_name], project=project, raise_exception=False)
+        return "Not found: Table" not in result
+
+
+class _ApiBackend(object):
+    """Talks to BigQuery via the REST API, from within this process.
+
+    We build the API client once and keep it around, so we only load
+    credentials and set up a connection the first time we're called;
+    httplib2 keeps the connection alive between requests.  httplib2
+    isn't thread-safe, though, so each thread gets its own client.
+    """
+    def __init__(self):
+        self._local = threading.local()
+
+    def _get_service(self):
+        if getattr(self._local, 'service', None) is None:
+            # We only need cloudmonitoring_util (and the google api
+            # libraries it uses) if we actually use this backend.
+            import cloudmonitoring_util
+            self._local.service = cloudmonitoring_util.get_cloud_service(
+                'bigquery', 'v2')
+        return self._local.service
+
+    def _execute(self, request):
+        import apiclient.errors
+        try:
+            return request.execute()
+        except (apiclient.errors.HttpError, socket.error,
+                http.client.HTTPException) as why:
+            raise BQException("BigQuery API call failed: %s" % why)
+
+    def start_query(self, sql_query, job_id, project, gdrive=False,
+                    timeout=None):
+        """Start running the query, without waiting for it to finish.
+
+        That doesn't take long, so we don't need the `timeout`.
+        """
+        if gdrive:
+            # We'd need a drive-scoped client for this; it's rare enough
+            # that we just let the bq tool handle it.  Once it's running,
+            # it's a job like any other.
+            try:
+                call_bq(['--nosync', '--job_id', job_id, '--enable_gdrive',
+                         'query', sql_query],
+                        project=project, return_output=False)
+            except subprocess.CalledProcessError as why:
+                raise BQException("bq failed with retcode %d: %s"
+                                  % (why.returncode, why.output))
+            return
+        # Like the bq tool, we let the API default to legacy SQL unless
+        # the query starts with '#standardSQL'.
+        self._execute(self._get_service().jobs().insert(
+            projectId=project, body={
+                'jobReference': {'projectId': project, 'jobId': job_id},
+                'configuration': {'query': {'query': sql_query}},
+            }))
+
+    def get_job(self, job_id, project):
+        """Return the BigQuery job resource for the job."""
+        return self._execute(self._get_service().jobs().get(
+            projectId=project, jobId=job_id))
+
+    def iter_result_pages(self, job_id, project, page_size=_PAGE_SIZE,
+                          start_row=0):
+        """Yield the results of a finished query job, a page at a time.
+
+        Each page is a pair (fields, rows): fields is the schema of the
+        results, as a list of BigQuery field resources, and rows is a
+        list of rows (each row is a dict).  We start at row `start_row`.
+        There's always at least one page, even if it has no rows.
+        """
+        jobs = self._get_service().jobs()
+        page_token = None
+        while True:
+            if page_token:
+                request = jobs.getQueryResults(
+                    projectId=project, jobId=job_id, pageToken=page_token,
+                    maxResults=page_size)
+            else:
+                request = jobs.getQueryResults(
+                    projectId=project, jobId=job_id, startIndex=start_row,
+                    maxResults=page_size)
+            response = self._execute(request)
+            fields = response['schema']['fields']
+            yield (fields, [_api_row_to_dict(row, fields)
+                            for row in response.get('rows', [])])
+            page_token = response.get('pageToken')
+            if not page_token:
+                return
+
+    def cancel(self, job_id, project):
+        self._execute(self._get_service().jobs().cancel(
+            projectId=project, jobId=job_id))
+
+    def table_exists(self, table_name, project):
+        import apiclient.errors
+        # Table names look like [project:]dataset.table.
+        if ':' in table_name:
+            (project, table_name) = table_name.split(':', 1)
+        (dataset, table) = table_name.split('.', 1)
+        try:
+            self._get_service().tables().get(
+                projectId=project, datasetId=dataset, tableId=table).execute()
+        except apiclient.errors.HttpError as e:
+            if int(e.resp['status']) == 404:
+                return False
+            raise
         return True
 
 
+class FakeBackend(object):
+    """A backend that answers from canned data, for testing offline.
+
+    `results` maps a substring of a query to the rows that query should
+    return: a list of dicts, with values as strings like `bq` gives us.
+    The value may instead be an exception, which is raised when that
+    query is run.  The first matching substring wins.  `schemas` maps
+    the same substrings to the schema of the results, as a list of
+    BigQuery field resources; if a query has no schema, its results get
+    converted like in the old days, by guessing at each value's type.
+    Every query run is recorded in `queries`, and every job canceled
+    in `canceled`.
+
+    To test what happens when downloading results fails, put exceptions
+    in `fetch_errors`; each attempt to fetch results raises the next one,
+    until there are none left.  Likewise, exceptions in `poll_errors`
+    are raised by attempts to check on a job.
+    """
+    def __init__(self, results=None, tables=(), schemas=None):
+        self.results = results or {}
+        self.tables = set(tables)
+        self.schemas = schemas or {}
+        self.fetch_errors = []
+        self.poll_errors = []
+        self.queries = []
+        self.canceled = []
+        self._jobs = {}
+
+    def start_query(self, sql_query, job_id, project, gdrive=False,
+                    timeout=None):
+        self.queries.append(sql_query)
+        for (substring, canned_rows) in self.results.items():
+            if substring in sql_query:
+                if isinstance(canned_rows, Exception):
+                    raise canned_rows
+                # Our callers may modify the rows in place.
+                self._jobs[job_id] = (self.schemas.get(substring),
+                                      copy.deepcopy(canned_rows))
+                return
+        self._jobs[job_id] = (None, [])
+
+    def get_job(self, job_id, project):
+        if self.poll_errors:
+            raise self.poll_errors.pop(0)
+        return {'jobReference': {'projectId': project, 'jobId': job_id},
+                'status': {'state': 'DONE'}}
+
+    def iter_result_pages(self, job_id, project, page_size=_PAGE_SIZE,
+                          start_row=0):
+        if self.fetch_errors:
+            raise self.fetch_errors.pop(0)
+        (fields, rows) = self._jobs[job_id]
+        yield (fields, rows[start_row:start_row + page_size])
+        for i in range(start_row + page_size, len(rows), page_size):
+            yield (fields, rows[i:i + page_size])
+
+    def cancel(self, job_id, project):
+        self.canceled.append(job_id)
+
+    def table_exists(self, table_name, project):
+        return table_name in self.tables
+
+
+# Which backend to use.  By default, we run the `bq` tool, once per
+# query (see _CommandLineBackend).  The API backend saves paying for
+# bq's startup on every query; to use it, set `BQ_UTIL_BACKEND=api` in
+# the environment, or call set_backend().
+_BACKENDS = {
+    'api': _ApiBackend,
+    'cli': _CommandLineBackend,
+}
+_backend = None
+
+
+def get_backend():
+    """Return the backend that query_bigquery() and friends use."""
+    global _backend
+    if _backend is None:
+        _backend = _BACKENDS[os.getenv('BQ_UTIL_BACKEND', 'cli')]()
+    return _backend
+
+
+def set_backend(backend):
+    """Use `backend` for all BigQuery calls; return the old backend."""
+    global _backend
+    old_backend = _backend
+    _backend = backend
+    return old_backend
+
+
+def does_table_exist(table_name):
+    """Takes in a table name and checks if that table exists in BigQuery."""
+    return get_backend().table_exists(table_name, project='khan-academy')
+
+
 def _get_data_filename(report, yyyymmdd):
     """Gets the filename in which old data might be stored.
 
     Takes a report name and a date stamp.  The file returned is not guaranteed
-    to exist.
+    to exist.  We don't store new data this way anymore -- it goes into the
+    history database -- but we copy these files over when we come across
+    them; see _migrate_pickle().
     """
     return os.path.join(_DATA_DIRECTORY, report + '_' + yyyymmdd + '.pickle')
 
 
-def get_daily_data(report, yyyymmdd):
+@contextlib.contextmanager
+def _history_db():
+    """Yield a connection to the history database, in a transaction.
+
+    The history database holds the daily data for all reports.  It's
+    stored by column: each value of each row is its own entry, keyed by
+    (report, column, date, row-number).  That way, reading a few columns
+    of a report over many days is a single scan of one index range, no
+    matter how many other columns the report has.  We also index each
+    day's rows by the key process_past_data() looks them up by, so it
+    can read just the rows it needs; see _key_days().
+
+    We use a new connection each time, since sqlite connections can't
+    be shared between threads, and opening one is cheap.
+    """
+    if not os.path.isdir(_DATA_DIRECTORY):
+        os.makedirs(_DATA_DIRECTORY)
+    db = sqlite3.connect(os.path.join(_DATA_DIRECTORY, 'history.sqlite'))
+    try:
+        with db:
+            db.execute('CREATE TABLE IF NOT EXISTS daily_reports ('
+                       '  report TEXT, yyyymmdd TEXT, num_rows INTEGER,'
+                       '  PRIMARY KEY (report, yyyymmdd)'
+                       ') WITHOUT ROWID')
+            db.execute('CREATE TABLE IF NOT EXISTS daily_values ('
+                       '  report TEXT, column_name TEXT, yyyymmdd TEXT,'
+                       '  row_index INTEGER, value,'
+                       '  PRIMARY KEY (report, column_name, yyyymmdd,'
+                       '               row_index)'
+                       ') WITHOUT ROWID')
+            db.execute('CREATE TABLE IF NOT EXISTS daily_keys ('
+                       '  report TEXT, row_key TEXT, yyyymmdd TEXT,'
+                       '  row_index INTEGER,'
+                       '  PRIMARY KEY (report, row_key, yyyymmdd)'
+                       ') WITHOUT ROWID')
+            db.execute('CREATE INDEX IF NOT EXISTS daily_keys_by_day'
+                       '  ON daily_keys (report, yyyymmdd)')
+            yield db
+    finally:
+        db.close()
+
+
+def _to_db_value(value):
+    # sqlite can store numbers, strings and None as-is; for anything
+    # else (lists from repeated fields, say), we store a pickle.
+    if value is None or isinstance(value, (int, float, str)):
+        return value
+    return pickle.dumps(value, protocol=2)
+
+
+def _from_db_value(value):
+    if isinstance(value, bytes):
+        return pickle.loads(value)
+    return value
+
+
+def _read_daily_data(db, report, start_yyyymmdd, end_yyyymmdd, columns):
+    """Read a report's data for a range of days from the history database.
+
+    Returns a dict from yyyymmdd to a list of rows (each row is a dict),
+    for every day in the range (inclusive) that we have data for.  If
+    `columns` is not None, each row only includes those columns.
+    """
+    data = {}
+    for (yyyymmdd, num_rows) in db.execute(
+            'SELECT yyyymmdd, num_rows FROM daily_reports'
+            '  WHERE report = ? AND yyyymmdd BETWEEN ? AND ?',
+            (report, start_yyyymmdd, end_yyyymmdd)):
+        data[yyyymmdd] = [{} for _ in range(num_rows)]
+
+    query = ('SELECT column_name, yyyymmdd, row_index, value'
+             '  FROM daily_values'
+             '  WHERE report = ? AND yyyymmdd BETWEEN ? AND ?')
+    params = [report, start_yyyymmdd, end_yyyymmdd]
+    if columns is not None:
+        query += ' AND column_name IN (%s)' % ', '.join('?' * len(columns))
+        params.extend(columns)
+    for (column_name, yyyymmdd, row_index, value) in db.execute(query,
+                                                                params):
+        data[yyyymmdd][row_index][column_name] = _from_db_value(value)
+    return data
+
+
+def get_daily_data(report, yyyymmdd, columns=None):
     """Gets old data for a particular report.
 
     Returns the data in the format saved (see save_daily_data or the caller),
-    or None if there is no old data for that report on that day.
+    or None if there is no old data for that report on that day.  If
+    `columns` is not None, only those columns of each row are returned.
     """
-    filename = _get_data_filename(report, yyyymmdd)
-    if not os.path.exists(filename):
-        return None
-    else:
-        with open(filename, 'rb') as f:
-            return pickle.load(f)
+    _migrate_pickle(report, yyyymmdd)
+    with _history_db() as db:
+        data = _read_daily_data(db, report, yyyymmdd, yyyymmdd, columns)
+    return data.get(yyyymmdd)
 
 
 def save_daily_data(data, report, yyyymmdd):
     """Saves the data for a report to be used in the future.
 
     This will create the relevant directories if they don't exist, and clobber
-    any existing data with the same timestamp.  "data" can be anything
-    pickleable, but in general will likely be of the format returned from
-    _query_bigquery, namely a list of dicts fieldname -> value.
+    any existing data with the same timestamp.  "data" should be of the
+    format returned from query_bigquery, namely a list of dicts
+    fieldname -> value.  The values can be anything pickleable, but
+    numbers and strings are stored most efficiently.
+    """
+    with _history_db() as db:
+        db.execute('DELETE FROM daily_values'
+                   '  WHERE report = ? AND yyyymmdd = ?',
+                   (report, yyyymmdd))
+        db.execute('DELETE FROM daily_keys'
+                   '  WHERE report = ? AND yyyymmdd = ?',
+                   (report, yyyymmdd))
+        db.execute('INSERT OR REPLACE INTO daily_reports VALUES (?, ?, ?)',
+                   (report, yyyymmdd, len(data)))
+        db.executemany('INSERT INTO daily_values VALUES (?, ?, ?, ?, ?)',
+                       ((report, column_name, yyyymmdd, i, _to_db_value(v))
+                        for (i, row) in enumerate(data)
+                        for (column_name, v) in row.items()))
+
+
+def _migrate_pickle(report, yyyymmdd):
+    """Copy a day's data from its old pickle file, if it has one.
+
+    We used to save each report's data for each day in its own pickle
+    file.  get_daily_data() and process_past_data() call this for each
+    day they read, so old data is copied over the first time we need it.
+    We don't copy over data we already have.  Returns True if we copied
+    the file.
     """
     filename = _get_data_filename(report, yyyymmdd)
-    if not os.path.isdir(os.path.dirname(filename)):
-        os.makedirs(os.path.dirname(filename))
-    with open(filename, 'wb') as f:
-        pickle.dump(data, f, protocol=2)
+    if not os.path.exists(filename):
+        return False
+    with _history_db() as db:
+        if db.execute('SELECT 1 FROM daily_reports'
+                      '  WHERE report = ? AND yyyymmdd = ?',
+                      (report, yyyymmdd)).fetchone():
+            return False
+    with open(filename, 'rb') as f:
+        save_daily_data(pickle.load(f), report, yyyymmdd)
+    return True
+
+
+def migrate_pickled_data(delete=False):
+    """Copy daily data saved in the old pickle files to the history database.
+
+    This copies over all such files at once, rather than as we need them;
+    if `delete` is True, we delete each file once it's copied.  Returns
+    the number of files copied.
+    """
+    if not os.path.isdir(_DATA_DIRECTORY):
+        return 0
+    num_copied = 0
+    for filename in sorted(os.listdir(_DATA_DIRECTORY)):
+        m = re.match(r'(.+)_(\d{8})\.pickle$', filename)
+        if not m:
+            continue
+        if _migrate_pickle(*m.groups()):
+            num_copied += 1
+        if delete:
+            os.unlink(os.path.join(_DATA_DIRECTORY, filename))
+    return num_copied
 
 
 def get_daily_data_from_disk_or_bq(query, report, yyyymmdd):
@@ -113,7 +623,96 @@ def get_daily_data_from_disk_or_bq(query, report, yyyymmdd):
     return daily_data
 
 
-def process_past_data(report, end_date, history_length, keyfn):
+def _history_key(key):
+    """The string we index a row by, for a key returned by a keyfn.
+
+    The same key can come back as different types: the pickle files, and
+    the `bq` command-line tool, guess at types (see _convert_row()), so
+    an url_route of '404' may have been saved as the int 404.  So we
+    compare keys as strings.
+    """
+    if isinstance(key, tuple):
+        return repr(tuple(_history_key(k) for k in key))
+    if key is None:
+        return '(None)'    # what _convert_row() would have made it
+    return str(key)
+
+
+def _key_days(db, report, start_yyyymmdd, end_yyyymmdd, keyfn, columns):
+    """Index the rows of the days in the range we haven't indexed yet.
+
+    We index each row by _history_key(keyfn(row)).  save_daily_data()
+    doesn't know a report's keyfn, so we do this the first time we look
+    a day up by key.  A report should always be looked up with the same
+    keyfn.
+    """
+    days = [yyyymmdd for (yyyymmdd,) in db.execute(
+        'SELECT yyyymmdd FROM daily_reports'
+        '  WHERE report = ? AND yyyymmdd BETWEEN ? AND ? AND num_rows > 0'
+        '  AND NOT EXISTS (SELECT 1 FROM daily_keys'
+        '                  WHERE daily_keys.report = daily_reports.report'
+        '                  AND daily_keys.yyyymmdd = daily_reports.yyyymmdd)',
+        (report, start_yyyymmdd, end_yyyymmdd))]
+    for yyyymmdd in days:
+        rows = _read_daily_data(db, report, yyyymmdd, yyyymmdd,
+                                columns)[yyyymmdd]
+        # If two rows have the same key, the last one wins, like in
+        # process_past_data().
+        db.executemany('INSERT OR REPLACE INTO daily_keys VALUES (?, ?, ?, ?)',
+                       ((report, _history_key(keyfn(row)), yyyymmdd, i)
+                        for (i, row) in enumerate(rows)))
+
+
+def _read_daily_rows_by_key(db, report, start_yyyymmdd, end_yyyymmdd, keys,
+                            columns):
+    """Like _read_daily_data(), but only reads the rows with these keys.
+
+    Returns a dict from yyyymmdd to a dict from each of `keys` to its
+    row that day, or None if there isn't one, for every day in the range
+    that we have data for.  The days must be indexed; see _key_days().
+    """
+    keys_by_history_key = {_history_key(key): key for key in keys}
+    data = {}
+    for (yyyymmdd,) in db.execute(
+            'SELECT yyyymmdd FROM daily_reports'
+            '  WHERE report = ? AND yyyymmdd BETWEEN ? AND ?',
+            (report, start_yyyymmdd, end_yyyymmdd)):
+        data[yyyymmdd] = dict.fromkeys(keys)
+
+    # There may be too many keys for an IN (...), so we put them in a
+    # table to join against.  (CROSS JOIN tells sqlite to look up each
+    # of them in turn, rather than scanning all the keys in the range.)
+    db.execute('CREATE TEMP TABLE IF NOT EXISTS wanted_keys ('
+               '  row_key TEXT PRIMARY KEY)')
+    db.execute('DELETE FROM wanted_keys')
+    db.executemany('INSERT INTO wanted_keys VALUES (?)',
+                   ((k,) for k in keys_by_history_key))
+    query = ('SELECT daily_keys.row_key, daily_keys.yyyymmdd,'
+             '       column_name, value'
+             '  FROM wanted_keys'
+             '  CROSS JOIN daily_keys'
+             '    ON daily_keys.row_key = wanted_keys.row_key'
+             '  JOIN daily_values'
+             '    ON daily_values.report = daily_keys.report'
+             '    AND daily_values.yyyymmdd = daily_keys.yyyymmdd'
+             '    AND daily_values.row_index = daily_keys.row_index'
+             '  WHERE daily_keys.report = ?'
+             '  AND daily_keys.yyyymmdd BETWEEN ? AND ?')
+    params = [report, start_yyyymmdd, end_yyyymmdd]
+    if columns is not None:
+        query += ' AND column_name IN (%s)' % ', '.join('?' * len(columns))
+        params.extend(columns)
+    for (row_key, yyyymmdd, column_name, value) in db.execute(query,
+                                                              params):
+        key = keys_by_history_key[row_key]
+        if data[yyyymmdd][key] is None:
+            data[yyyymmdd][key] = {}
+        data[yyyymmdd][key][column_name] = _from_db_value(value)
+    return data
+
+
+def process_past_data(report, end_date, history_length, keyfn, columns=None,
+                      keys=None):
     """Get and process the past data for a particular report.
 
     Returns a list of dicts, one for each day, in most-recent-first order, with
@@ -121,14 +720,42 @@ def process_past_data(report, end_date, history_length, keyfn):
     returned by `bq`.  If there is no data, the dict will be empty.
     'history_length' is the number of days of data to include, not counting the
     current one.
+
+    If `columns` is not None, each row only includes those columns, which
+    must include everything keyfn() looks at.  We read all the days'
+    data in one go, so this is much faster than calling get_daily_data()
+    for each day, especially if you only need a few columns.
+
+    If `keys` is not None, we only read the rows with those keys, which
+    is faster still: each day we have data for maps each of `keys` to
+    its row that day, or to None if it had no such row.  Keys match if
+    they're equal as strings (see _history_key()), and the dicts use the
+    keys as you passed them.
     """
+    start_yyyymmdd = (end_date - datetime.timedelta(
+        history_length)).strftime("%Y%m%d")
+    end_yyyymmdd = end_date.strftime("%Y%m%d")
+    for i in range(history_length + 1):
+        _migrate_pickle(report, (end_date - datetime.timedelta(i)).strftime(
+            "%Y%m%d"))
+    with _history_db() as db:
+        if keys is None:
+            data = {yyyymmdd: {keyfn(row): row for row in rows}
+                    for (yyyymmdd, rows) in _read_daily_data(
+                        db, report, start_yyyymmdd, end_yyyymmdd,
+                        columns).items()}
+        else:
+            _key_days(db, report, start_yyyymmdd, end_yyyymmdd, keyfn,
+                      columns)
+            data = _read_daily_rows_by_key(db, report, start_yyyymmdd,
+                                           end_yyyymmdd, keys, columns)
+
     historical_data = []
     for i in range(history_length + 1):
         old_yyyymmdd = (end_date - datetime.timedelta(i)).strftime("%Y%m%d")
-        old_data = get_daily_data(report, old_yyyymmdd)
-        # Save it by url_route for easy lookup.
+        old_data = data.get(old_yyyymmdd)
         if old_data:
-            historical_data.append({keyfn(row): row for row in old_data})
+            historical_data.append(old_data)
         else:
             # If we're missing data, put in a placeholder.  This will get
             # carried through and eventually become a space in the graph.
@@ -139,80 +766,660 @@ def process_past_data(report, end_date, history_length, keyfn):
     return historical_data
 
 
+def _convert_row(row):
+    """Do naive type conversion to int and float, in place, when possible.
+
+    This is what we do when we don't know the schema of the results.
+    """
+    for key in row:
+        if row[key] is None:
+            row[key] = '(None)'
+        else:
+            try:
+                row[key] = int(row[key])
+            except ValueError:
+                try:
+                    row[key] = float(row[key])
+                except ValueError:
+                    pass
+            except TypeError:
+                # Row maybe a list
+                pass
+    return row
+
+
+def _parse_bool(value):
+    return value in (True, 'true')
+
+
+# How to convert a value of a given BigQuery type.  Types that aren't
+# listed here (strings, timestamps, dates, etc.) are left as strings.
+_TYPE_CONVERTERS = {
+    'INTEGER': int,
+    'INT64': int,
+    'FLOAT': float,
+    'FLOAT64': float,
+    'NUMERIC': float,
+    'BIGNUMERIC': float,
+    'BOOLEAN': _parse_bool,
+    'BOOL': _parse_bool,
+}
+
+
+def _field_converter(field, null_value):
+    """Return a function that converts a value of the given schema field."""
+    if field.get('mode') == 'REPEATED':
+        convert_elt = _field_converter(dict(field, mode='NULLABLE'),
+                                       null_value)
+        return lambda value: ([convert_elt(v) for v in value]
+                              if value is not None else [])
+    if field['type'] in ('RECORD', 'STRUCT'):
+        subfields = [(f['name'], _field_converter(f, null_value))
+                     for f in field['fields']]
+        return lambda value: ({name: convert(value.get(name))
+                               for (name, convert) in subfields}
+                              if value is not None else null_value)
+    convert = _TYPE_CONVERTERS.get(field['type'])
+    if convert is None:
+        return lambda value: value if value is not None else null_value
+    return lambda value: convert(value) if value is not None else null_value
+
+
+def _row_converter(fields, compact):
+    """Return a function that converts a row of results with this schema.
+
+    The function takes a row as a dict from column-name to the string
+    the backend gave us, and returns it converted to the proper types.
+    We build this once per query, so converting a row is just one call
+    per column, with no guessing at types.
+
+    If `compact` is True, the converted row is a namedtuple, with
+    fields in the same order as the query's columns, and NULL values
+    are None.  Otherwise, the converted row is a dict, and NULL values
+    are the string '(None)'.
+    """
+    if fields is None:
+        # We don't know the schema, so we have to guess at each value.
+        if compact:
+            return lambda row: tuple(
+                None if v == '(None)' else v
+                for v in _convert_row(row).values())
+        return _convert_row
+
+    null_value = None if compact else '(None)'
+    names = [field['name'] for field in fields]
+    converters = [(field['name'], _field_converter(field, null_value))
+                  for field in fields]
+    if compact:
+        # rename=True is needed for column names that aren't valid
+        # python identifiers, like '_col0'.
+        row_class = collections.namedtuple('Row', names, rename=True)
+        return lambda row: row_class._make(
+            [convert(row.get(name)) for (name, convert) in converters])
+    return lambda row: {name: convert(row.get(name))
+                        for (name, convert) in converters}
+
+
+# Hit/miss counts for the query cache, since this process started.
+_cache_stats = {'hits': 0, 'misses': 0}
+_cache_stats_lock = threading.Lock()
+
+
+def default_cache_ttl(sql_query):
+    """Return how long to cache the results of this query, in seconds.
+
+    The daily requestlogs tables don't change once the day is over, so
+    results over past days can be cached forever.  The fastly log tables
+    are streamed into, so we only cache those results for a little while.
+    Anything else we don't know about, so we don't cache it at all.
+    """
+    if 'khanacademy_dot_org_' in sql_query:     # the fastly logs
+        return _STREAMING_CACHE_TTL
+    yyyymmdds = re.findall(r'requestlogs_(\d{8})\b', sql_query)
+    today = datetime.datetime.utcnow().strftime('%Y%m%d')
+    if yyyymmdds and all(yyyymmdd < today for yyyymmdd in yyyymmdds):
+        return CACHE_FOREVER
+    return 0
+
+
+def _cache_key(sql_query, project, max_rows):
+    # Leading and trailing whitespace can vary depending on how the
+    # caller built the query, but doesn't change what it does.  We leave
+    # the rest alone: whitespace inside a string literal matters.
+    return hashlib.sha1(json.dumps(
+        [sql_query.strip(), project, max_rows]).encode('utf-8')).hexdigest()
+
+
+@contextlib.contextmanager
+def _query_cache_db():
+    """Yield a connection to the query-cache database, in a transaction."""
+    if not os.path.isdir(_DATA_DIRECTORY):
+        os.makedirs(_DATA_DIRECTORY)
+    db = sqlite3.connect(os.path.join(_DATA_DIRECTORY, 'query_cache.sqlite'))
+    try:
+        with db:
+            # expires is NULL for results we can keep forever.
+            db.execute('CREATE TABLE IF NOT EXISTS query_cache ('
+                       '  cache_key TEXT PRIMARY KEY, expires REAL,'
+                       '  last_used REAL, num_bytes INTEGER, pages BLOB)')
+            db.execute('CREATE INDEX IF NOT EXISTS query_cache_last_used'
+                       '  ON query_cache (last_used)')
+            yield db
+    finally:
+        db.close()
+
+
+def _cache_get(cache_key):
+    """Return the cached pages of results for this key, or None."""
+    now = time.time()
+    with _query_cache_db() as db:
+        row = db.execute('SELECT pages FROM query_cache'
+                         '  WHERE cache_key = ?'
+                         '    AND (expires IS NULL OR expires > ?)',
+                         (cache_key, now)).fetchone()
+        if row is not None:
+            db.execute('UPDATE query_cache SET last_used = ?'
+                       '  WHERE cache_key = ?', (now, cache_key))
+    with _cache_stats_lock:
+        _cache_stats['hits' if row is not None else 'misses'] += 1
+    return pickle.loads(row[0]) if row is not None else None
+
+
+def _cache_put(cache_key, pages, ttl):
+    """Cache the pages of results for this key, and evict old entries."""
+    now = time.time()
+    blob = pickle.dumps(pages, protocol=2)
+    if len(blob) > _CACHE_MAX_BYTES:
+        return
+    expires = None if ttl == CACHE_FOREVER else now + ttl
+    with _query_cache_db() as db:
+        db.execute('DELETE FROM query_cache'
+                   '  WHERE expires IS NOT NULL AND expires <= ?', (now,))
+        db.execute('INSERT OR REPLACE INTO query_cache VALUES (?, ?, ?, ?, ?)',
+                   (cache_key, expires, now, len(blob), sqlite3.Binary(blob)))
+        # Evict the least-recently-used results until we fit.
+        (total_bytes,) = db.execute(
+            'SELECT SUM(num_bytes) FROM query_cache').fetchone()
+        for (old_key, num_bytes) in db.execute(
+                'SELECT cache_key, num_bytes FROM query_cache'
+                '  ORDER BY last_used').fetchall():
+            if total_bytes <= _CACHE_MAX_BYTES:
+                break
+            db.execute('DELETE FROM query_cache WHERE cache_key = ?',
+                       (old_key,))
+            total_bytes -= num_bytes
+
+
+def get_cache_stats():
+    """Return a dict of stats about the query cache.
+
+    'hits' and 'misses' count lookups since this process started;
+    'entries' and 'num_bytes' describe what's in the cache right now.
+    """
+    with _query_cache_db() as db:
+        (entries, num_bytes) = db.execute(
+            'SELECT COUNT(*), IFNULL(SUM(num_bytes), 0) FROM query_cache'
+        ).fetchone()
+    with _cache_stats_lock:
+        stats = dict(_cache_stats)
+    stats.update(entries=entries, num_bytes=num_bytes)
+    return stats
+
+
+# Every query we've logged in this process; see _log_query().
+_query_records = []
+_query_records_lock = threading.Lock()
+
+
+def _new_query_record(sql_query, label):
+    """Return a dict describing a query, for _log_query() to log."""
+    return {
+        'start_time': time.time(),
+        'label': label or os.path.basename(sys.argv[0]) or 'unknown',
+        # So you can tell when the same query is run more than once.
+        'query_hash': hashlib.sha1(
+            sql_query.strip().encode('utf-8')).hexdigest()[:12],
+        'job_id': None,
+        'cache_hit': False,
+        'retries': 0,
+        'bytes_processed': None,
+        'bytes_billed': None,
+        'rows': None,
+        'error': None,
+    }
+
+
+def _log_query(record):
+    """Log the stats about a query that just finished (or failed).
+
+    We append them, as a line of json, to ~/bq_data/query_log.jsonl, and
+    keep them around for send_query_stats_to_cloudmonitoring().  Once the
+    log gets to _QUERY_LOG_MAX_BYTES, we move it to query_log.jsonl.1,
+    replacing the one that was there, and start a new one.
+    """
+    record['wall_time'] = round(time.time() - record['start_time'], 3)
+    with _query_records_lock:
+        _query_records.append(record)
+        try:
+            if not os.path.isdir(_DATA_DIRECTORY):
+                os.makedirs(_DATA_DIRECTORY)
+            log_path = os.path.join(_DATA_DIRECTORY, 'query_log.jsonl')
+            try:
+                if os.path.getsize(log_path) >= _QUERY_LOG_MAX_BYTES:
+                    os.replace(log_path, log_path + '.1')
+            except FileNotFoundError:
+                pass
+            with open(log_path, 'a') as f:
+                f.write(json.dumps(record, sort_keys=True) + '\n')
+        except (IOError, OSError) as why:
+            # Not being able to log is no reason to fail the query.
+            print("-- Unable to log query stats: %s --" % why)
+
+
+def get_query_records():
+    """Return the stats for every query run by this process, so far."""
+    with _query_records_lock:
+        return list(_query_records)
+
+
+def send_query_stats_to_cloudmonitoring(google_project_id, dry_run=False):
+    """Send a summary of the queries this process has run to stackdriver.
+
+    For each label, we send how many queries we ran, how long they took,
+    how many bytes they scanned, how many were served from the cache,
+    and how many retries they needed -- all in one request.
+    """
+    import cloudmonitoring_util
+
+    summaries = collections.defaultdict(collections.Counter)
+    for record in get_query_records():
+        summary = summaries[record['label']]
+        summary['count'] += 1
+        summary['seconds'] += record['wall_time']
+        summary['bytes_processed'] += record['bytes_processed'] or 0
+        summary['cache_hits'] += 1 if record['cache_hit'] else 0
+        summary['retries'] += record['retries']
+        summary['errors'] += 1 if record['error'] else 0
+
+    # send_timeseries_to_cloudmonitoring() wants 4-tuples:
+    #    (metric-name, metric-labels, value, time).
+    now = time.time()
+    data = [('bigquery.queries.%s' % stat, {'caller': label}, value, now)
+            for (label, summary) in sorted(summaries.items())
+            for (stat, value) in sorted(summary.items())]
+    return cloudmonitoring_util.send_timeseries_to_cloudmonitoring(
+        google_project_id, data, dry_run=dry_run)
+
+
+def _random_job_name():
+    # We specify the job-name (randomly) so we can cancel it.
+    return 'bq_util_%s' % random.randint(0, sys.maxsize)
+
+
+class QueryJob(object):
+    """A query running in BigQuery.  Use submit_query() to make one.
+
+    This lets you start a query, go off and do other things, and then
+    check on it (poll()), wait for it (wait()), or give up on it
+    (cancel()).  If checking on it fails, we retry just the check.  Once
+    it's done, iter_pages() gets the results; if downloading them fails,
+    we retry just the download, since BigQuery keeps the results of a
+    finished job around for a while.
+    """
+    def __init__(self, sql_query, job_id, project, gdrive=False,
+                 backend=None):
+        self.sql_query = sql_query
+        self.job_id = job_id
+        self.project = project
+        self.gdrive = gdrive
+        self.backend = backend or get_backend()
+        self.started = False
+        self.done = False
+        self.canceled = False
+        # The 'statistics' field of the BigQuery job, once it's done.
+        self.statistics = {}
+        # How many times we've had to retry checking on the job, and
+        # downloading the results.
+        self.num_poll_retries = 0
+        self.num_fetch_retries = 0
+
+    def start(self, timeout=None):
+        """Start the job.
+
+        Some backends (like the `bq` tool) run the whole query when they
+        start it; with those, we raise a BQTimeout if that takes more
+        than `timeout` seconds.
+        """
+        self.started = True
+        self.backend.start_query(self.sql_query, self.job_id, self.project,
+                                 gdrive=self.gdrive, timeout=timeout)
+
+    def poll(self, retries=_POLL_RETRIES):
+        """Return True if the job is done, False if it's still running.
+
+        Raises a BQJobFailed if the job failed.  If we can't find out
+        how the job is doing, we retry up to `retries` times, and then
+        raise a BQException; the job may well still be running.
+        """
+        if not self.done:
+            for i in range(1 + retries):
+                try:
+                    job = self.backend.get_job(self.job_id, self.project)
+                    break
+                except BQException as why:
+                    if i == retries:
+                        raise
+                    print("-- Checking on %s failed, retrying: %s --"
+                          % (self.job_id, why))
+                    self.num_poll_retries += 1
+                    time.sleep(min(_MIN_POLL_INTERVAL * 2 ** i,
+                                   _MAX_POLL_INTERVAL))
+            status = job.get('status', {})
+            self.statistics = job.get('statistics', {})
+            if status.get('errorResult'):
+                self.done = True
+                raise BQJobFailed("Query job %s failed: %s"
+                                  % (self.job_id,
+                                     status['errorResult'].get('message')))
+            self.done = (status.get('state') == 'DONE')
+        return self.done
+
+    def wait(self, timeout=None):
+        """Wait until the job is done, for at most `timeout` seconds.
+
+        Raises a BQTimeout if the job isn't done by then (in which case
+        it keeps running; see cancel()), a BQJobFailed if it failed, or
+        a BQException if we can't find out; see poll().
+        """
+        deadline = time.time() + timeout if timeout is not None else None
+        poll_interval = _MIN_POLL_INTERVAL
+        while not self.poll():
+            if deadline is not None:
+                time_left = deadline - time.time()
+                if time_left <= 0:
+                    raise BQTimeout("Query job %s did not finish in %ss"
+                                    % (self.job_id, timeout))
+                poll_interval = min(poll_interval, time_left)
+            time.sleep(poll_interval)
+            poll_interval = min(poll_interval * 2, _MAX_POLL_INTERVAL)
+
+    def cancel(self):
+        """Cancel the job if it's still running.  It's ok to call this twice.
+
+        We don't care if the cancel fails, since that probably means
+        the job finished (or failed) on its own.
+        """
+        if not self.started or self.done or self.canceled:
+            return
+        self.canceled = True
+        try:
+            self.backend.cancel(self.job_id, self.project)
+        except BQException:
+            print("That's ok, it just means the job canceled itself.")
+
+    def iter_pages(self, page_size=_PAGE_SIZE, retries=2):
+        """Yield the results of the (finished) job, a page at a time.
+
+        Each page is a pair (fields, rows); see iter_result_pages() in
+        the backends.  If fetching the results fails, we retry up to
+        `retries` times, picking up where we left off.
+        """
+        num_rows = 0
+        for i in range(1 + retries):
+            try:
+                for (fields, rows) in self.backend.iter_result_pages(
+                        self.job_id, self.project, page_size=page_size,
+                        start_row=num_rows):
+                    num_rows += len(rows)
+                    yield (fields, rows)
+                return
+            except BQException as why:
+                if i == retries:
+                    raise
+                print("-- Fetching results of %s failed, retrying: %s --"
+                      % (self.job_id, why))
+                self.num_fetch_retries += 1
+
+    def bytes_processed(self):
+        """How many bytes the query scanned, or None if we don't know."""
+        query_statistics = self.statistics.get('query', {})
+        num_bytes = query_statistics.get(
+            'totalBytesProcessed', self.statistics.get('totalBytesProcessed'))
+        return int(num_bytes) if num_bytes is not None else None
+
+    def bytes_billed(self):
+        """How many bytes we paid for, or None if we don't know."""
+        num_bytes = self.statistics.get('query', {}).get('totalBytesBilled')
+        return int(num_bytes) if num_bytes is not None else None
+
+
+def submit_query(sql_query, gdrive=False, job_name=None,
+                 project='khanacademy.org:deductive-jet-827'):
+    """Start running a query in BigQuery, and return a QueryJob for it.
+
+    This returns as soon as BigQuery has the query; it doesn't wait for
+    it to finish (unless the backend can't help but wait; see
+    _CommandLineBackend).  If you'd like to view the results of this query in the
+    bigquery web UI, you may wish to pass a unique string as `job_name`.
+    """
+    job = QueryJob(sql_query, job_name or _random_job_name(), project,
+                   gdrive=gdrive)
+    job.start()
+    return job
+
+
+def _start_query(sql_query, gdrive, retries, job_name, project, page_size,
+                 timeout, record):
+    """Run a query, retrying as needed, and return the job and its pages.
+
+    The pages are an iterator of the (fields, rows) pages of results.
+    We fill in `record` -- see _new_query_record() -- as we go.
+
+    We don't return until the first page of results is in, so that we can
+    retry the whole query if it fails.  We only rerun the query if
+    starting it failed, or the job itself failed: if we just can't check
+    on it, or download its results, we retry that instead, since rerunning
+    the query means paying for it again.
+
+    If `timeout` is not None, we give up (and cancel the query) if it
+    hasn't finished after that many seconds, counting any retries.
+    """
+    deadline = time.time() + timeout if timeout is not None else None
+    error_msg = None
+
+    for i in range(1 + retries):
+        job = QueryJob(sql_query, job_name or _random_job_name(), project,
+                       gdrive=gdrive)
+        # Clear out job_name so it will be regenerated if this query fails
+        job_name = None
+        record['job_id'] = job.job_id
+        record['retries'] = i
+        try:
+            job.start(deadline - time.time() if deadline is not None
+                      else None)
+        except BQTimeout:
+            job.cancel()
+            raise
+        except BQException as why:
+            print("-- Starting query failed: %s --" % why)
+            error_msg = str(why)
+            job.cancel()
+            continue
+        try:
+            job.wait(deadline - time.time() if deadline is not None
+                     else None)
+        except BQJobFailed as why:
+            print("-- Running query failed: %s --" % why)
+            error_msg = str(why)
+            continue
+        except BQException:
+            # We timed out, or couldn't find out how the job is doing
+            # even after retrying (see QueryJob.poll()).
+            job.cancel()
+            raise
+        record['retries'] += job.num_poll_retries
+
+        record['bytes_processed'] = job.bytes_processed()
+        record['bytes_billed'] = job.bytes_billed()
+        pages = job.iter_pages(page_size=page_size, retries=retries)
+        first_page = next(pages, (None, []))
+        return (job, itertools.chain([first_page], pages))
+
+    raise BQException("-- Query failed after %d retries: %s --"
+                      % (retries, error_msg))
+
+
+def _convert_pages(pages, compact):
+    """Yield the converted rows from the (fields, rows) pages of results."""
+    convert = None
+    for (fields, rows) in pages:
+        if convert is None:
+            convert = _row_converter(fields, compact)
+        for row in rows:
+            yield convert(row)
+
+
+def iter_query_rows(sql_query, gdrive=False, retries=2, job_name=None,
+                    project='khanacademy.org:deductive-jet-827',
+                    page_size=_PAGE_SIZE, compact=False, timeout=None,
+                    label=None):
+    """Run a query in BigQuery, and yield the resulting rows one at a time.
+
+    This is like query_bigquery(), but rather than getting all the rows at
+    once, we page through them, fetching `page_size` rows at a time, so we
+    only ever hold one page of results in memory.  Each row is converted
+    the same way query_bigquery() does it.  We never cache the results.
+
+    The query is retried, limited by `timeout`, and logged under `label`,
+    like in query_bigquery().  We log it once we've gone through all the
+    rows (or given up).
+    """
+    record = _new_query_record(sql_query, label)
+    job = None
+    try:
+        (job, pages) = _start_query(sql_query, gdrive, retries, job_name,
+                                    project, page_size, timeout, record)
+        record['rows'] = 0
+        for row in _convert_pages(pages, compact):
+            record['rows'] += 1
+            yield row
+    except BQException as why:
+        record['error'] = str(why)
+        raise
+    finally:
+        if job is not None:
+            record['retries'] += job.num_fetch_retries
+        _log_query(record)
+
+
 def query_bigquery(sql_query, gdrive=False, retries=2, job_name=None,
-                   project='khanacademy.org:deductive-jet-827'):
-    """Use the 'bq' tool to run a query, and return the results as
+                   project='khanacademy.org:deductive-jet-827',
+                   max_rows=None, compact=False, cache_ttl=None,
+                   timeout=None, label=None):
+    """Run a query in BigQuery, and return the results as
     a json list (each row is a dict).
 
-    We do naive type conversion to int and float, when possible.
+    We use the schema of the results to convert each value to the right
+    python type: INTEGER columns become ints, FLOAT columns floats, and
+    BOOLEAN columns bools; everything else stays a string.  NULL values
+    become the string '(None)'.
 
-    The bq tool fails every once in a while for flaky reasons, so by default we
-    retry the query a few times.
+    If you pass compact=True, each row is instead a namedtuple, with the
+    columns in the order the query lists them, and NULL values are None.
+    This takes a lot less memory for big results.
 
-    This requires 'pip install bigquery' be run on this machine.
+    BigQuery fails every once in a while for flaky reasons, so by default we
+    retry the query a few times.  If the query succeeds but downloading the
+    results fails, we only retry the download.  If `timeout` is not None,
+    we cancel the query and raise a BQTimeout if we don't have results
+    after that many seconds, counting retries.
+
+    We cache the results on disk for `cache_ttl` seconds (or forever, if
+    it's CACHE_FOREVER); running the same query again in that time just
+    returns the cached results.  By default we use default_cache_ttl(),
+    which only caches queries over tables we know how to handle.  Pass 0
+    to skip the cache.
+
+    How we talk to BigQuery depends on the backend; see get_backend().
+    We return all the rows the query produces, unless you limit it via
+    `max_rows`.  If you don't need them all at once, consider using
+    iter_query_rows() instead.
+
+    We log how long the query took, how much data it scanned, and so
+    forth, under `label` (by default, the name of the running script);
+    see _log_query().
 
     If you'd like to view the results of this query in the bigquery web UI, you
     may wish to pass a unique string as the `job_name` param. Note that if the
     first attempt at this query fails, we'll overwrite the job_name with a
     randomly generated one.
     """
-    # We could probably do 'import bq' and call out directly, but
-    # I couldn't figure out an easy way to do this.  Ah well.
-    # To avoid having to deal with paging (which I think the command-line bq is
-    # not very good at anyway), we just get a bunch of rows.  We probably only
-    # want to display the first 100 or so, but the rest may be useful to save.
+    if cache_ttl is None:
+        cache_ttl = default_cache_ttl(sql_query)
+    cache_key = _cache_key(sql_query, project, max_rows) if cache_ttl else None
 
-    table = None
-    error_msg = None
+    record = _new_query_record(sql_query, label)
+    try:
+        pages = _cache_get(cache_key) if cache_key else None
+        record['cache_hit'] = pages is not None
+        if pages is None:
+            page_size = min(max_rows, _PAGE_SIZE) if max_rows else _PAGE_SIZE
+            (job, job_pages) = _start_query(sql_query, gdrive, retries,
+                                            job_name, project, page_size,
+                                            timeout, record)
+            pages = []
+            num_rows = 0
+            for (fields, rows) in job_pages:
+                pages.append((fields, rows))
+                num_rows += len(rows)
+                if max_rows is not None and num_rows >= max_rows:
+                    break
+            record['retries'] += job.num_fetch_retries
+            if cache_key:
+                _cache_put(cache_key, pages, cache_ttl)
 
-    for i in range(1 + retries):
-        try:
-            if not job_name:
-                # We specify the job-name (randomly) so we can cancel it.
-                job_name = 'bq_util_%s' % random.randint(0, sys.maxsize)
+        table = list(itertools.islice(_convert_pages(pages, compact),
+                                      max_rows))
+        record['rows'] = len(table)
+        return table
+    except BQException as why:
+        record['error'] = str(why)
+        raise
+    finally:
+        _log_query(record)
 
-            # call_bq can return None when there are no results for
-            # the query.  We map that to [].
-            table = call_bq(['--job_id', job_name] +
-                            (['--enable_gdrive'] if gdrive else []) +
-                            ['query', '--max_rows=10000', sql_query],
-                            project=project) or []
-            job_name = None     # to indicate the job has finished
-            break
-        except subprocess.CalledProcessError as why:
-            print("-- Running query failed with retcode %d --"
-                  % why.returncode)
-            error_msg = why.output
-        finally:
-            if job_name:
-                try:        # Cancel the job if it's still running
-                    call_bq(['--nosync', 'cancel', job_name],
-                            project=project, return_output=False)
-                except subprocess.CalledProcessError:
-                    print("That's ok, it just means the job canceled itself.")
-                    pass    # probably means the job finished already
-
-            # Clear out job_name so it will be regenerated if this query failed
-            job_name = None
-
-    if table is None:
-        raise BQException("-- Query failed after %d retries: %s --"
-                          % (retries, error_msg))
-
-    for row in table:
-        for key in row:
-            if row[key] is None:
-                row[key] = '(None)'
-            else:
-                try:
-                    row[key] = int(row[key])
-                except ValueError:
-                    try:
-                        row[key] = float(row[key])
-                    except ValueError:
-                        pass
-                except TypeError:
-                    # Row maybe a list
-                    pass
 
-    return table
+def query_many(sql_queries, max_concurrent=_MAX_CONCURRENT_QUERIES,
+               **kwargs):
+    """Run several queries at once, and return a list of their results.
+
+    Most of the time spent running a query is spent waiting for BigQuery,
+    so independent queries can run in parallel.  Each query is run via
+    query_bigquery(sql_query, **kwargs) -- so it gets the same retries and
+    canceling -- with at most `max_concurrent` of them in flight at a time.
+    The results are in the same order as `sql_queries`.  If any query
+    fails, we raise its exception (once all the queries are done).
+    """
+    if not sql_queries:
+        return []
+    pool = multiprocessing.dummy.Pool(min(max_concurrent, len(sql_queries)))
+    try:
+        return pool.map(lambda q: query_bigquery(q, **kwargs), sql_queries)
+    finally:
+        pool.close()
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--migrate-pickles', action='store_true',
+                        help=('Copy the daily data from the pickle files in '
+                              '%s to the history database' % _DATA_DIRECTORY))
+    parser.add_argument('--delete', action='store_true',
+                        help=('With --migrate-pickles, delete the pickle '
+                              'files once they are copied'))
+    args = parser.parse_args()
+    if args.migrate_pickles:
+        print('Copied %d pickle files' % migrate_pickled_data(args.delete))
+    else:
+        parser.print_help()
@@ -0,0 +1,690 @@
+import datetime
+import json
+import os
+import pickle
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+import unittest
+
+import apiclient.discovery
+import apiclient.http
+
+import bq_util
+
+
+class DataDirectoryTestCase(unittest.TestCase):
+    """Keeps all daily data, and the query log, in a temporary directory."""
+    def setUp(self):
+        data_dir = tempfile.mkdtemp()
+        self.addCleanup(lambda: shutil.rmtree(data_dir))
+        old_data_dir = bq_util._DATA_DIRECTORY
+        bq_util._DATA_DIRECTORY = data_dir
+        self.addCleanup(lambda: setattr(bq_util, '_DATA_DIRECTORY',
+                                        old_data_dir))
+
+
+class BackendTestCase(DataDirectoryTestCase):
+    """Runs every test against a FakeBackend holding `results`."""
+    results = {}
+
+    def setUp(self):
+        super(BackendTestCase, self).setUp()
+        self.backend = bq_util.FakeBackend(self.results)
+        old_backend = bq_util.set_backend(self.backend)
+        self.addCleanup(lambda: bq_util.set_backend(old_backend))
+
+
+class TestQueryBigquery(BackendTestCase):
+    results = {
+        'FROM [numbers]': [{'count': '12', 'ratio': '0.5', 'name': 'abc',
+                            'missing': None}],
+        'FROM [flaky]': bq_util.BQException('backend error'),
+    }
+
+    def test_converts_types(self):
+        self.assertEqual(
+            [{'count': 12, 'ratio': 0.5, 'name': 'abc', 'missing': '(None)'}],
+            bq_util.query_bigquery('SELECT * FROM [numbers]'))
+
+    def test_no_results_returns_empty_list(self):
+        self.assertEqual([], bq_util.query_bigquery('SELECT * FROM [empty]'))
+
+    def test_retries_then_raises(self):
+        with self.assertRaises(bq_util.BQException):
+            bq_util.query_bigquery('SELECT * FROM [flaky]', retries=2)
+        self.assertEqual(3, len(self.backend.queries))
+        # Each failed attempt gets canceled, with a fresh job id each time.
+        self.assertEqual(3, len(set(self.backend.canceled)))
+
+    def test_finished_query_is_not_canceled(self):
+        bq_util.query_bigquery('SELECT * FROM [numbers]', job_name='my_job')
+        self.assertEqual([], self.backend.canceled)
+
+
+class TestCommandLineBackend(DataDirectoryTestCase):
+    """Runs queries via the `bq` tool, with a fake call_bq()."""
+    def setUp(self):
+        super(TestCommandLineBackend, self).setUp()
+        old_backend = bq_util.set_backend(bq_util._CommandLineBackend())
+        self.addCleanup(lambda: bq_util.set_backend(old_backend))
+        orig_call_bq = bq_util.call_bq
+        bq_util.call_bq = self.fake_call_bq
+        self.addCleanup(lambda: setattr(bq_util, 'call_bq', orig_call_bq))
+        # The args of each call to `bq`.
+        self.calls = []
+        # What each `bq query` does: return these rows, or raise this.
+        self.query_results = [[{'n': '1', 'id': '007'}, {'n': '2'}]]
+        # The rows in the query's results table, for `bq head`.
+        self.table_rows = []
+
+    def fake_call_bq(self, subcommand_list, project, return_output=True,
+                     raise_exception=True, **kwargs):
+        self.calls.append(subcommand_list)
+        if 'query' in subcommand_list:
+            result = self.query_results.pop(0)
+            if isinstance(result, Exception):
+                raise result
+            return result
+        if subcommand_list[:2] == ['show', '-j']:
+            return {'configuration': {'query': {'destinationTable': {
+                'projectId': 'p', 'datasetId': 'd', 'tableId': 't'}}}}
+        if subcommand_list[0] == 'head':
+            start_row = int(subcommand_list[1].split('=')[1])
+            max_rows = int(subcommand_list[2].split('=')[1])
+            return self.table_rows[start_row:start_row + max_rows]
+        return None
+
+    def test_query_is_one_bq_call(self):
+        self.assertEqual([{'n': 1, 'id': 7}, {'n': 2}],
+                         bq_util.query_bigquery('SELECT n FROM [t]',
+                                                job_name='my_job'))
+        self.assertEqual(
+            [['--job_id', 'my_job', 'query', '--max_rows=10000',
+              'SELECT n FROM [t]']],
+            self.calls)
+
+    def test_pages_only_when_first_page_is_full(self):
+        orig_page_size = bq_util._PAGE_SIZE
+        bq_util._PAGE_SIZE = 2
+        self.addCleanup(lambda: setattr(bq_util, '_PAGE_SIZE',
+                                        orig_page_size))
+        self.table_rows = [{'n': str(i)} for i in range(5)]
+        self.query_results = [self.table_rows[:2]]
+        self.assertEqual(list(range(5)),
+                         [row['n'] for row in bq_util.query_bigquery(
+                             'SELECT n FROM [t]', cache_ttl=0)])
+        self.assertEqual(
+            [['show', '-j'], ['head', '--start_row=2'],
+             ['head', '--start_row=4']],
+            [call[:2] for call in self.calls[1:]])
+
+    def test_no_results(self):
+        self.query_results = [None]
+        self.assertEqual([], bq_util.query_bigquery('SELECT n FROM [t]'))
+        self.assertEqual(1, len(self.calls))
+
+    def test_failed_query_is_canceled_and_retried(self):
+        self.query_results.insert(
+            0, subprocess.CalledProcessError(1, 'bq', output='flaky'))
+        self.assertEqual(2, len(bq_util.query_bigquery('SELECT n FROM [t]')))
+        self.assertEqual(['query', 'cancel', 'query'],
+                         [next(arg for arg in call
+                               if arg in ('query', 'cancel'))
+                          for call in self.calls])
+
+    def test_timeout(self):
+        self.query_results = [subprocess.TimeoutExpired('bq', 1)]
+        with self.assertRaises(bq_util.BQTimeout):
+            bq_util.query_bigquery('SELECT n FROM [t]', timeout=1)
+        # We cancel the query, and don't retry it.
+        self.assertEqual(2, len(self.calls))
+        self.assertIn('cancel', self.calls[1])
+
+
+class TestSchemaConversion(DataDirectoryTestCase):
+    def setUp(self):
+        super(TestSchemaConversion, self).setUp()
+        fields = [
+            {'name': 'blast_id', 'type': 'STRING'},
+            {'name': 'count', 'type': 'INTEGER'},
+            {'name': 'ratio', 'type': 'FLOAT'},
+            {'name': 'blocked', 'type': 'BOOLEAN'},
+            {'name': 'routes', 'type': 'STRING', 'mode': 'REPEATED'},
+            {'name': 'waf', 'type': 'RECORD',
+             'fields': [{'name': 'hits', 'type': 'INTEGER'}]},
+        ]
+        rows = [
+            {'blast_id': '000123', 'count': '4', 'ratio': '2', 'routes': [],
+             'blocked': 'true', 'waf': {'hits': '7'}},
+            {'blast_id': '1e5', 'count': None, 'ratio': '0.25',
+             'routes': ['123'], 'blocked': 'false', 'waf': None},
+        ]
+        self.backend = bq_util.FakeBackend({'[blasts]': rows},
+                                           schemas={'[blasts]': fields})
+        old_backend = bq_util.set_backend(self.backend)
+        self.addCleanup(lambda: bq_util.set_backend(old_backend))
+
+    def test_dict_rows(self):
+        self.assertEqual(
+            [{'blast_id': '000123', 'count': 4, 'ratio': 2.0, 'routes': [],
+              'blocked': True, 'waf': {'hits': 7}},
+             {'blast_id': '1e5', 'count': '(None)', 'ratio': 0.25,
+              'routes': ['123'], 'blocked': False, 'waf': '(None)'}],
+            bq_util.query_bigquery('SELECT * FROM [blasts]'))
+
+    def test_compact_rows(self):
+        rows = bq_util.query_bigquery('SELECT * FROM [blasts]', compact=True)
+        self.assertEqual(('000123', 4, 2.0, True, [], {'hits': 7}), rows[0])
+        self.assertEqual(('1e5', None, 0.25, False, ['123'], None), rows[1])
+        self.assertEqual(None, rows[1].count)
+
+
+class TestIterQueryRows(BackendTestCase):
+    results = {
+        'FROM [big]': [{'n': str(i)} for i in range(25)],
+    }
+
+    def test_pages_through_all_rows(self):
+        rows = bq_util.iter_query_rows('SELECT n FROM [big]', page_size=10)
+        self.assertEqual(list(range(25)), [row['n'] for row in rows])
+
+    def test_query_bigquery_is_not_truncated(self):
+        rows = bq_util.query_bigquery('SELECT n FROM [big]')
+        self.assertEqual(25, len(rows))
+
+    def test_query_bigquery_max_rows(self):
+        rows = bq_util.query_bigquery('SELECT n FROM [big]', max_rows=12)
+        self.assertEqual(list(range(12)), [row['n'] for row in rows])
+
+
+class _NeverDoneFakeBackend(bq_util.FakeBackend):
+    def get_job(self, job_id, project):
+        return {'status': {'state': 'RUNNING'}}
+
+
+class _FailingJobFakeBackend(bq_util.FakeBackend):
+    def get_job(self, job_id, project):
+        return {'status': {'state': 'DONE',
+                           'errorResult': {'message': 'Syntax error'}}}
+
+
+class TestQueryJobs(BackendTestCase):
+    results = {
+        'FROM [numbers]': [{'n': str(i)} for i in range(25)],
+    }
+
+    def test_submit_and_wait(self):
+        job = bq_util.submit_query('SELECT n FROM [numbers]')
+        self.assertTrue(job.poll())
+        job.wait(timeout=1)
+        rows = [row for (_, page) in job.iter_pages() for row in page]
+        self.assertEqual(25, len(rows))
+
+    def test_cancel_is_idempotent(self):
+        bq_util.set_backend(_NeverDoneFakeBackend())
+        job = bq_util.submit_query('SELECT n FROM [numbers]')
+        self.assertFalse(job.poll())
+        job.cancel()
+        job.cancel()
+        self.assertEqual([job.job_id], job.backend.canceled)
+
+    def test_finished_job_is_not_canceled(self):
+        job = bq_util.submit_query('SELECT n FROM [numbers]')
+        job.wait()
+        job.cancel()
+        self.assertEqual([], self.backend.canceled)
+
+    def test_timeout(self):
+        backend = _NeverDoneFakeBackend()
+        bq_util.set_backend(backend)
+        with self.assertRaises(bq_util.BQTimeout):
+            bq_util.query_bigquery('SELECT n FROM [numbers]', timeout=0.2)
+        # We don't retry after a timeout, and we cancel the query.
+        self.assertEqual(1, len(backend.queries))
+        self.assertEqual(1, len(backend.canceled))
+
+    def test_failed_job_is_retried(self):
+        backend = _FailingJobFakeBackend()
+        bq_util.set_backend(backend)
+        with self.assertRaises(bq_util.BQException):
+            bq_util.query_bigquery('SELECT n FROM [numbers]', retries=2)
+        self.assertEqual(3, len(backend.queries))
+
+    def test_failed_poll_does_not_rerun_query(self):
+        self.backend.poll_errors = [bq_util.BQException('flaky poll')] * 2
+        rows = bq_util.query_bigquery('SELECT n FROM [numbers]')
+        self.assertEqual(list(range(25)), [row['n'] for row in rows])
+        self.assertEqual(1, len(self.backend.queries))
+        self.assertEqual([], self.backend.canceled)
+
+    def test_poll_that_keeps_failing_is_raised(self):
+        self.backend.poll_errors = [bq_util.BQException('down')] * 10
+        with self.assertRaises(bq_util.BQException):
+            bq_util.query_bigquery('SELECT n FROM [numbers]', retries=2)
+        # We give up on the job, rather than paying to run it again.
+        self.assertEqual(1, len(self.backend.queries))
+        self.assertEqual(1, len(self.backend.canceled))
+
+    def test_failed_fetch_does_not_rerun_query(self):
+        self.backend.fetch_errors = [bq_util.BQException('flaky download')]
+        rows = bq_util.query_bigquery('SELECT n FROM [numbers]')
+        self.assertEqual(list(range(25)), [row['n'] for row in rows])
+        self.assertEqual(1, len(self.backend.queries))
+
+    def test_failed_fetch_resumes_where_it_left_off(self):
+        backend = self.backend
+        real_iter_result_pages = backend.iter_result_pages
+        calls = []
+
+        def flaky_iter_result_pages(job_id, project, page_size, start_row):
+            calls.append(start_row)
+            pages = real_iter_result_pages(job_id, project, page_size,
+                                           start_row)
+            yield next(pages)
+            if len(calls) == 1:
+                raise bq_util.BQException('connection reset')
+            for page in pages:
+                yield page
+
+        backend.iter_result_pages = flaky_iter_result_pages
+        rows = bq_util.iter_query_rows('SELECT n FROM [numbers]',
+                                       page_size=10)
+        self.assertEqual(list(range(25)), [row['n'] for row in rows])
+        self.assertEqual([0, 10], calls)
+
+
+class _SlowFakeBackend(bq_util.FakeBackend):
+    """A FakeBackend that keeps track of how many queries run at once."""
+    def __init__(self, *args, **kwargs):
+        super(_SlowFakeBackend, self).__init__(*args, **kwargs)
+        self.lock = threading.Lock()
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    def start_query(self, *args, **kwargs):
+        with self.lock:
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        time.sleep(0.01)
+        with self.lock:
+            self.in_flight -= 1
+        return super(_SlowFakeBackend, self).start_query(*args, **kwargs)
+
+
+class TestQueryMany(DataDirectoryTestCase):
+    def setUp(self):
+        super(TestQueryMany, self).setUp()
+        self.backend = _SlowFakeBackend(
+            {'[t%d]' % i: [{'i': str(i)}] for i in range(10)})
+        self.backend.results['[broken]'] = bq_util.BQException('oops')
+        old_backend = bq_util.set_backend(self.backend)
+        self.addCleanup(lambda: bq_util.set_backend(old_backend))
+
+    def test_results_are_in_order(self):
+        queries = ['SELECT i FROM [t%d]' % i for i in range(10)]
+        self.assertEqual([[{'i': i}] for i in range(10)],
+                         bq_util.query_many(queries))
+
+    def test_concurrency_is_bounded(self):
+        queries = ['SELECT i FROM [t%d]' % i for i in range(10)]
+        bq_util.query_many(queries, max_concurrent=3)
+        self.assertLessEqual(self.backend.max_in_flight, 3)
+        self.assertGreater(self.backend.max_in_flight, 1)
+
+    def test_failure_is_raised(self):
+        with self.assertRaises(bq_util.BQException):
+            bq_util.query_many(
+                ['SELECT i FROM [t1]', 'SELECT * FROM [broken]'], retries=0)
+
+    def test_no_queries(self):
+        self.assertEqual([], bq_util.query_many([]))
+
+
+class TestDoesTableExist(BackendTestCase):
+    def setUp(self):
+        super(TestDoesTableExist, self).setUp()
+        self.backend.tables.add('logs.requestlogs_20200101')
+
+    def test_exists(self):
+        self.assertTrue(bq_util.does_table_exist('logs.requestlogs_20200101'))
+
+    def test_does_not_exist(self):
+        self.assertFalse(bq_util.does_table_exist('logs.requestlogs_19700101'))
+
+
+class TestDailyData(DataDirectoryTestCase):
+    def test_save_and_get(self):
+        data = [{'url_route': '/a', 'count_': 3, 'cost': 1.5, 'tags': ['x']},
+                {'url_route': '/b', 'count_': 4, 'cost': '(None)',
+                 'tags': []}]
+        bq_util.save_daily_data(data, 'instance_hours', '20200102')
+        self.assertEqual(data,
+                         bq_util.get_daily_data('instance_hours', '20200102'))
+        self.assertEqual([{'count_': 3}, {'count_': 4}],
+                         bq_util.get_daily_data('instance_hours', '20200102',
+                                                columns=['count_']))
+
+    def test_missing_day(self):
+        self.assertIsNone(bq_util.get_daily_data('instance_hours', '20200102'))
+
+    def test_save_clobbers_old_data(self):
+        bq_util.save_daily_data([{'a': 1}, {'a': 2}], 'r', '20200102')
+        bq_util.save_daily_data([{'b': 3}], 'r', '20200102')
+        self.assertEqual([{'b': 3}], bq_util.get_daily_data('r', '20200102'))
+
+    def test_empty_day(self):
+        bq_util.save_daily_data([], 'r', '20200102')
+        self.assertEqual([], bq_util.get_daily_data('r', '20200102'))
+
+    def test_process_past_data(self):
+        bq_util.save_daily_data([{'route': '/a', 'n': 1, 'other': 'x'}],
+                                'r', '20200101')
+        bq_util.save_daily_data([{'route': '/a', 'n': 3, 'other': 'y'},
+                                 {'route': '/b', 'n': 4, 'other': 'z'}],
+                                'r', '20200103')
+        historical_data = bq_util.process_past_data(
+            'r', datetime.date(2020, 1, 3), 3, lambda row: row['route'],
+            columns=['route', 'n'])
+        self.assertEqual([{},
+                          {'/a': {'route': '/a', 'n': 1}},
+                          {},
+                          {'/a': {'route': '/a', 'n': 3},
+                           '/b': {'route': '/b', 'n': 4}}],
+                         historical_data)
+
+    def test_process_past_data_by_key(self):
+        bq_util.save_daily_data([{'route': '/a', 'n': 1},
+                                 {'route': '/c', 'n': 2}],
+                                'r', '20200101')
+        bq_util.save_daily_data([{'route': '/a', 'n': 3},
+                                 {'route': '/b', 'n': 4}],
+                                'r', '20200103')
+        historical_data = bq_util.process_past_data(
+            'r', datetime.date(2020, 1, 3), 3, lambda row: row['route'],
+            columns=['route', 'n'], keys=['/a', '/b'])
+        self.assertEqual([{},
+                          {'/a': {'route': '/a', 'n': 1}, '/b': None},
+                          {},
+                          {'/a': {'route': '/a', 'n': 3},
+                           '/b': {'route': '/b', 'n': 4}}],
+                         historical_data)
+
+        # Saving a day again replaces its rows' keys, too.
+        bq_util.save_daily_data([{'route': '/b', 'n': 5}], 'r', '20200103')
+        historical_data = bq_util.process_past_data(
+            'r', datetime.date(2020, 1, 3), 0, lambda row: row['route'],
+            columns=['route', 'n'], keys=['/a', '/b'])
+        self.assertEqual([{'/a': None, '/b': {'route': '/b', 'n': 5}}],
+                         historical_data)
+
+    def test_keys_match_as_strings(self):
+        bq_util.save_daily_data([{'module_id': 'default', 'route': 404,
+                                  'n': 1}],
+                                'r', '20200101')
+        historical_data = bq_util.process_past_data(
+            'r', datetime.date(2020, 1, 1), 0,
+            lambda row: (row['module_id'], row['route']),
+            columns=['module_id', 'route', 'n'], keys=[('default', '404')])
+        self.assertEqual(
+            [{('default', '404'): {'module_id': 'default', 'route': 404,
+                                   'n': 1}}],
+            historical_data)
+
+    def test_pickled_data_is_migrated_when_read(self):
+        # Old pickle files have the types `bq` guessed at.
+        with open(os.path.join(bq_util._DATA_DIRECTORY,
+                               'log_bytes_20200101.pickle'), 'wb') as f:
+            pickle.dump([{'firstword': 404, 'size_mb': 2.5}], f, protocol=2)
+        historical_data = bq_util.process_past_data(
+            'log_bytes', datetime.date(2020, 1, 2), 1,
+            lambda row: row['firstword'], columns=['firstword', 'size_mb'],
+            keys=['404'])
+        self.assertEqual([{'404': {'firstword': 404, 'size_mb': 2.5}}, {}],
+                         historical_data)
+        self.assertEqual([{'firstword': 404, 'size_mb': 2.5}],
+                         bq_util.get_daily_data('log_bytes', '20200101'))
+
+    def test_migrate_pickled_data(self):
+        data = [{'module_id': 'default', 'count_': 7}]
+        with open(os.path.join(bq_util._DATA_DIRECTORY,
+                               'out_of_memory_errors_by_module_20200101'
+                               '.pickle'), 'wb') as f:
+            pickle.dump(data, f, protocol=2)
+        self.assertEqual(1, bq_util.migrate_pickled_data(delete=True))
+        self.assertEqual(data, bq_util.get_daily_data(
+            'out_of_memory_errors_by_module', '20200101'))
+        self.assertEqual(['history.sqlite'],
+                         os.listdir(bq_util._DATA_DIRECTORY))
+
+
+class TestQueryCache(DataDirectoryTestCase):
+    def setUp(self):
+        super(TestQueryCache, self).setUp()
+        self.backend = bq_util.FakeBackend({
+            'requestlogs_20200101': [{'n': '1'}],
+            'fastly': [{'n': '2'}],
+            'big': [{'n': str(i)} for i in range(100)],
+        })
+        old_backend = bq_util.set_backend(self.backend)
+        self.addCleanup(lambda: bq_util.set_backend(old_backend))
+
+    def test_default_cache_ttl(self):
+        self.assertEqual(bq_util.CACHE_FOREVER, bq_util.default_cache_ttl(
+            'SELECT * FROM [logs.requestlogs_20200101]'))
+        self.assertEqual(0, bq_util.default_cache_ttl(
+            'SELECT * FROM [logs.requestlogs_99991231]'))
+        self.assertEqual(bq_util._STREAMING_CACHE_TTL,
+                         bq_util.default_cache_ttl(
+                             'SELECT * FROM [fastly.khanacademy_dot_org_logs'
+                             '_20200101@-600000-]'))
+        self.assertEqual(0, bq_util.default_cache_ttl('SELECT 1'))
+
+    def test_past_day_is_cached(self):
+        q = 'SELECT n FROM [logs.requestlogs_20200101]'
+        self.assertEqual([{'n': 1}], bq_util.query_bigquery(q))
+        # Leading and trailing whitespace doesn't matter.
+        self.assertEqual([{'n': 1}],
+                         bq_util.query_bigquery('\n  %s\n' % q))
+        self.assertEqual(1, len(self.backend.queries))
+        stats = bq_util.get_cache_stats()
+        self.assertEqual(1, stats['entries'])
+        self.assertGreaterEqual(stats['hits'], 1)
+
+    def test_whitespace_in_strings_matters(self):
+        q = "SELECT n FROM [logs.requestlogs_20200101] WHERE s = '%s'"
+        bq_util.query_bigquery(q % 'a b')
+        bq_util.query_bigquery(q % 'a  b')
+        self.assertEqual(2, len(self.backend.queries))
+
+    def test_expired_results_are_not_used(self):
+        q = 'SELECT n FROM [fastly]'
+        bq_util.query_bigquery(q, cache_ttl=-1)
+        bq_util.query_bigquery(q, cache_ttl=-1)
+        self.assertEqual(2, len(self.backend.queries))
+
+    def test_no_caching(self):
+        q = 'SELECT n FROM [logs.requestlogs_20200101]'
+        bq_util.query_bigquery(q, cache_ttl=0)
+        bq_util.query_bigquery(q, cache_ttl=0)
+        self.assertEqual(2, len(self.backend.queries))
+
+    def test_evicts_least_recently_used(self):
+        old_max_bytes = bq_util._CACHE_MAX_BYTES
+        bq_util._CACHE_MAX_BYTES = 1000
+        self.addCleanup(lambda: setattr(bq_util, '_CACHE_MAX_BYTES',
+                                        old_max_bytes))
+        for i in range(20):
+            bq_util.query_bigquery('SELECT n FROM [big] -- %d' % i,
+                                   cache_ttl=bq_util.CACHE_FOREVER,
+                                   max_rows=10)
+        stats = bq_util.get_cache_stats()
+        self.assertLessEqual(stats['num_bytes'], 1000)
+        self.assertLess(stats['entries'], 20)
+        # The most recent one is still there.
+        bq_util.query_bigquery('SELECT n FROM [big] -- 19',
+                               cache_ttl=bq_util.CACHE_FOREVER, max_rows=10)
+        self.assertEqual(20, len(self.backend.queries))
+
+
+class TestQueryLog(BackendTestCase):
+    results = {'SELECT 1': [{'a': '1'}],
+               'SELECT 2': bq_util.BQException('no such table')}
+
+    def setUp(self):
+        super(TestQueryLog, self).setUp()
+        bq_util._query_records[:] = []
+
+    def test_logs_each_query(self):
+        bq_util.query_bigquery('SELECT 1', label='test', cache_ttl=60)
+        bq_util.query_bigquery('SELECT 1\n', label='test', cache_ttl=60)
+        (miss, hit) = bq_util.get_query_records()
+        self.assertEqual('test', miss['label'])
+        self.assertFalse(miss['cache_hit'])
+        self.assertIsNotNone(miss['job_id'])
+        self.assertEqual(1, miss['rows'])
+        self.assertTrue(hit['cache_hit'])
+        self.assertIsNone(hit['job_id'])
+        self.assertEqual(miss['query_hash'], hit['query_hash'])
+
+        with open(os.path.join(bq_util._DATA_DIRECTORY,
+                               'query_log.jsonl')) as f:
+            logged = [json.loads(line) for line in f]
+        self.assertEqual([miss['job_id'], None],
+                         [r['job_id'] for r in logged])
+
+    def test_logs_failed_queries(self):
+        with self.assertRaises(bq_util.BQException):
+            bq_util.query_bigquery('SELECT 2', retries=0)
+        (record,) = bq_util.get_query_records()
+        self.assertIsNotNone(record['error'])
+
+    def test_log_is_rotated(self):
+        orig_max_bytes = bq_util._QUERY_LOG_MAX_BYTES
+        bq_util._QUERY_LOG_MAX_BYTES = 1
+        self.addCleanup(lambda: setattr(bq_util, '_QUERY_LOG_MAX_BYTES',
+                                        orig_max_bytes))
+        for label in ('a', 'b', 'c'):
+            bq_util.query_bigquery('SELECT 1', label=label, cache_ttl=0)
+        log_path = os.path.join(bq_util._DATA_DIRECTORY, 'query_log.jsonl')
+        # We keep the current log, and the one before it.
+        for (path, label) in ((log_path + '.1', 'b'), (log_path, 'c')):
+            with open(path) as f:
+                self.assertEqual([label],
+                                 [json.loads(line)['label'] for line in f])
+
+
+class _RecordingHttp(apiclient.http.HttpMockSequence):
+    """An HttpMockSequence that remembers the requests it was sent."""
+    def __init__(self, responses):
+        super(_RecordingHttp, self).__init__(responses)
+        self.requests = []
+
+    def request(self, uri, method='GET', body=None, *args, **kwargs):
+        path = uri.split('?')[0].split('/bigquery/v2/')[1]
+        self.requests.append((method, path,
+                              json.loads(body) if body else None))
+        return super(_RecordingHttp, self).request(uri, method, body,
+                                                   *args, **kwargs)
+
+
+class TestApiBackend(DataDirectoryTestCase):
+    """Runs queries through the real API client, over a fake http."""
+    fields = [{'name': 'route', 'type': 'STRING'},
+              {'name': 'count', 'type': 'INTEGER'}]
+
+    def use_responses(self, responses):
+        self.http = _RecordingHttp([({'status': str(status)}, json.dumps(body))
+                                    for (status, body) in responses])
+        backend = bq_util._ApiBackend()
+        # The discovery document comes with the client library, so this
+        # doesn't go over the network.
+        backend._local.service = apiclient.discovery.build(
+            'bigquery', 'v2', http=self.http, static_discovery=True)
+        old_backend = bq_util.set_backend(backend)
+        self.addCleanup(lambda: bq_util.set_backend(old_backend))
+
+    def test_query(self):
+        self.use_responses([
+            (200, {}),                                  # insert
+            (200, {'status': {'state': 'RUNNING'}}),    # get
+            (200, {'status': {'state': 'DONE'},
+                   'statistics': {'query': {
+                       'totalBytesProcessed': '1000',
+                       'totalBytesBilled': '2000'}}}),
+            (200, {'schema': {'fields': self.fields},
+                   'rows': [{'f': [{'v': '007'}, {'v': '3'}]}],
+                   'pageToken': 'next'}),
+            (200, {'schema': {'fields': self.fields},
+                   'rows': [{'f': [{'v': '/a'}, {'v': None}]}]}),
+        ])
+        self.assertEqual([{'route': '007', 'count': 3},
+                          {'route': '/a', 'count': '(None)'}],
+                         bq_util.query_bigquery('SELECT route, count FROM [t]',
+                                                job_name='my_job',
+                                                project='proj'))
+        self.assertEqual([('POST', 'projects/proj/jobs'),
+                          ('GET', 'projects/proj/jobs/my_job'),
+                          ('GET', 'projects/proj/jobs/my_job'),
+                          ('GET', 'projects/proj/queries/my_job'),
+                          ('GET', 'projects/proj/queries/my_job')],
+                         [(method, path)
+                          for (method, path, _) in self.http.requests])
+        self.assertEqual({'jobReference': {'projectId': 'proj',
+                                           'jobId': 'my_job'},
+                          'configuration': {'query': {
+                              'query': 'SELECT route, count FROM [t]'}}},
+                         self.http.requests[0][2])
+        (record,) = bq_util.get_query_records()[-1:]
+        self.assertEqual(1000, record['bytes_processed'])
+        self.assertEqual(2000, record['bytes_billed'])
+
+    def test_failed_poll_is_retried(self):
+        self.use_responses([
+            (200, {}),
+            (503, {'error': {'message': 'backend error'}}),
+            (200, {'status': {'state': 'DONE'}}),
+            (200, {'schema': {'fields': self.fields}}),
+        ])
+        self.assertEqual([], bq_util.query_bigquery('SELECT route FROM [t]'))
+        self.assertEqual(['POST', 'GET', 'GET', 'GET'],
+                         [method for (method, _, _) in self.http.requests])
+
+    def test_failed_job_is_rerun(self):
+        self.use_responses([
+            (200, {}),
+            (200, {'status': {'state': 'DONE',
+                              'errorResult': {'message': 'oops'}}}),
+            (200, {}),
+            (200, {'status': {'state': 'DONE'}}),
+            (200, {'schema': {'fields': self.fields}}),
+        ])
+        self.assertEqual([], bq_util.query_bigquery('SELECT route FROM [t]'))
+        self.assertEqual(2, [method for (method, _, _) in self.http.requests]
+                         .count('POST'))
+
+
+class TestApiRowToDict(unittest.TestCase):
+    def test_nested_and_repeated_fields(self):
+        fields = [
+            {'name': 'ip', 'type': 'STRING'},
+            {'name': 'time', 'type': 'TIMESTAMP'},
+            {'name': 'counts', 'type': 'INTEGER', 'mode': 'REPEATED'},
+            {'name': 'waf', 'type': 'RECORD',
+             'fields': [{'name': 'message', 'type': 'STRING'}]},
+        ]
+        row = {'f': [{'v': '1.2.3.4'},
+                     {'v': '1.5778368E9'},
+                     {'v': [{'v': '1'}, {'v': '2'}]},
+                     {'v': {'f': [{'v': 'blocked'}]}}]}
+        self.assertEqual({'ip': '1.2.3.4',
+                          'time': '2020-01-01 00:00:00',
+                          'counts': ['1', '2'],
+                          'waf': {'message': 'blocked'}},
+                         bq_util._api_row_to_dict(row, fields))
+
+
+if __name__ == '__main__':
+    unittest.main()
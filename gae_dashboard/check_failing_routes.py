@@ -124,7 +124,9 @@ def notify(route_data, date):
 def check(date, dry_run=False):
     yyyymmdd = date.strftime("%Y%m%d")
     q = QUERY.format(yyyymmdd)
-    data = bq_util.query_bigquery(q)
+    # We only keep the rows we care about, so there's no need to hold
+    # the entire result set in memory.
+    data = bq_util.iter_query_rows(q)
     route_data = [row for row in data
                   if not (row['route'] in ROUTES_EXPECTED_TO_FAIL or
                           any([r.match(row['route']) for r in BAD_ROUTES_RE])
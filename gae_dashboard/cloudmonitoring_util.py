@@ -4,15 +4,18 @@ Cloud Monitoring monitors and alerts based on timeseries data for App
 Engine and Compute Engine.
 """
 import calendar
+import collections
+import concurrent.futures
+import hashlib
 import http.client
 import logging
 import os
+import random
 import re
 import socket
+import threading
 import time
 
-import alertlib
-
 
 def to_rfc3339(time_t):
     """Format a time_t in seconds since the UNIX epoch per RFC 3339."""
@@ -29,87 +32,338 @@ def from_rfc3339(iso_string):
     return calendar.timegm(time_t)
 
 
-def _call_with_retries(fn, num_retries=9):
-    """Run fn (a network command) up to 9 times for non-fatal errors."""
-    import apiclient.errors
-    import oauth2client.client
-    for i in range(num_retries + 1):     # the last time, we re-raise
-        try:
-            return fn()
-        except (socket.error, http.client.HTTPException,
-                oauth2client.client.Error):
-            if i == num_retries:
-                raise
-            pass
-        except apiclient.errors.HttpError as e:
-            if i == num_retries:
-                raise
+# httplib2, which the API service objects use, isn't thread-safe, so each
+# thread gets its own services; see get_cloud_service().
+_thread_local = threading.local()
+
+
+class RetryPolicy(object):
+    """How, and how much, to retry network commands that fail.
+
+    We retry errors that are probably temporary -- network errors, and
+    403s (probably rate-limiting), 429s and 5xx's from the API -- up to
+    `num_retries` times.  Before retry number i (counting from 0), we
+    wait a random time between 0 and base_delay * 2**i seconds, but no
+    more than `max_delay`; or, if the server says how long to wait (with
+    a Retry-After header), that long, again up to `max_delay`.
+
+    So that we don't make things worse when an API is having trouble,
+    retries come out of a budget, shared by everything using the policy:
+    each retry takes one from it, and each success puts back
+    `budget_per_success`, up to `max_budget`.  When it's empty, we stop
+    retrying until enough calls succeed.
+
+    stats() says how many errors of each kind we've seen, and how many
+    times we retried or gave up.
+    """
+    def __init__(self, num_retries=9, base_delay=0.5, max_delay=30,
+                 max_budget=100, budget_per_success=0.1):
+        self.num_retries = num_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.max_budget = max_budget
+        self.budget_per_success = budget_per_success
+        self._budget = max_budget
+        self._stats = collections.Counter()
+        self._lock = threading.Lock()
+
+    def stats(self):
+        """Return a map from kind of error or outcome to how many we've had.
+
+        The keys are the error classes from _error_class(), plus
+        'retries', 'gave_up' (we ran out of retries), and
+        'budget_exhausted' (we didn't retry because of the budget).
+        """
+        with self._lock:
+            return dict(self._stats)
+
+    def _error_class(self, e):
+        """Return the kind of error e is, or None if it's not retryable."""
+        import apiclient.errors
+        import oauth2client.client
+
+        if isinstance(e, apiclient.errors.HttpError):
             code = int(e.resp['status'])
-            if code == 403 or code >= 500:     # 403: rate-limiting probably
-                pass
+            if code in (403, 429):     # 403: rate-limiting probably
+                return 'http_%s' % code
+            elif code >= 500:
+                return 'http_5xx'
+            return None
+        elif isinstance(e, socket.error):
+            return 'socket'
+        elif isinstance(e, http.client.HTTPException):
+            return 'http_client'
+        elif isinstance(e, oauth2client.client.Error):
+            return 'oauth'
+        return None
+
+    def _delay(self, e, retry):
+        """How long to wait before retry number `retry` (from 0)."""
+        retry_after = getattr(e, 'resp', None) and e.resp.get('retry-after')
+        if retry_after:
+            try:
+                return min(float(retry_after), self.max_delay)
+            except ValueError:
+                pass     # it's an HTTP date; we just use our own delay
+        return random.uniform(
+            0, min(self.base_delay * 2 ** retry, self.max_delay))
+
+    def call(self, fn, num_retries=None):
+        """Return fn() (a network command), retrying as described above."""
+        if num_retries is None:
+            num_retries = self.num_retries
+        for i in range(num_retries + 1):     # the last time, we re-raise
+            try:
+                retval = fn()
+            except Exception as e:
+                error_class = self._error_class(e)
+                if error_class is None:
+                    raise
+                with self._lock:
+                    self._stats[error_class] += 1
+                    if i == num_retries:
+                        self._stats['gave_up'] += 1
+                        raise
+                    if self._budget < 1:
+                        self._stats['budget_exhausted'] += 1
+                        raise
+                    self._budget -= 1
+                    self._stats['retries'] += 1
+                # Wait a bit before the next request.
+                time.sleep(self._delay(e, i))
             else:
-                raise
-        time.sleep(0.5)     # wait a bit before the next request
+                with self._lock:
+                    self._budget = min(
+                        self._budget + self.budget_per_success,
+                        self.max_budget)
+                return retval
+
+
+# The retry policy that everything uses, unless told otherwise.
+DEFAULT_RETRY_POLICY = RetryPolicy()
+
+
+def _call_with_retries(fn, num_retries=None, retry_policy=None):
+    """Run fn (a network command), retrying non-fatal errors.
+
+    By default we retry as many times as the retry policy says.
+    """
+    return (retry_policy or DEFAULT_RETRY_POLICY).call(
+        fn, num_retries=num_retries)
+
+
+# Where we keep the API discovery documents that discovery.build() needs,
+# so we don't have to fetch them every time a script starts up.
+_DISCOVERY_CACHE_DIRECTORY = os.path.join(
+    os.path.expanduser('~'), '.cache', 'cloudmonitoring_util', 'discovery')
+
+# How long, in seconds, we use a discovery document before re-fetching it.
+_DISCOVERY_CACHE_SECONDS = 24 * 60 * 60
+
+
+class _DiscoveryCache(object):
+    """A cache of discovery documents on disk, for discovery.build().
+
+    It's only a cache, so if we can't read or write it, we just say we
+    don't have the document.
+    """
+    def __init__(self, directory, max_age):
+        self.directory = directory
+        self.max_age = max_age
+
+    def _filename(self, url):
+        return os.path.join(self.directory,
+                            hashlib.sha1(url.encode('utf-8')).hexdigest())
+
+    def get(self, url):
+        filename = self._filename(url)
+        try:
+            if time.time() - os.path.getmtime(filename) > self.max_age:
+                return None
+            with open(filename) as f:
+                return f.read()
+        except (IOError, OSError):
+            return None
 
+    def set(self, url, content):
+        if isinstance(content, bytes):
+            content = content.decode('utf-8')
+        filename = self._filename(url)
+        try:
+            if not os.path.isdir(self.directory):
+                os.makedirs(self.directory)
+            # Write it all, then rename, so no one reads half of it.
+            tmpfile = '%s.%s.tmp' % (filename, os.getpid())
+            with open(tmpfile, 'w') as f:
+                f.write(content)
+            os.replace(tmpfile, filename)
+        except (IOError, OSError) as e:
+            logging.warning("Unable to cache discovery document for %s: %s",
+                            url, e)
+
+
+# Map from scope to the credentials we use for it.  Every service with
+# that scope shares the credentials, so when they expire, we only need to
+# refresh them once.
+_credentials = {}
+_credentials_lock = threading.Lock()
+
+
+def _get_credentials(scope):
+    import oauth2client.service_account
+
+    with _credentials_lock:
+        if scope not in _credentials:
+            # Load the private key that we need to get data from Cloud
+            # compute.  This will (properly) raise an exception if this
+            # file isn't installed (it's acquired from the Cloud Platform
+            # Console).
+            _credentials[scope] = (
+                oauth2client.service_account.ServiceAccountCredentials.
+                from_json_keyfile_name(
+                    os.path.expanduser('~/cloudmonitoring_secret.json'),
+                    scopes=[scope]))
+        return _credentials[scope]
 
-def get_cloud_service(service_name, version_number, scope=None):
+
+def get_cloud_service(service_name, version_number, scope=None,
+                      timeout=None):
+    """Return a client for the given google cloud API.
+
+    We only build each client once per thread: httplib2, which the
+    clients use, isn't thread-safe, so threads can't share them.  The
+    discovery documents we build them from are cached on disk, and the
+    credentials are shared by all the threads.
+
+    If `timeout` is not None, the client's requests time out after that
+    many seconds of waiting on the network.
+    """
     import apiclient.discovery
     import httplib2
-    import oauth2client.service_account
 
     scope = 'https://www.googleapis.com/auth/%s' % (
         scope if scope is not None else service_name)
 
+    key = (service_name, version_number, scope, timeout)
+    if not hasattr(_thread_local, 'services'):
+        _thread_local.services = {}
+    if key in _thread_local.services:
+        return _thread_local.services[key]
+
     def get_service():
-        # Load the private key that we need to get data from Cloud compute.
-        # This will (properly) raise an exception if this file
-        # isn't installed (it's acquired from the Cloud Platform Console).
-        credentials = (oauth2client.service_account.ServiceAccountCredentials.
-                       from_json_keyfile_name(
-                           os.path.expanduser('~/cloudmonitoring_secret.json'),
-                           scopes=[scope]))
-        http = credentials.authorize(httplib2.Http())
-        return apiclient.discovery.build(serviceName=service_name,
-                                         version=version_number, http=http)
+        http = _get_credentials(scope).authorize(
+            httplib2.Http(timeout=timeout))
+        return apiclient.discovery.build(
+            serviceName=service_name, version=version_number, http=http,
+            cache=_DiscoveryCache(_DISCOVERY_CACHE_DIRECTORY,
+                                  _DISCOVERY_CACHE_SECONDS))
+
+    service = _call_with_retries(get_service)
+    _thread_local.services[key] = service
+    return service
+
 
-    return _call_with_retries(get_service)
+def execute_with_retries(request, num_retries=None, retry_policy=None):
+    """Run request.execute(), retrying non-fatal errors.
 
+    See RetryPolicy for how we retry; by default, we use
+    DEFAULT_RETRY_POLICY, and retry as many times as it says.
+    """
+    return _call_with_retries(request.execute, num_retries=num_retries,
+                              retry_policy=retry_policy)
 
-def execute_with_retries(request, num_retries=9):
-    """Run request.execute() up to 9 times for non-fatal errors."""
-    return _call_with_retries(request.execute, num_retries=num_retries)
+
+# The most timeseries the Cloud Monitoring API lets us write in one request.
+_MAX_TIMESERIES_PER_REQUEST = 200
+
+
+class TimeseriesBatcher(object):
+    """Collects datapoints, and writes them to Cloud Monitoring in batches.
+
+    Use it like:
+        batcher = TimeseriesBatcher('khan-academy')
+        batcher.add('my.metric', {'my_label': 'value'}, 1.0, time.time())
+        ...
+        batcher.send()
+
+    We write up to _MAX_TIMESERIES_PER_REQUEST timeseries per request,
+    and send up to `max_parallel_requests` requests at once.  Each request
+    is retried on its own (see execute_with_retries()), so one failing
+    doesn't make us re-send the others.
+    """
+    def __init__(self, google_project_id, max_parallel_requests=4):
+        self.google_project_id = google_project_id
+        self.max_parallel_requests = max_parallel_requests
+        # Map from (metric-name, sorted metric-labels) to (value, time).
+        self._points = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self._points)
+
+    def add(self, metric_name, metric_labels, value, time_t):
+        # Cloud Monitoring won't take two points for the same timeseries
+        # in one request, so we keep only the latest one.
+        key = (metric_name, tuple(sorted((metric_labels or {}).items())))
+        if key not in self._points or time_t >= self._points[key][1]:
+            self._points[key] = (value, time_t)
+
+    def timeseries(self):
+        """Return what we'd send, as a list of Cloud Monitoring timeseries."""
+        return [
+            {'metric': {'type': 'custom.googleapis.com/%s' % metric_name,
+                        'labels': {k: str(v) for (k, v) in metric_labels}},
+             'resource': {'type': 'global',
+                          'labels': {'project_id': self.google_project_id}},
+             'points': [{'interval': {'endTime': to_rfc3339(time_t)},
+                         'value': {'doubleValue': float(value)}}]}
+            for ((metric_name, metric_labels), (value, time_t))
+            in self._points.items()]
+
+    def _write_timeseries(self, timeseries):
+        service = get_cloud_service('monitoring', 'v3')
+        request = service.projects().timeSeries().create(
+            name='projects/%s' % self.google_project_id,
+            body={'timeSeries': timeseries})
+        execute_with_retries(request)
+
+    def send(self, dry_run=False):
+        """Write the datapoints we've collected, and forget them.
+
+        Returns the number of timeseries we wrote (or would have).  If
+        some requests fail, we still make the rest, and then raise.
+        """
+        timeseries = self.timeseries()
+        self._points.clear()
+        if not timeseries:
+            return 0
+        if dry_run:
+            logging.debug("Would send to stackdriver: %s", timeseries)
+            return len(timeseries)
+
+        logging.debug("Sending to stackdriver: %s", timeseries)
+        chunks = [timeseries[i:i + _MAX_TIMESERIES_PER_REQUEST]
+                  for i in range(0, len(timeseries),
+                                 _MAX_TIMESERIES_PER_REQUEST)]
+        with concurrent.futures.ThreadPoolExecutor(
+                min(self.max_parallel_requests, len(chunks))) as executor:
+            futures = [executor.submit(self._write_timeseries, chunk)
+                       for chunk in chunks]
+        errors = [future.exception() for future in futures
+                  if future.exception() is not None]
+        if errors:
+            logging.error("%s of %s requests to stackdriver failed",
+                          len(errors), len(chunks))
+            raise errors[0]
+        return len(timeseries)
 
 
 def send_timeseries_to_cloudmonitoring(google_project_id, data, dry_run=False):
-    """data is a list of 4tuples: (metric-name, metric-labels, value, time)."""
-    # alertlib is set up to only send one timeseries per call.  But we
-    # want to send all the timeseries in a single call, so we have to
-    # do some hackery.
-    timeseries_data = []
-    alert = alertlib.Alert('gae-dashboard metrics')
-    old_send_datapoints = alert.send_datapoints_to_stackdriver
-    alert.send_datapoints_to_stackdriver = lambda timeseries, *a, **kw: (
-        timeseries_data.extend(timeseries))
-
-    # This will put the data into timeseries_data but not actually send it.
-    try:
-        for (metric_name, metric_labels, value, time_t) in data:
-            logging.info("Collecting to send to stackdriver: %s (%s) %s %s",
-                         metric_name, metric_labels, value, time_t)
-            alert.send_to_stackdriver(metric_name, value,
-                                      metric_labels=metric_labels,
-                                      project=google_project_id,
-                                      when=time_t)
-    finally:
-        alert.send_datapoints_to_stackdriver = old_send_datapoints
-
-    # Now we do the actual send.
-    if timeseries_data and not dry_run:
-        logging.debug("Sending to stackdriver: %s", timeseries_data)
-        alert.send_datapoints_to_stackdriver(timeseries_data,
-                                             project=google_project_id,
-                                             ignore_errors=False)
-    elif timeseries_data and dry_run:
-        logging.debug("Would send to stackdriver: %s", timeseries_data)
-
-    return len(timeseries_data)
+    """data is a list of 4tuples: (metric-name, metric-labels, value, time).
+
+    We send them in as few requests as the API allows; see
+    TimeseriesBatcher.
+    """
+    batcher = TimeseriesBatcher(google_project_id)
+    for (metric_name, metric_labels, value, time_t) in data:
+        batcher.add(metric_name, metric_labels, value, time_t)
+    return batcher.send(dry_run=dry_run)
@@ -0,0 +1,209 @@
+import os
+import shutil
+import socket
+import tempfile
+import threading
+import time
+import unittest
+import unittest.mock
+
+import apiclient.errors
+import httplib2
+
+import cloudmonitoring_util
+
+
+def _http_error(status, headers=None):
+    resp = httplib2.Response(dict(headers or {}, status=str(status)))
+    return apiclient.errors.HttpError(resp, b'')
+
+
+class TestRetryPolicy(unittest.TestCase):
+    def setUp(self):
+        self.sleeps = []
+        orig_sleep = cloudmonitoring_util.time.sleep
+        self.addCleanup(setattr, cloudmonitoring_util.time, 'sleep',
+                        orig_sleep)
+        cloudmonitoring_util.time.sleep = self.sleeps.append
+
+    def _fail_then_succeed(self, errors):
+        errors = list(errors)
+
+        def fn():
+            if errors:
+                raise errors.pop(0)
+            return 'ok'
+        return fn
+
+    def test_retries_temporary_errors(self):
+        policy = cloudmonitoring_util.RetryPolicy()
+        fn = self._fail_then_succeed(
+            [_http_error(503), _http_error(403), socket.error()])
+        self.assertEqual('ok', policy.call(fn))
+        self.assertEqual({'http_5xx': 1, 'http_403': 1, 'socket': 1,
+                          'retries': 3},
+                         policy.stats())
+
+    def test_does_not_retry_other_errors(self):
+        policy = cloudmonitoring_util.RetryPolicy()
+        with self.assertRaises(apiclient.errors.HttpError):
+            policy.call(self._fail_then_succeed([_http_error(404)]))
+        self.assertEqual([], self.sleeps)
+        self.assertEqual({}, policy.stats())
+
+    def test_uses_the_policys_number_of_retries(self):
+        policy = cloudmonitoring_util.RetryPolicy(num_retries=1)
+        request = unittest.mock.Mock(
+            execute=self._fail_then_succeed([socket.error()] * 2))
+        with self.assertRaises(socket.error):
+            cloudmonitoring_util.execute_with_retries(request,
+                                                      retry_policy=policy)
+        self.assertEqual(1, policy.stats()['retries'])
+
+    def test_gives_up(self):
+        policy = cloudmonitoring_util.RetryPolicy(num_retries=2)
+        with self.assertRaises(apiclient.errors.HttpError):
+            policy.call(self._fail_then_succeed([_http_error(500)] * 3))
+        self.assertEqual(2, len(self.sleeps))
+        self.assertEqual({'http_5xx': 3, 'retries': 2, 'gave_up': 1},
+                         policy.stats())
+
+    def test_exponential_backoff(self):
+        policy = cloudmonitoring_util.RetryPolicy(base_delay=1, max_delay=5)
+        policy.call(self._fail_then_succeed([socket.error()] * 6))
+        for (i, delay) in enumerate(self.sleeps):
+            self.assertTrue(0 <= delay <= min(2 ** i, 5), (i, delay))
+
+    def test_retry_after(self):
+        policy = cloudmonitoring_util.RetryPolicy(max_delay=30)
+        policy.call(self._fail_then_succeed([
+            _http_error(429, {'retry-after': '7'}),
+            _http_error(429, {'retry-after': '120'})]))
+        self.assertEqual([7, 30], self.sleeps)
+
+    def test_retry_budget(self):
+        policy = cloudmonitoring_util.RetryPolicy(max_budget=2,
+                                                  budget_per_success=0.5)
+        policy.call(self._fail_then_succeed([socket.error()] * 2))
+        # We've used up the budget, less what the success put back.
+        with self.assertRaises(socket.error):
+            policy.call(self._fail_then_succeed([socket.error()] * 2))
+        self.assertEqual(1, policy.stats()['budget_exhausted'])
+        # Enough successes fill it up again.
+        for _ in range(4):
+            policy.call(lambda: 'ok')
+        self.assertEqual(
+            'ok', policy.call(self._fail_then_succeed([socket.error()])))
+
+
+class TestTimeseriesBatcher(unittest.TestCase):
+    def setUp(self):
+        self.requests = []
+        self.failures = {}     # map from metric name to times to fail
+        lock = threading.Lock()
+
+        def new_write_timeseries(batcher, timeseries):
+            first_metric = timeseries[0]['metric']['type']
+            with lock:
+                if self.failures.get(first_metric):
+                    self.failures[first_metric] -= 1
+                    raise RuntimeError('failed to write %s' % first_metric)
+                self.requests.append(timeseries)
+
+        orig = cloudmonitoring_util.TimeseriesBatcher._write_timeseries
+        self.addCleanup(setattr, cloudmonitoring_util.TimeseriesBatcher,
+                        '_write_timeseries', orig)
+        cloudmonitoring_util.TimeseriesBatcher._write_timeseries = (
+            new_write_timeseries)
+
+    def test_timeseries(self):
+        batcher = cloudmonitoring_util.TimeseriesBatcher('proj')
+        batcher.add('my.metric', {'module': 'default', 'n': 3}, 2, 1467830173)
+        self.assertEqual(
+            [{'metric': {'type': 'custom.googleapis.com/my.metric',
+                         'labels': {'module': 'default', 'n': '3'}},
+              'resource': {'type': 'global',
+                           'labels': {'project_id': 'proj'}},
+              'points': [{'interval': {'endTime': '2016-07-06T18:36:13Z'},
+                          'value': {'doubleValue': 2.0}}]}],
+            batcher.timeseries())
+
+    def test_dedupes_points_for_the_same_timeseries(self):
+        batcher = cloudmonitoring_util.TimeseriesBatcher('proj')
+        batcher.add('my.metric', {'a': 1, 'b': 2}, 1, 100)
+        batcher.add('my.metric', {'b': 2, 'a': 1}, 2, 200)
+        batcher.add('my.metric', {'a': 1, 'b': 2}, 3, 150)
+        batcher.add('my.metric', {'a': 2, 'b': 2}, 4, 100)
+        self.assertEqual([2.0, 4.0],
+                         [ts['points'][0]['value']['doubleValue']
+                          for ts in batcher.timeseries()])
+
+    def test_sends_in_chunks(self):
+        batcher = cloudmonitoring_util.TimeseriesBatcher('proj')
+        for i in range(450):
+            batcher.add('my.metric', {'i': i}, i, 100)
+        self.assertEqual(450, batcher.send())
+        self.assertEqual([50, 200, 200],
+                         sorted(len(request) for request in self.requests))
+        self.assertEqual(0, len(batcher))
+        self.assertEqual(0, batcher.send())
+
+    def test_dry_run(self):
+        batcher = cloudmonitoring_util.TimeseriesBatcher('proj')
+        batcher.add('my.metric', {}, 1, 100)
+        self.assertEqual(1, batcher.send(dry_run=True))
+        self.assertEqual([], self.requests)
+
+    def test_failed_chunk_does_not_stop_the_others(self):
+        batcher = cloudmonitoring_util.TimeseriesBatcher('proj')
+        for i in range(400):
+            batcher.add('my.metric%03d' % i, {}, i, 100)
+        self.failures['custom.googleapis.com/my.metric000'] = 1
+        with self.assertRaises(RuntimeError):
+            batcher.send()
+        ((request,),) = [self.requests]
+        self.assertEqual('custom.googleapis.com/my.metric200',
+                         request[0]['metric']['type'])
+
+
+class TestDiscoveryCache(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(lambda: shutil.rmtree(self.tmpdir))
+        self.cache = cloudmonitoring_util._DiscoveryCache(
+            os.path.join(self.tmpdir, 'discovery'), 60)
+
+    def test_get_what_was_set(self):
+        url = 'https://www.googleapis.com/discovery/v1/apis/compute/v1/rest'
+        self.assertIsNone(self.cache.get(url))
+        self.cache.set(url, '{"name": "compute"}')
+        self.assertEqual('{"name": "compute"}', self.cache.get(url))
+        self.assertIsNone(self.cache.get(url + '?other'))
+
+    def test_old_documents_expire(self):
+        self.cache.set('url', b'{"name": "compute"}')
+        (filename,) = os.listdir(self.cache.directory)
+        old = time.time() - 61
+        os.utime(os.path.join(self.cache.directory, filename), (old, old))
+        self.assertIsNone(self.cache.get('url'))
+
+
+class TestSendTimeseries(unittest.TestCase):
+    def test_sends_data(self):
+        sent = []
+        orig = cloudmonitoring_util.TimeseriesBatcher._write_timeseries
+        self.addCleanup(setattr, cloudmonitoring_util.TimeseriesBatcher,
+                        '_write_timeseries', orig)
+        cloudmonitoring_util.TimeseriesBatcher._write_timeseries = (
+            lambda batcher, timeseries: sent.extend(timeseries))
+
+        self.assertEqual(
+            2, cloudmonitoring_util.send_timeseries_to_cloudmonitoring(
+                'proj', [('a', {'x': 1}, 1, 100), ('b', {'x': 1}, 2, 100)]))
+        self.assertEqual(['custom.googleapis.com/a',
+                          'custom.googleapis.com/b'],
+                         [ts['metric']['type'] for ts in sent])
+
+
+if __name__ == '__main__':
+    unittest.main()
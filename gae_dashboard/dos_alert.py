@@ -14,11 +14,22 @@ Note that we exclude URLs like these
 `/api/internal/user/profile?kaid=...&projection=%7B%22countBrandNewNotifications%22:1%7D`
 which are currently being requested 80 times a minute by some clients. I'm not
 sure whether this is due to a bug or by design, but I don't think it's a DoS.
+
+All three checks get their results from a single query, so each run only
+scans the logs once.  With --incremental, instead of scanning the last 10
+minutes of logs, we scan just the logs that have arrived since the last
+run, and keep running per-minute counts locally.  That makes each run
+cheap enough that it can run every minute.
 """
 
+import argparse
+import calendar
+import contextlib
 import re
 import datetime
 import itertools
+import os
+import sqlite3
 
 import alertlib
 import bq_util
@@ -36,6 +47,14 @@ SCRATCHPAD_PERIOD = 5 * 60
 DOS_PERIOD = 5 * 60
 CDN_ERROR_PERIOD = 5 * 60
 
+# This runs every 5 minutes, so we give up on a query (and cancel it)
+# if it's taking so long that the next run will be starting soon.
+QUERY_TIMEOUT = 4 * 60
+
+# We assume that all logs timestamped at any given moment will arrive at
+# the logs table within this many seconds.
+MAX_LOG_DELAY = 5 * 60
+
 TABLE_FORMAT = '%Y%m%d'
 TS_FORMAT = '%Y-%m-%d %H:%M:%S'
 
@@ -50,7 +69,8 @@ SELECT
   client_ip AS ip,
   url,
   request_user_agent AS user_agent,
-  COUNT(*) AS count
+  COUNT(*) AS count,
+  MAX({max_count}) AS max_count
 FROM (
   SELECT
     FIRST(client_ip) AS client_ip,
@@ -80,7 +100,8 @@ GROUP BY
   url,
   user_agent
 HAVING
-  count > {max_count}
+  -- This is NULL for safelisted urls we never alert on.
+  count > max_count
 ORDER BY
   count DESC
 """
@@ -101,11 +122,11 @@ Click "View active configuration", then go to "IP block list" under "Settings".
 See requests in bq in fastly.khanacademy_dot_org_logs_YYYYMMDD table
 """
 
-# Dictionary with override values for certain routes to support more traffic
-# without alerting. A value of "None" will set off an alert for any number of
-# requests for that route. Routes that do not match any regex here will
-# trigger an alert if they receive more than MAX_REQS_SEC.
-# Note that overrides won't work if set below the MAX_REQS_SEC threshold.
+# Dictionary with override values for certain routes to support more (or
+# less) traffic without alerting. A value of "None" means we never alert for
+# that route. Routes that do not match any regex here will trigger an alert
+# if they receive more than MAX_REQS_SEC.  These are applied in BigQuery,
+# so the regexes must be ones RE2 understands, too.
 DOS_SAFELIST_URL_REGEX = {
     # Mobile team will fix in 6.9.0
     # TODO: remove after 2020401
@@ -143,6 +164,78 @@ DOS_SAFELIST_URL_REGEX = {
     r'/_api/static_version.*': 100,
 }
 
+
+def _safelist_matcher(safelist):
+    """Returns a function that finds the safelist rule a url matches.
+
+    The function takes a url, and returns (regex, override) for the first
+    regex in `safelist`, in order, that re.match()es the url, or None if
+    none do.  We combine all the regexes into one, with a named group
+    for each, so matching a url is one pass over it rather than one per
+    regex; since alternatives are tried in order, the group that matches
+    is that of the first regex that does.
+    """
+    regexes = list(safelist)
+    combined_regex = re.compile('|'.join(
+        '(?P<rule%d>%s)' % (i, regex) for (i, regex) in enumerate(regexes)))
+
+    def match(url):
+        m = combined_regex.match(url)
+        if m is None:
+            return None
+        # The group for the whole rule is the last one to close.
+        regex = regexes[int(m.lastgroup[len('rule'):])]
+        return (regex, safelist[regex])
+
+    return match
+
+
+# Returns (regex, override) for the DOS_SAFELIST_URL_REGEX rule a url
+# matches, or None.
+match_dos_safelist = _safelist_matcher(DOS_SAFELIST_URL_REGEX)
+
+
+def dos_max_reqs_sec(url):
+    """How many requests/sec a client can make to url before we alert.
+
+    This is None for urls we never alert on.
+    """
+    safelist_match = match_dos_safelist(url)
+    if safelist_match is None:
+        return MAX_REQS_SEC
+    # Note that if more than one route regex matches, the value for the
+    # first match will be used. In other words, the order of
+    # DOS_SAFELIST_URL_REGEX might matter for overrides!
+    (_, override_max_reqs_sec) = safelist_match
+    return override_max_reqs_sec or None
+
+
+def _dos_max_count_sql(url_column, period):
+    """SQL for the most requests to a url that are ok over a period.
+
+    This does the same as dos_max_reqs_sec(url_column) * period, but in
+    (legacy) BigQuery SQL, so the queries can apply the right threshold
+    to each url themselves.  re.match() only matches at the start of the
+    url, while REGEXP_MATCH() matches anywhere, so we anchor each regex.
+    """
+    cases = []
+    for (regex, override_max_reqs_sec) in DOS_SAFELIST_URL_REGEX.items():
+        assert "'" not in regex, regex
+        cases.append("WHEN REGEXP_MATCH(%s, r'^(?:%s)') THEN %s" % (
+            url_column, regex,
+            override_max_reqs_sec * period if override_max_reqs_sec
+            else 'NULL'))
+    return 'CASE\n    %s\n    ELSE %s\n  END' % (
+        '\n    '.join(cases), MAX_REQS_SEC * period)
+
+
+def min_dos_max_reqs_sec():
+    """The lowest requests/sec any url can get without our alerting."""
+    return min([MAX_REQS_SEC] +
+               [override for override in DOS_SAFELIST_URL_REGEX.values()
+                if override])
+
+
 SCRATCHPAD_QUERY_TEMPLATE = """\
 SELECT
   client_ip AS ip,
@@ -234,6 +327,113 @@ Error rate: {percent:.2f}% ({err_count} / {traffic_count})
 """
 
 
+# This computes what QUERY_TEMPLATE, SCRATCHPAD_QUERY_TEMPLATE and
+# CDN_ERROR_QUERY_TEMPLATE do, all in one pass over the logs: a row of
+# `kind` 'dos' is a row of QUERY_TEMPLATE's results, 'scratchpad' one of
+# SCRATCHPAD_QUERY_TEMPLATE's, and 'cdn_error' one of
+# CDN_ERROR_QUERY_TEMPLATE's (with `count` being the traffic count).
+# FLATTEN() gives us a copy of each log line for each kind, which we
+# then group by kind.  Since a request can have several log lines, for
+# dos counts we first group each request's lines together, like
+# QUERY_TEMPLATE does; for the others we group by minute and ip.
+# The kinds in `per_minute_kinds` are counted per minute; the others
+# over the whole period.  `dos_max_count` is the SQL for the dos
+# threshold of a url; see _dos_max_count_sql().
+COUNTS_QUERY_TEMPLATE = """\
+SELECT
+  kind,
+  TIMESTAMP(minute) AS minute_bucket,
+  ip,
+  url,
+  user_agent,
+  SUM(IF(kind = 'dos', 1, num_lines)) AS count,
+  SUM(err_count) AS err_count,
+  -- For 'dos' rows, the count above which we care about the row.  This
+  -- is NULL for safelisted urls we never alert on.
+  MAX({dos_max_count}) AS max_count
+FROM (
+  SELECT
+    kind,
+    FIRST(IF(kind IN ({per_minute_kinds}), minute, STRING(NULL))) AS minute,
+    FIRST(ip) AS ip,
+    FIRST(url) AS url,
+    FIRST(user_agent) AS user_agent,
+    COUNT(*) AS num_lines,
+    SUM(hit) AS hit,
+    SUM(is_cdn_error) AS err_count
+  FROM (
+    SELECT
+      kind,
+      minute,
+      IF(kind = 'dos', request_id,
+         CONCAT(minute, ' ', IF(kind = 'scratchpad', client_ip, '')))
+        AS group_key,
+      IF(kind = 'cdn_error', STRING(NULL), client_ip) AS ip,
+      IF(kind = 'dos', url, STRING(NULL)) AS url,
+      IF(kind = 'dos', request_user_agent, STRING(NULL)) AS user_agent,
+      IF(cache_status = 'HIT', 1, 0) AS hit,
+      is_cdn_error
+    FROM FLATTEN((
+      SELECT
+        SPLIT('dos,scratchpad,cdn_error') AS kind,
+        LEFT(timestamp, 16) AS minute,
+        request_id,
+        client_ip,
+        url,
+        request_user_agent,
+        cache_status,
+        (NOT(url CONTAINS 'countBrandNewNotifications')
+         AND LEFT(url, 5) != '/_ah/'
+         AND NOT (status == 403 AND time_elapsed <= 500)
+         AND NOT (status == 308)) AS is_dos_candidate,
+        (request = 'POST'
+         AND url LIKE '/api/internal/scratchpads%'
+         AND at_edge_node
+         AND status = 200) AS is_new_scratchpad,
+        at_edge_node,
+        IF(status = 503 AND (request_id = '(null)' OR request_id IS NULL),
+           1, 0) AS is_cdn_error
+      FROM
+        {fastly_log_tables}
+      {timestamp_filter}
+    ), kind)
+    WHERE
+      (kind = 'dos' AND is_dos_candidate)
+      OR (kind = 'scratchpad' AND is_new_scratchpad)
+      OR (kind = 'cdn_error' AND at_edge_node))
+  GROUP BY
+    kind,
+    group_key)
+WHERE
+  -- We only care about requests that are not cached.
+  NOT (kind = 'dos' AND hit > 0)
+GROUP BY
+  kind,
+  minute_bucket,
+  ip,
+  url,
+  user_agent
+HAVING
+  {having}
+ORDER BY
+  kind,
+  minute_bucket,
+  count DESC
+"""
+
+COUNTS_QUERY_TIMESTAMP_FILTER = """\
+WHERE
+        TIMESTAMP(LEFT(timestamp, 19)) >= TIMESTAMP('{start_timestamp}')
+        AND TIMESTAMP(LEFT(timestamp, 19)) < TIMESTAMP('{end_timestamp}')"""
+
+COUNTS_QUERY_THRESHOLDS = """\
+(kind = 'dos' AND count > max_count)
+  OR (kind = 'scratchpad' AND count > {max_scratchpads})
+  OR (kind = 'cdn_error'
+      AND err_count / count > {max_cdn_percent}
+      AND err_count > {max_cdn_error})"""
+
+
 def _fastly_log_tables(start, end, period):
     """Returns logs table name(s) to query from given the period for the logs.
 
@@ -249,7 +449,7 @@ def _fastly_log_tables(start, end, period):
     on table names.
     """
 
-    _MAX_LOG_DELAY_MS = 5 * 60 * 1000
+    _MAX_LOG_DELAY_MS = MAX_LOG_DELAY * 1000
     _TABLE_STRING_TEMPLATE = """
         [{project}.{dataset}.{table_prefix}_{table_date}@-{latest_duration}-]
     """
@@ -270,19 +470,35 @@ def _fastly_log_tables(start, end, period):
     ])
 
 
-def dos_detect(end):
+def _dos_query(end):
     start = end - datetime.timedelta(seconds=DOS_PERIOD)
-
-    query = QUERY_TEMPLATE.format(
+    return QUERY_TEMPLATE.format(
         fastly_log_tables=_fastly_log_tables(start, end, DOS_PERIOD),
         start_timestamp=start.strftime(TS_FORMAT),
         end_timestamp=end.strftime(TS_FORMAT),
-        max_count=(MAX_REQS_SEC * DOS_PERIOD))
-    results = bq_util.query_bigquery(query, project=BQ_PROJECT)
+        max_count=_dos_max_count_sql('url', DOS_PERIOD))
+
+
+def dos_detect(end, results=None):
+    """Alert on clients hitting the same url too much in the period to `end`.
+
+    If `results` is None, we run the query ourselves; otherwise it should
+    be the results of running _dos_query(end).
+    """
+    if results is None:
+        results = bq_util.query_bigquery(_dos_query(end), project=BQ_PROJECT,
+                                         timeout=QUERY_TIMEOUT)
 
+    msg = dos_alert_message(results)
+    if msg:
+        alertlib.Alert(msg).send_to_slack(ALERT_CHANNEL_SECURITY)
+
+
+def dos_alert_message(results):
+    """The slack message dos_detect() sends for `results`, or None."""
     # Stop processing if we don't have any flagged IPs
     if not results:
-        return
+        return None
 
     # Group by IPs to reduce duplicate alerts during a DDoS attack
     ip_groups = itertools.groupby(results, key=lambda row: row['ip'])
@@ -292,41 +508,14 @@ def dos_detect(end):
     for ip, rows in ip_groups:
         alerted_ip = False
         for row in rows:
-            # We want to alert for this IP/URL combination by default. If the
-            # url matches one in the safelist, this value may be set to false.
-            # However, if it does not match anything in the safelist, we
-            # should set off an alert.
-            to_alert = True
-            # If a matching url is found, check for adjusted/overriden max
-            # requests for that particular route
-            # TODO(drosile): maybe refactor this to be cleaner?
-            alerting_url_regexes = [
-                    filter_regex for filter_regex
-                    in DOS_SAFELIST_URL_REGEX.keys()
-                    if re.match(filter_regex, row['url'])]
-            if alerting_url_regexes:
-                # Note that if more than one route regex matches, the value for
-                # the first match will be used. In other words, the order of
-                # DOS_SAFELIST_URL_REGEX might matter for overrides!
-                regex = alerting_url_regexes[0]
-                override_max_reqs_sec = DOS_SAFELIST_URL_REGEX[regex]
-                if not override_max_reqs_sec:
-                    # There's no override set, so we do the default behavior
-                    # when detecting a matched URL, which is to exclude it from
-                    # alerting entirely. Skip to the next row.
-                    continue
-                # The rule has an override. Calculate the new max and see if we
-                # exceeded it. Only alert when over the threshold, otherwise we
-                # ignore.
-                # Note that if the override is set below MAX_REQS_SEC, the
-                # alert will still trigger, *but* the script won't catch
-                # anything where num_requests is more than the override but
-                # less than MAX_REQS_SEC - this is because of how the querying
-                # is done in BigQuery. Code changes would be needed to support
-                # lower override thresholds.
-                calculated_max_reqs = override_max_reqs_sec * DOS_PERIOD
-                to_alert = row['count'] > calculated_max_reqs
-            if to_alert:
+            # The queries already apply the safelist, but we check again in
+            # case `results` came from somewhere that doesn't (such as the
+            # --incremental counts).
+            max_reqs_sec = dos_max_reqs_sec(row['url'])
+            if max_reqs_sec is None:
+                # The url is safelisted: we never alert on it.
+                continue
+            if row['count'] > max_reqs_sec * DOS_PERIOD:
                 # Once for each IP, we show some default links...
                 if not alerted_ip:
                     msg += DOS_ALERT_IP_INTRO_TEMPLATE.format(ip=ip)
@@ -337,39 +526,50 @@ def dos_detect(end):
                 any_alerts_seen = True
         msg += '\n'
     if not any_alerts_seen:
-        return
+        return None
     msg += DOS_ALERT_FOOTER
+    return msg
 
-    alertlib.Alert(msg).send_to_slack(ALERT_CHANNEL_SECURITY)
 
-
-def scratchpad_detect(end):
+def _scratchpad_query(end):
     start = end - datetime.timedelta(seconds=SCRATCHPAD_PERIOD)
-    scratchpad_query = SCRATCHPAD_QUERY_TEMPLATE.format(
+    return SCRATCHPAD_QUERY_TEMPLATE.format(
         fastly_log_tables=_fastly_log_tables(start, end,
                                              SCRATCHPAD_PERIOD),
         start_timestamp=start.strftime(TS_FORMAT),
         end_timestamp=end.strftime(TS_FORMAT),
         max_count=MAX_SCRATCHPADS)
 
-    scratchpad_results = bq_util.query_bigquery(scratchpad_query,
-                                                project=BQ_PROJECT)
 
-    if len(scratchpad_results) != 0:
-        msg = SCRATCHPAD_ALERT_INTRO_TEMPLATE.format(max_count=MAX_SCRATCHPADS)
-        msg += '\n'.join(SCRATCHPAD_ALERT_ENTRY_TEMPLATE.format(**row)
-                         for row in scratchpad_results)
+def scratchpad_detect(end, scratchpad_results=None):
+    """Alert on IPs creating lots of scratchpads in the period to `end`.
+
+    If `scratchpad_results` is None, we run the query ourselves; otherwise
+    it should be the results of running _scratchpad_query(end).
+    """
+    if scratchpad_results is None:
+        scratchpad_results = bq_util.query_bigquery(_scratchpad_query(end),
+                                                    project=BQ_PROJECT,
+                                                    timeout=QUERY_TIMEOUT)
+
+    msg = scratchpad_alert_message(scratchpad_results)
+    if msg:
         alertlib.Alert(msg).send_to_slack(ALERT_CHANNEL_SECURITY)
 
 
-def cdn_error_detect(end):
-    """Detected 503 CDN error
+def scratchpad_alert_message(scratchpad_results):
+    """The slack message scratchpad_detect() sends, or None."""
+    if len(scratchpad_results) == 0:
+        return None
+    msg = SCRATCHPAD_ALERT_INTRO_TEMPLATE.format(max_count=MAX_SCRATCHPADS)
+    msg += '\n'.join(SCRATCHPAD_ALERT_ENTRY_TEMPLATE.format(**row)
+                     for row in scratchpad_results)
+    return msg
 
-    We have seen spike of these error during deploy/rollback.  This alert is
-    a temporary measure to alert us when we see such error.
-    """
+
+def _cdn_error_query(end):
     start = end - datetime.timedelta(seconds=CDN_ERROR_PERIOD)
-    cdn_query = CDN_ERROR_QUERY_TEMPLATE.format(
+    return CDN_ERROR_QUERY_TEMPLATE.format(
         fastly_log_tables=_fastly_log_tables(start, end,
                                              CDN_ERROR_PERIOD),
         start_timestamp=start.strftime(TS_FORMAT),
@@ -378,30 +578,313 @@ def cdn_error_detect(end):
         max_count=MAX_CDN_ERROR
     )
 
-    cdn_results = bq_util.query_bigquery(cdn_query, project=BQ_PROJECT)
-    if len(cdn_results) != 0:
-        msg = CDN_ALERT_INTRO_TEMPLATE
-        msg += '\n'.join(
-
-            CDN_ALERT_ENTRY_TEMPLATE.format(**{
-                'minute_bucket': row['minute_bucket'],
-                'err_count': row['err_count'],
-                'traffic_count': row['traffic_count'],
-                'percent': (
-                    100. * float(row['err_count']) / int(row['traffic_count'])
-                )
-            })
-            for row in cdn_results
-        )
+
+def cdn_error_detect(end, cdn_results=None):
+    """Detected 503 CDN error
+
+    We have seen spike of these error during deploy/rollback.  This alert is
+    a temporary measure to alert us when we see such error.
+
+    If `cdn_results` is None, we run the query ourselves; otherwise it
+    should be the results of running _cdn_error_query(end).
+    """
+    if cdn_results is None:
+        cdn_results = bq_util.query_bigquery(_cdn_error_query(end),
+                                             project=BQ_PROJECT,
+                                             timeout=QUERY_TIMEOUT)
+    msg = cdn_error_alert_message(cdn_results)
+    if msg:
         alertlib.Alert(msg).send_to_slack(ALERT_CHANNEL_SRE)
 
 
+def cdn_error_alert_message(cdn_results):
+    """The slack message cdn_error_detect() sends, or None."""
+    if len(cdn_results) == 0:
+        return None
+    msg = CDN_ALERT_INTRO_TEMPLATE
+    msg += '\n'.join(
+
+        CDN_ALERT_ENTRY_TEMPLATE.format(**{
+            'minute_bucket': row['minute_bucket'],
+            'err_count': row['err_count'],
+            'traffic_count': row['traffic_count'],
+            'percent': (
+                100. * float(row['err_count']) / int(row['traffic_count'])
+            )
+        })
+        for row in cdn_results
+    )
+    return msg
+
+
+def _counts_query(end):
+    """The results of all three checks' queries, in one query.
+
+    This assumes DOS_PERIOD, SCRATCHPAD_PERIOD and CDN_ERROR_PERIOD are
+    all the same.  Use split_counts() to get each check's results.
+    """
+    start = end - datetime.timedelta(seconds=DOS_PERIOD)
+    return COUNTS_QUERY_TEMPLATE.format(
+        fastly_log_tables=_fastly_log_tables(start, end, DOS_PERIOD),
+        timestamp_filter=COUNTS_QUERY_TIMESTAMP_FILTER.format(
+            start_timestamp=start.strftime(TS_FORMAT),
+            end_timestamp=end.strftime(TS_FORMAT)),
+        per_minute_kinds="'cdn_error'",
+        dos_max_count=_dos_max_count_sql('url', DOS_PERIOD),
+        having=COUNTS_QUERY_THRESHOLDS.format(
+            max_scratchpads=MAX_SCRATCHPADS,
+            max_cdn_percent=MAX_CDN_PERCENT,
+            max_cdn_error=MAX_CDN_ERROR))
+
+
+def split_counts(results):
+    """Split the results of _counts_query() by check.
+
+    The return value is a triple: the results of _dos_query(end),
+    _scratchpad_query(end), and _cdn_error_query(end), as you'd pass them
+    to dos_detect(), scratchpad_detect() and cdn_error_detect().
+    """
+    dos_results = []
+    scratchpad_results = []
+    cdn_results = []
+    for row in results:
+        if row['kind'] == 'dos':
+            dos_results.append({'ip': row['ip'], 'url': row['url'],
+                                'user_agent': row['user_agent'],
+                                'count': row['count']})
+        elif row['kind'] == 'scratchpad':
+            scratchpad_results.append({'ip': row['ip'],
+                                       'count': row['count']})
+        elif row['kind'] == 'cdn_error':
+            cdn_results.append({'minute_bucket': row['minute_bucket'],
+                                'traffic_count': row['count'],
+                                'err_count': row['err_count']})
+    return (dos_results, scratchpad_results, cdn_results)
+
+
+# Where we keep the per-minute counts in --incremental mode.
+INCREMENTAL_STATE_FILE = os.path.join(os.getenv('HOME'), 'bq_data',
+                                      'dos_alert_state.sqlite')
+
+
+def _epoch_ms(dt):
+    """Milliseconds since the epoch, for a naive datetime in UTC."""
+    return calendar.timegm(dt.timetuple()) * 1000 + dt.microsecond // 1000
+
+
+def _fastly_log_slice_tables(since, until):
+    """Returns the logs table(s) holding the logs that arrived in a range.
+
+    This is like _fastly_log_tables(), but with absolute table
+    decorators: the tables hold the logs that arrived between `since`
+    and `until`, no matter what their timestamps are.  So if we always
+    start where the last slice ended, we read each log line exactly once.
+    """
+    # Logs that arrive right after midnight may still be for the day
+    # before.
+    table_dates = sorted({(since - datetime.timedelta(
+        seconds=MAX_LOG_DELAY)).date(), until.date()})
+    return ', '.join(
+        '[{project}.{dataset}.{table_prefix}_{table_date}@{since}-{until}]'
+        .format(project=BQ_PROJECT,
+                dataset=FASTLY_DATASET,
+                table_prefix=FASTLY_LOG_TABLE_PREFIX,
+                table_date=table_date.strftime(TABLE_FORMAT),
+                since=_epoch_ms(since),
+                until=_epoch_ms(until))
+        for table_date in table_dates)
+
+
+def _incremental_query(since, until):
+    """Per-minute counts, as for _counts_query(), of the logs in a slice.
+
+    We can't leave out the small counts here, the way _counts_query()
+    does: one minute's logs arrive over several slices -- they can be up
+    to MAX_LOG_DELAY late -- and a client's counts only get big enough
+    to matter once we add them up.  So we keep them all, except for
+    safelisted urls, which we never alert on.
+    """
+    return COUNTS_QUERY_TEMPLATE.format(
+        fastly_log_tables=_fastly_log_slice_tables(since, until),
+        timestamp_filter='',
+        per_minute_kinds="'dos', 'scratchpad', 'cdn_error'",
+        dos_max_count=_dos_max_count_sql('url', DOS_PERIOD),
+        having="kind != 'dos' OR max_count IS NOT NULL")
+
+
+@contextlib.contextmanager
+def _incremental_state_db():
+    """Yield a connection to the --incremental state, in a transaction.
+
+    We keep per-minute counts, as returned by _incremental_query(), and
+    the time up to which we've read the logs.  The transaction holds
+    sqlite's write lock from the start, so if runs overlap, only one of
+    them reads or updates the state at a time.
+    """
+    dirname = os.path.dirname(INCREMENTAL_STATE_FILE)
+    if not os.path.isdir(dirname):
+        os.makedirs(dirname)
+    db = sqlite3.connect(INCREMENTAL_STATE_FILE)
+    try:
+        with db:
+            db.execute('BEGIN IMMEDIATE')
+            db.execute('CREATE TABLE IF NOT EXISTS dos_counts ('
+                       '  minute_bucket TEXT, ip TEXT, url TEXT,'
+                       '  user_agent TEXT, count INTEGER,'
+                       '  PRIMARY KEY (minute_bucket, ip, url, user_agent)'
+                       ') WITHOUT ROWID')
+            db.execute('CREATE TABLE IF NOT EXISTS scratchpad_counts ('
+                       '  minute_bucket TEXT, ip TEXT, count INTEGER,'
+                       '  PRIMARY KEY (minute_bucket, ip)'
+                       ') WITHOUT ROWID')
+            db.execute('CREATE TABLE IF NOT EXISTS cdn_error_counts ('
+                       '  minute_bucket TEXT PRIMARY KEY,'
+                       '  traffic_count INTEGER, err_count INTEGER'
+                       ') WITHOUT ROWID')
+            db.execute('CREATE TABLE IF NOT EXISTS scanned_until ('
+                       '  id INTEGER PRIMARY KEY, until TEXT)')
+            yield db
+    finally:
+        db.close()
+
+
+def _add_incremental_counts(db, results):
+    """Add the results of _incremental_query() to our counts."""
+    for row in results:
+        if row['kind'] == 'dos':
+            db.execute('INSERT INTO dos_counts VALUES (?, ?, ?, ?, ?)'
+                       ' ON CONFLICT (minute_bucket, ip, url, user_agent)'
+                       ' DO UPDATE'
+                       ' SET count = count + excluded.count',
+                       (row['minute_bucket'], row['ip'], row['url'],
+                        row['user_agent'], row['count']))
+        elif row['kind'] == 'scratchpad':
+            db.execute('INSERT INTO scratchpad_counts VALUES (?, ?, ?)'
+                       ' ON CONFLICT (minute_bucket, ip) DO UPDATE'
+                       ' SET count = count + excluded.count',
+                       (row['minute_bucket'], row['ip'], row['count']))
+        elif row['kind'] == 'cdn_error':
+            db.execute('INSERT INTO cdn_error_counts VALUES (?, ?, ?)'
+                       ' ON CONFLICT (minute_bucket) DO UPDATE'
+                       ' SET traffic_count = traffic_count'
+                       '                     + excluded.traffic_count,'
+                       '     err_count = err_count + excluded.err_count',
+                       (row['minute_bucket'], row['count'],
+                        row['err_count']))
+
+
+def incremental_update(now, results=None):
+    """Add the logs that have arrived since the last run to our counts.
+
+    If `results` is None, we run the query ourselves; otherwise it should
+    be the results of running _incremental_query() from the end of the
+    last run to `now`.
+    """
+    # We store where we stopped to the second, so we stop there, too.
+    now = now.replace(microsecond=0)
+    # We never need counts from before this.
+    oldest = now - datetime.timedelta(
+        seconds=max(DOS_PERIOD, SCRATCHPAD_PERIOD, CDN_ERROR_PERIOD)
+        + MAX_LOG_DELAY)
+
+    with _incremental_state_db() as db:
+        row = db.execute('SELECT until FROM scanned_until').fetchone()
+    since = oldest
+    if row:
+        since = max(since, datetime.datetime.strptime(row[0], TS_FORMAT))
+
+    if results is None:
+        # We never read the same slice twice, so there's no use caching.
+        results = bq_util.query_bigquery(_incremental_query(since, now),
+                                         project=BQ_PROJECT, cache_ttl=0,
+                                         timeout=QUERY_TIMEOUT)
+
+    with _incremental_state_db() as db:
+        # If another run added its slice while we were querying, that
+        # slice overlaps ours, and adding ours would count those logs
+        # twice.  So we leave it to the next run, which will start where
+        # the other run stopped.
+        if db.execute('SELECT until FROM scanned_until').fetchone() != row:
+            return
+        _add_incremental_counts(db, results)
+        db.execute('INSERT OR REPLACE INTO scanned_until VALUES (0, ?)',
+                   (now.strftime(TS_FORMAT),))
+        oldest_minute = oldest.strftime(TS_FORMAT)
+        for table in ('dos_counts', 'scratchpad_counts', 'cdn_error_counts'):
+            db.execute('DELETE FROM %s WHERE minute_bucket < ?' % table,
+                       (oldest_minute,))
+
+
+def _window_start(end, period):
+    # Our counts are per minute, so we include all of the minute the
+    # period starts in.
+    return (end - datetime.timedelta(seconds=period)).strftime(
+        '%Y-%m-%d %H:%M:00')
+
+
+def incremental_results(end):
+    """Returns what the three checks' queries would have, from our counts.
+
+    The return value is a triple: the results of _dos_query(end),
+    _scratchpad_query(end), and _cdn_error_query(end), as computed from
+    the counts that incremental_update() keeps.
+    """
+    with _incremental_state_db() as db:
+        db.row_factory = sqlite3.Row
+        dos_results = db.execute(
+            'SELECT ip, url, user_agent, SUM(count) AS count'
+            ' FROM dos_counts WHERE minute_bucket >= ?'
+            ' GROUP BY ip, url, user_agent HAVING SUM(count) > ?'
+            ' ORDER BY SUM(count) DESC',
+            (_window_start(end, DOS_PERIOD),
+             min_dos_max_reqs_sec() * DOS_PERIOD)).fetchall()
+        scratchpad_results = db.execute(
+            'SELECT ip, SUM(count) AS count'
+            ' FROM scratchpad_counts WHERE minute_bucket >= ?'
+            ' GROUP BY ip HAVING SUM(count) > ?'
+            ' ORDER BY SUM(count) DESC',
+            (_window_start(end, SCRATCHPAD_PERIOD),
+             MAX_SCRATCHPADS)).fetchall()
+        cdn_results = db.execute(
+            'SELECT minute_bucket, traffic_count, err_count'
+            ' FROM cdn_error_counts WHERE minute_bucket >= ?'
+            '   AND err_count > ? AND err_count > ? * traffic_count'
+            ' ORDER BY minute_bucket',
+            (_window_start(end, CDN_ERROR_PERIOD),
+             MAX_CDN_ERROR, MAX_CDN_PERCENT)).fetchall()
+    # Each url has its own threshold, which we apply here, rather than
+    # in sqlite.
+    return ([dict(row) for row in dos_results
+             if dos_max_reqs_sec(row['url']) is not None
+             and row['count'] > dos_max_reqs_sec(row['url']) * DOS_PERIOD],
+            [dict(row) for row in scratchpad_results],
+            [dict(row) for row in cdn_results])
+
+
 def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--incremental', action='store_true',
+                        help=('Only scan the logs that arrived since the '
+                              'last --incremental run, keeping counts in %s'
+                              % INCREMENTAL_STATE_FILE))
+    args = parser.parse_args()
+
     now = datetime.datetime.utcnow()
 
-    dos_detect(now)
-    scratchpad_detect(now)
-    cdn_error_detect(now)
+    if args.incremental:
+        incremental_update(now)
+        (dos_results, scratchpad_results,
+         cdn_results) = incremental_results(now)
+    else:
+        # We get the results for all three checks from one query, so we
+        # only scan the logs once.
+        (dos_results, scratchpad_results, cdn_results) = split_counts(
+            bq_util.query_bigquery(_counts_query(now), project=BQ_PROJECT,
+                                   timeout=QUERY_TIMEOUT))
+
+    dos_detect(now, dos_results)
+    scratchpad_detect(now, scratchpad_results)
+    cdn_error_detect(now, cdn_results)
 
 
 if __name__ == '__main__':
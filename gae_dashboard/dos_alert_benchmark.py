@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+"""Time how long dos_alert takes to check flagged rows against its safelist.
+
+During a real DDoS, the dos query can return thousands of (ip, url, ua)
+rows, and dos_detect() checks each one against DOS_SAFELIST_URL_REGEX.
+This makes up a result set like that, and times checking it the way we
+used to -- re.match() with every regex, for every row -- against
+dos_alert.match_dos_safelist().  It also makes sure the two agree.
+
+Run it like:
+   python3 dos_alert_benchmark.py --rows 10000
+"""
+
+import argparse
+import random
+import re
+import timeit
+
+import dos_alert
+
+
+# Urls that match some safelist rule, one for each rule.
+_SAFELISTED_URLS = [
+    '/api/auth2/request_token',
+    '/mission/sat/tasks/123',
+    '/math/algebra/x2f8bb11595b61c86:foundation-algebra',
+    '/computing/computer-programming',
+    '/profile/Bloomsburgstudent/projects',
+    '/graphql/debugDatastoreMapMutation',
+    '/graphql/deleteTestUser',
+    '/graphql/runUserBackfillTask',
+    '/graphql/phantomDeletionCheck',
+    '/graphql/queueTaskForUser',
+    '/graphql/syncUserData',
+    '/graphql/LearningEquality_getContent',
+    '/api/internal/graphql/getFullUserProfile',
+    '/api/internal/graphql/LoginWithPasswordMutation?lang=en',
+    '/api/internal/_analytics/publish_event?x=1',
+    '/_fastly/healthcheck',
+    '/_api/static_version?v=1',
+]
+
+# Urls that an attacker might hit, that match no rule -- and so have
+# to be checked against every one.
+_UNSAFELISTED_URLS = [
+    '/',
+    '/login',
+    '/api/internal/graphql/getUserInfoForTopNav',
+    '/api/internal/user/profile?kaid=kaid_1234',
+    '/science/physics',
+    '/profile/kaid_5678/courses',
+    '/graphql/getAssignments',
+]
+
+
+def _synthetic_results(num_rows, seed=0):
+    """Make up dos-query result rows, most of them for unsafelisted urls."""
+    rand = random.Random(seed)
+    rows = []
+    for i in range(num_rows):
+        if rand.random() < 0.25:
+            url = rand.choice(_SAFELISTED_URLS)
+        else:
+            url = rand.choice(_UNSAFELISTED_URLS)
+        rows.append({'ip': '10.0.%d.%d' % (i // 256 % 256, i % 256),
+                     'url': '%s%s' % (url, '' if i % 3 else '?r=%d' % i),
+                     'user_agent': 'bot-%d' % (i % 17),
+                     'count': 5000})
+    return rows
+
+
+def _match_every_regex(url):
+    """How dos_detect() used to find the safelist rule a url matches."""
+    matching_regexes = [
+        filter_regex for filter_regex in dos_alert.DOS_SAFELIST_URL_REGEX
+        if re.match(filter_regex, url)]
+    if not matching_regexes:
+        return None
+    regex = matching_regexes[0]
+    return (regex, dos_alert.DOS_SAFELIST_URL_REGEX[regex])
+
+
+def main(num_rows, repeat):
+    rows = _synthetic_results(num_rows)
+    urls = [row['url'] for row in rows]
+
+    expected = [_match_every_regex(url) for url in urls]
+    actual = [dos_alert.match_dos_safelist(url) for url in urls]
+    assert actual == expected, 'match_dos_safelist() disagrees with re.match'
+
+    for (name, match) in (
+            ('re.match with every regex', _match_every_regex),
+            ('match_dos_safelist', dos_alert.match_dos_safelist)):
+        best = min(timeit.repeat(lambda: [match(url) for url in urls],
+                                 number=1, repeat=repeat))
+        print('%-28s %8.2f ms for %d rows (%.2f us/row)'
+              % (name, best * 1000, num_rows, best * 1e6 / num_rows))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rows', type=int, default=10000,
+                        help='How many flagged rows to check (default 10000)')
+    parser.add_argument('--repeat', type=int, default=5,
+                        help='Report the best of this many runs (default 5)')
+    args = parser.parse_args()
+    main(args.rows, args.repeat)
@@ -0,0 +1,386 @@
+#!/usr/bin/env python3
+"""Replay recorded fastly logs through the dos_alert and waf_alert checks.
+
+The checks in dos_alert.py (and waf_alert.py) normally run against the
+last few minutes of logs in BigQuery.  This runs the same checks against
+fastly log rows saved to local files -- say, from an attack we want to
+be able to catch -- for every period of the logs, and tells you which
+alerts would have fired.  That way you can tune MAX_REQS_SEC,
+MAX_CDN_PERCENT and friends, or DOS_SAFELIST_URL_REGEX (edit it in
+dos_alert.py and replay again), without spending anything on BigQuery.
+
+The log files can be newline-delimited json (what `bq extract` and
+`bq head --format=json` give you, one row per line), or csv with a
+header line; either can be gzipped.  The rows need (at least) the
+columns the checks' queries use: timestamp, request_id, client_ip, url,
+request_user_agent, cache_status, status, time_elapsed, request and
+at_edge_node.  WAF logs need timestamp, blocked, client_ip,
+request_user_agent, and waf.message (or waf_message, in csv).
+
+We read the logs in one pass, counting each DOS_PERIOD of them like the
+queries do, and check each period once we've seen logs from
+MAX_LOG_DELAY past its end.  (The rows don't need to be in order, but
+ones more than MAX_LOG_DELAY out of order are dropped, and counted as
+"late".)  So memory use only depends on how much traffic there is in a
+period, not on how big the files are.
+
+Run it like:
+   python3 dos_alert_replay.py khanacademy_dot_org_logs_20200102.json.gz
+   python3 dos_alert_replay.py --max-reqs-sec 5 --quiet logs.csv
+   python3 dos_alert_replay.py --waf-logs waf_logs.json logs.json
+"""
+
+import argparse
+import collections
+import csv
+import datetime
+import gzip
+import io
+import json
+import sys
+import time
+
+import dos_alert
+import waf_alert
+
+
+# The ways a boolean (like at_edge_node) shows up in json and csv.
+_TRUE_VALUES = frozenset((True, 1, 'true', 'True', 'TRUE', '1'))
+
+
+def _open(filename):
+    if filename == '-':
+        return io.TextIOWrapper(sys.stdin.buffer, encoding='utf-8')
+    if filename.endswith('.gz'):
+        return gzip.open(filename, 'rt', encoding='utf-8')
+    return open(filename, encoding='utf-8')
+
+
+def read_log_rows(filename):
+    """Yield the rows of a log file, as dicts, in the order they're in.
+
+    Files with '.csv' in their name are read as csv; others as
+    newline-delimited json.
+    """
+    with _open(filename) as f:
+        if '.csv' in filename:
+            for row in csv.DictReader(f):
+                yield row
+        else:
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+
+
+def _to_int(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def _minute_bucket(minute):
+    """'2020-01-02T03:04' -> '2020-01-02 03:04:00', like BigQuery says."""
+    return '%s %s:00' % (minute[:10], minute[11:16])
+
+
+class _WindowCounts(object):
+    """What the dos_alert queries count, for one period of logs."""
+    __slots__ = ('requests', 'scratchpads', 'traffic', 'errors')
+
+    def __init__(self):
+        # request-id -> [ip, url, user-agent, was-any-line-a-cache-hit].
+        self.requests = {}
+        # ip -> how many new scratchpads it created.
+        self.scratchpads = collections.Counter()
+        # minute -> how many (edge) requests we got, and how many errors.
+        self.traffic = collections.Counter()
+        self.errors = collections.Counter()
+
+
+class DosReplayer(object):
+    """Runs the dos_alert checks on every DOS_PERIOD of a stream of logs.
+
+    Call add() with each log row, and then finish(); `alerts` is then a
+    list of (period-start, period-end, check-name, slack-message) for
+    every alert that would have fired, in order.
+    """
+    def __init__(self):
+        self.period = datetime.timedelta(seconds=dos_alert.DOS_PERIOD)
+        self.max_delay = datetime.timedelta(seconds=dos_alert.MAX_LOG_DELAY)
+        self.alerts = []
+        self.num_windows = 0
+        self.num_late_rows = 0
+
+        # Period-start -> _WindowCounts, for periods we haven't checked.
+        self._windows = {}
+        # Minute (as in the log timestamps) -> the start of its period.
+        self._minute_to_window_start = {}
+        # The latest minute we've seen a log for.
+        self._latest = None
+        # Periods that start before this have been checked.
+        self._checked_until = None
+        # Url -> dos_alert.dos_max_reqs_sec(url), since urls repeat a lot.
+        self._max_reqs_sec = {}
+
+    def _window_start(self, minute):
+        """The start of the period that a minute of logs is in.
+
+        We only do date math once per minute of logs, which is also
+        when we check any periods we've seen all the logs for.
+        """
+        dt = datetime.datetime.strptime(minute[:10] + minute[11:16],
+                                        '%Y-%m-%d%H:%M')
+        epoch = datetime.datetime(1970, 1, 1)
+        start = dt - (dt - epoch) % self.period
+        self._minute_to_window_start[minute] = start
+        if self._latest is None or dt > self._latest:
+            self._latest = dt
+            self._check_windows(dt - self.max_delay)
+        return start
+
+    def add(self, row):
+        minute = row['timestamp'][:16]
+        window_start = self._minute_to_window_start.get(minute)
+        if window_start is None:
+            window_start = self._window_start(minute)
+        if (self._checked_until is not None
+                and window_start < self._checked_until):
+            self.num_late_rows += 1
+            return
+        window = self._windows.get(window_start)
+        if window is None:
+            window = self._windows[window_start] = _WindowCounts()
+
+        url = row.get('url') or ''
+        status = _to_int(row.get('status'))
+
+        # What cdn_error_detect() and scratchpad_detect() count.
+        if row.get('at_edge_node') in _TRUE_VALUES:
+            window.traffic[minute] += 1
+            if status == 503 and row.get('request_id') in (None, '(null)'):
+                window.errors[minute] += 1
+            if (status == 200 and row.get('request') == 'POST'
+                    and url.startswith('/api/internal/scratchpads')):
+                window.scratchpads[row.get('client_ip')] += 1
+
+        # What dos_detect() counts; see dos_alert.QUERY_TEMPLATE.
+        if (status != 308
+                and url[:5] != '/_ah/'
+                and 'countBrandNewNotifications' not in url
+                and not (status == 403
+                         and (_to_int(row.get('time_elapsed')) or 0) <= 500)):
+            hit = row.get('cache_status') == 'HIT'
+            request = window.requests.get(row.get('request_id'))
+            if request is None:
+                window.requests[row.get('request_id')] = [
+                    row.get('client_ip'), url,
+                    row.get('request_user_agent'), hit]
+            elif hit:
+                request[3] = True
+
+    def _check_windows(self, until):
+        """Run the checks on all the periods that end by `until`."""
+        for window_start in sorted(self._windows):
+            if window_start + self.period > until:
+                break
+            self._check_window(window_start, self._windows.pop(window_start))
+            self._checked_until = window_start + self.period
+        # We're done with these minutes, so don't keep them around.
+        if self._checked_until is not None:
+            for (minute, window_start) in list(
+                    self._minute_to_window_start.items()):
+                if window_start < self._checked_until:
+                    del self._minute_to_window_start[minute]
+
+    def _dos_max_count(self, url):
+        if url not in self._max_reqs_sec:
+            self._max_reqs_sec[url] = dos_alert.dos_max_reqs_sec(url)
+        max_reqs_sec = self._max_reqs_sec[url]
+        return None if max_reqs_sec is None else max_reqs_sec * (
+            dos_alert.DOS_PERIOD)
+
+    def _check_window(self, window_start, window):
+        self.num_windows += 1
+        window_end = window_start + self.period
+
+        counts = collections.Counter(
+            (ip, url, user_agent)
+            for (ip, url, user_agent, hit) in window.requests.values()
+            if not hit)
+        dos_results = []
+        for ((ip, url, user_agent), count) in counts.most_common():
+            max_count = self._dos_max_count(url)
+            if max_count is not None and count > max_count:
+                dos_results.append({'ip': ip, 'url': url,
+                                    'user_agent': user_agent,
+                                    'count': count})
+
+        scratchpad_results = [
+            {'ip': ip, 'count': count}
+            for (ip, count) in window.scratchpads.most_common()
+            if count > dos_alert.MAX_SCRATCHPADS]
+
+        cdn_results = [
+            {'minute_bucket': _minute_bucket(minute),
+             'traffic_count': traffic_count,
+             'err_count': window.errors[minute]}
+            for (minute, traffic_count) in sorted(window.traffic.items())
+            if (window.errors[minute] > dos_alert.MAX_CDN_ERROR
+                and (window.errors[minute] >
+                     dos_alert.MAX_CDN_PERCENT * traffic_count))]
+
+        for (name, msg) in (
+                ('dos_detect', dos_alert.dos_alert_message(dos_results)),
+                ('scratchpad_detect',
+                 dos_alert.scratchpad_alert_message(scratchpad_results)),
+                ('cdn_error_detect',
+                 dos_alert.cdn_error_alert_message(cdn_results))):
+            if msg:
+                self.alerts.append((window_start, window_end, name, msg))
+
+    def finish(self):
+        """Check the periods we haven't yet, now that the logs are done."""
+        self._check_windows(datetime.datetime.max - self.period)
+        self.alerts.sort(key=lambda alert: alert[:3])
+
+
+class WafReplayer(object):
+    """Runs waf_alert's check on every WAF_PERIOD of the (waf) logs.
+
+    Call add_request() with each fastly log row, add_waf_log() with each
+    waf log row, and then finish(); `alerts` is then like DosReplayer's.
+    """
+    def __init__(self):
+        self.period = datetime.timedelta(seconds=waf_alert.WAF_PERIOD)
+        self.alerts = []
+        self.num_windows = 0
+        # Period-start -> how many requests we got.
+        self._totals = collections.Counter()
+        # Period-start -> (how many we blocked, and by ip, ua and reason).
+        self._blocked = collections.defaultdict(
+            lambda: (collections.Counter(), collections.Counter(),
+                     collections.Counter(), collections.Counter()))
+        self._hour_to_window_start = {}
+
+    def _window_start(self, timestamp):
+        hour = timestamp[:13]
+        window_start = self._hour_to_window_start.get(hour)
+        if window_start is None:
+            dt = datetime.datetime.strptime(hour[:10] + hour[11:13],
+                                            '%Y-%m-%d%H')
+            epoch = datetime.datetime(1970, 1, 1)
+            window_start = dt - (dt - epoch) % self.period
+            self._hour_to_window_start[hour] = window_start
+        return window_start
+
+    def add_request(self, row):
+        self._totals[self._window_start(row['timestamp'])] += 1
+
+    def add_waf_log(self, row):
+        if row.get('blocked') not in _TRUE_VALUES:
+            return
+        message = (row.get('waf') or {}).get('message', row.get('waf_message'))
+        (blocked, ips, user_agents, messages) = self._blocked[
+            self._window_start(row['timestamp'])]
+        blocked['total'] += 1
+        ips[row.get('client_ip')] += 1
+        user_agents[row.get('request_user_agent')] += 1
+        messages[message] += 1
+
+    def finish(self):
+        for window_start in sorted(self._blocked):
+            self.num_windows += 1
+            total = self._totals[window_start]
+            (blocked, ips, user_agents, messages) = self._blocked[window_start]
+            if not total:
+                continue
+            num_blocked = blocked['total']
+            # This is what waf_alert.BLOCKED_REQ gets, but exact.
+            blocked_info = {'blocked': num_blocked}
+            for (name, counter) in (('ip', ips),
+                                    ('request_user_agent', user_agents),
+                                    ('message', messages)):
+                ((value, count),) = counter.most_common(1)
+                blocked_info[name] = value
+                blocked_info[name + '_percentage'] = (
+                    100. * count / num_blocked)
+            window_end = window_start + self.period
+            msg = waf_alert.waf_alert_message(window_start, window_end,
+                                              blocked_info, total)
+            if msg:
+                self.alerts.append((window_start, window_end, 'waf_detect',
+                                    msg))
+
+
+def main(log_files, waf_log_files=(), quiet=False):
+    start_time = time.time()
+    dos_replayer = DosReplayer()
+    waf_replayer = WafReplayer() if waf_log_files else None
+    num_rows = 0
+    for filename in log_files:
+        for row in read_log_rows(filename):
+            dos_replayer.add(row)
+            if waf_replayer:
+                waf_replayer.add_request(row)
+            num_rows += 1
+    dos_replayer.finish()
+    alerts = dos_replayer.alerts
+    if waf_replayer:
+        for filename in waf_log_files:
+            for row in read_log_rows(filename):
+                waf_replayer.add_waf_log(row)
+        waf_replayer.finish()
+        alerts = sorted(alerts + waf_replayer.alerts,
+                        key=lambda alert: alert[:3])
+    elapsed = time.time() - start_time
+
+    for (window_start, window_end, name, msg) in alerts:
+        print('== %s - %s: %s would alert =='
+              % (window_start.strftime(dos_alert.TS_FORMAT),
+                 window_end.strftime(dos_alert.TS_FORMAT), name))
+        if not quiet:
+            print(msg)
+
+    print('Replayed %d rows over %d periods in %.1fs (%d rows/sec): '
+          '%d alerts, %d rows dropped as late'
+          % (num_rows, dos_replayer.num_windows, elapsed,
+             num_rows / elapsed if elapsed else 0, len(alerts),
+             dos_replayer.num_late_rows),
+          file=sys.stderr)
+    return alerts
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('log_files', nargs='+', metavar='LOG_FILE',
+                        help='Fastly logs to replay ("-" for stdin)')
+    parser.add_argument('--waf-logs', nargs='+', default=(),
+                        metavar='WAF_LOG_FILE',
+                        help='Fastly WAF logs, to also replay waf_alert')
+    parser.add_argument('--max-reqs-sec', type=float,
+                        default=dos_alert.MAX_REQS_SEC,
+                        help='Override dos_alert.MAX_REQS_SEC')
+    parser.add_argument('--max-scratchpads', type=int,
+                        default=dos_alert.MAX_SCRATCHPADS,
+                        help='Override dos_alert.MAX_SCRATCHPADS')
+    parser.add_argument('--max-cdn-error', type=int,
+                        default=dos_alert.MAX_CDN_ERROR,
+                        help='Override dos_alert.MAX_CDN_ERROR')
+    parser.add_argument('--max-cdn-percent', type=float,
+                        default=dos_alert.MAX_CDN_PERCENT,
+                        help='Override dos_alert.MAX_CDN_PERCENT')
+    parser.add_argument('--waf-spike-percentage', type=float,
+                        default=waf_alert.SPIKE_PERCENTAGE,
+                        help='Override waf_alert.SPIKE_PERCENTAGE')
+    parser.add_argument('--quiet', '-q', action='store_true',
+                        help="Only say which alerts fire, not what they say")
+    args = parser.parse_args()
+
+    dos_alert.MAX_REQS_SEC = args.max_reqs_sec
+    dos_alert.MAX_SCRATCHPADS = args.max_scratchpads
+    dos_alert.MAX_CDN_ERROR = args.max_cdn_error
+    dos_alert.MAX_CDN_PERCENT = args.max_cdn_percent
+    waf_alert.SPIKE_PERCENTAGE = args.waf_spike_percentage
+    main(args.log_files, args.waf_logs, quiet=args.quiet)
@@ -0,0 +1,98 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+import dos_alert_replay
+
+
+def _log_row(timestamp, request_id, **kwargs):
+    row = {'timestamp': timestamp + '+0000', 'request_id': request_id,
+           'client_ip': '1.2.3.4', 'url': '/a', 'request_user_agent': 'ua',
+           'cache_status': 'MISS', 'status': 200, 'time_elapsed': 1000,
+           'request': 'GET', 'at_edge_node': True}
+    row.update(kwargs)
+    return row
+
+
+class TestDosReplayer(unittest.TestCase):
+    def _replay(self, rows):
+        replayer = dos_alert_replay.DosReplayer()
+        for row in rows:
+            replayer.add(row)
+        replayer.finish()
+        return replayer
+
+    def test_dos_alert(self):
+        # 3001 requests in 12:00-12:05, and 3000 in 12:05-12:10.
+        rows = [_log_row('2020-01-02T12:0%d:00' % (i % 5), 'a%d' % i)
+                for i in range(3001)]
+        rows += [_log_row('2020-01-02T12:0%d:00' % (5 + i % 5), 'b%d' % i)
+                 for i in range(3000)]
+        replayer = self._replay(rows)
+        self.assertEqual(2, replayer.num_windows)
+        ((start, end, name, msg),) = replayer.alerts
+        self.assertEqual(('2020-01-02 12:00:00', '2020-01-02 12:05:00',
+                          'dos_detect'),
+                         (str(start), str(end), name))
+        self.assertIn('3001 requests to _/a_', msg)
+
+    def test_request_lines_are_counted_once(self):
+        # Each request has two lines, one of which is sometimes a hit.
+        rows = []
+        for i in range(4000):
+            rows.append(_log_row('2020-01-02T12:00:00', 'r%d' % i))
+            rows.append(_log_row('2020-01-02T12:00:01', 'r%d' % i,
+                                 cache_status='HIT' if i % 2 else 'MISS'))
+        self.assertEqual([], self._replay(rows).alerts)
+
+    def test_safelisted_urls(self):
+        rows = [_log_row('2020-01-02T12:00:00', 'r%d' % i, url='/math/x')
+                for i in range(5000)]
+        self.assertEqual([], self._replay(rows).alerts)
+
+    def test_cdn_errors(self):
+        rows = [_log_row('2020-01-02T12:00:00', None, status=503)
+                for i in range(1001)]
+        rows += [_log_row('2020-01-02T12:01:00', 'r%d' % i, status=503)
+                 for i in range(2000)]
+        ((_, _, name, msg),) = self._replay(rows).alerts
+        self.assertEqual('cdn_error_detect', name)
+        self.assertIn('Time: 2020-01-02 12:00:00', msg)
+        self.assertNotIn('12:01:00', msg)
+
+    def test_late_rows_are_dropped(self):
+        rows = [_log_row('2020-01-02T12:00:00', 'r1'),
+                _log_row('2020-01-02T12:20:00', 'r2'),
+                _log_row('2020-01-02T12:00:00', 'r3')]
+        replayer = self._replay(rows)
+        self.assertEqual(1, replayer.num_late_rows)
+
+
+class TestReadLogRows(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(lambda: shutil.rmtree(self.tmpdir))
+
+    def test_json_and_csv(self):
+        rows = [_log_row('2020-01-02T12:00:00', 'r1'),
+                _log_row('2020-01-02T12:00:01', 'r2', status=503)]
+        json_file = os.path.join(self.tmpdir, 'logs.json')
+        with open(json_file, 'w') as f:
+            f.write(''.join(json.dumps(row) + '\n' for row in rows))
+        csv_file = os.path.join(self.tmpdir, 'logs.csv')
+        with open(csv_file, 'w') as f:
+            f.write('timestamp,request_id,status,at_edge_node\n'
+                    '2020-01-02T12:00:00+0000,r1,200,true\n')
+
+        self.assertEqual(rows,
+                         list(dos_alert_replay.read_log_rows(json_file)))
+        self.assertEqual([{'timestamp': '2020-01-02T12:00:00+0000',
+                           'request_id': 'r1', 'status': '200',
+                           'at_edge_node': 'true'}],
+                         list(dos_alert_replay.read_log_rows(csv_file)))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,199 @@
+import datetime
+import os
+import shutil
+import tempfile
+import unittest
+
+import bq_util
+import dos_alert
+
+
+class TestSafelistMatcher(unittest.TestCase):
+    def test_first_matching_rule_wins(self):
+        match = dos_alert._safelist_matcher({
+            r'/a/b.*': 50,
+            r'/a/.*': None,
+            r'(/x)?/y': 20,
+        })
+        self.assertEqual((r'/a/b.*', 50), match('/a/bc'))
+        self.assertEqual((r'/a/.*', None), match('/a/c'))
+        self.assertEqual((r'(/x)?/y', 20), match('/x/y'))
+        self.assertEqual((r'(/x)?/y', 20), match('/y?z=1'))
+        self.assertIsNone(match('/b/a/bc'))
+
+    def test_dos_safelist(self):
+        self.assertEqual((r'/_fastly/.*', 100),
+                         dos_alert.match_dos_safelist('/_fastly/ping'))
+        self.assertEqual((r'/math/.*', None),
+                         dos_alert.match_dos_safelist('/math/algebra'))
+        self.assertIsNone(dos_alert.match_dos_safelist('/login'))
+
+
+class TestDosThresholds(unittest.TestCase):
+    def setUp(self):
+        old_safelist = dos_alert.DOS_SAFELIST_URL_REGEX
+        old_matcher = dos_alert.match_dos_safelist
+        dos_alert.DOS_SAFELIST_URL_REGEX = {r'/quiet/.*': None,
+                                            r'/slow/.*': 2,
+                                            r'/fast': 100}
+        dos_alert.match_dos_safelist = dos_alert._safelist_matcher(
+            dos_alert.DOS_SAFELIST_URL_REGEX)
+        self.addCleanup(lambda: setattr(dos_alert, 'DOS_SAFELIST_URL_REGEX',
+                                        old_safelist))
+        self.addCleanup(lambda: setattr(dos_alert, 'match_dos_safelist',
+                                        old_matcher))
+
+    def test_max_reqs_sec(self):
+        self.assertIsNone(dos_alert.dos_max_reqs_sec('/quiet/a'))
+        self.assertEqual(2, dos_alert.dos_max_reqs_sec('/slow/a'))
+        self.assertEqual(100, dos_alert.dos_max_reqs_sec('/fast?x=1'))
+        self.assertEqual(dos_alert.MAX_REQS_SEC,
+                         dos_alert.dos_max_reqs_sec('/a/slow/a'))
+        self.assertEqual(2, dos_alert.min_dos_max_reqs_sec())
+
+    def test_max_count_sql(self):
+        sql = dos_alert._dos_max_count_sql('url', 300)
+        self.assertIn("WHEN REGEXP_MATCH(url, r'^(?:/quiet/.*)') THEN NULL",
+                      sql)
+        self.assertIn("WHEN REGEXP_MATCH(url, r'^(?:/slow/.*)') THEN 600",
+                      sql)
+        self.assertIn('ELSE %d' % (dos_alert.MAX_REQS_SEC * 300), sql)
+        # The rules have to be tried in order.
+        self.assertLess(sql.index('/quiet/'), sql.index('/slow/'))
+
+
+class TestSplitCounts(unittest.TestCase):
+    def test_split_by_kind(self):
+        results = [
+            {'kind': 'cdn_error', 'minute_bucket': '2020-01-02 11:58:00',
+             'ip': None, 'url': None, 'user_agent': None,
+             'count': 10000, 'err_count': 2000},
+            {'kind': 'dos', 'minute_bucket': None, 'ip': '1.2.3.4',
+             'url': '/a', 'user_agent': 'ua', 'count': 5000, 'err_count': 0},
+            {'kind': 'scratchpad', 'minute_bucket': None, 'ip': '5.6.7.8',
+             'url': None, 'user_agent': None, 'count': 200, 'err_count': 0},
+        ]
+        self.assertEqual(
+            ([{'ip': '1.2.3.4', 'url': '/a', 'user_agent': 'ua',
+               'count': 5000}],
+             [{'ip': '5.6.7.8', 'count': 200}],
+             [{'minute_bucket': '2020-01-02 11:58:00',
+               'traffic_count': 10000, 'err_count': 2000}]),
+            dos_alert.split_counts(results))
+
+    def test_no_results(self):
+        self.assertEqual(([], [], []), dos_alert.split_counts([]))
+
+
+class TestIncremental(unittest.TestCase):
+    def setUp(self):
+        state_dir = tempfile.mkdtemp()
+        self.addCleanup(lambda: shutil.rmtree(state_dir))
+        old_state_file = dos_alert.INCREMENTAL_STATE_FILE
+        dos_alert.INCREMENTAL_STATE_FILE = os.path.join(state_dir,
+                                                        'state.sqlite')
+        self.addCleanup(lambda: setattr(dos_alert, 'INCREMENTAL_STATE_FILE',
+                                        old_state_file))
+        # Keep bq_util's query log out of the way, too.
+        old_data_dir = bq_util._DATA_DIRECTORY
+        bq_util._DATA_DIRECTORY = state_dir
+        self.addCleanup(lambda: setattr(bq_util, '_DATA_DIRECTORY',
+                                        old_data_dir))
+
+        self.backend = bq_util.FakeBackend({'FLATTEN': []})
+        old_backend = bq_util.set_backend(self.backend)
+        self.addCleanup(lambda: bq_util.set_backend(old_backend))
+
+        self.now = datetime.datetime(2020, 1, 2, 12, 0, 30)
+
+    def _dos_row(self, minute, count, ip='1.2.3.4'):
+        return {'kind': 'dos', 'minute_bucket': minute, 'ip': ip,
+                'url': '/a', 'user_agent': 'ua', 'count': count,
+                'err_count': 0}
+
+    def test_counts_add_up_across_runs(self):
+        # Neither run sees enough requests on its own.
+        dos_alert.incremental_update(self.now, [
+            self._dos_row('2020-01-02 11:57:00', 1500),
+            {'kind': 'scratchpad', 'minute_bucket': '2020-01-02 11:58:00',
+             'ip': '5.6.7.8', 'url': None, 'user_agent': None, 'count': 60,
+             'err_count': 0},
+        ])
+        self.assertEqual(([], [], []),
+                         dos_alert.incremental_results(self.now))
+
+        later = self.now + datetime.timedelta(minutes=1)
+        dos_alert.incremental_update(later, [
+            self._dos_row('2020-01-02 11:57:00', 1000),
+            self._dos_row('2020-01-02 11:59:00', 1000),
+            {'kind': 'scratchpad', 'minute_bucket': '2020-01-02 11:59:00',
+             'ip': '5.6.7.8', 'url': None, 'user_agent': None, 'count': 60,
+             'err_count': 0},
+        ])
+        (dos_results, scratchpad_results,
+         cdn_results) = dos_alert.incremental_results(later)
+        self.assertEqual([{'ip': '1.2.3.4', 'url': '/a', 'user_agent': 'ua',
+                           'count': 3500}],
+                         dos_results)
+        self.assertEqual([{'ip': '5.6.7.8', 'count': 120}],
+                         scratchpad_results)
+        self.assertEqual([], cdn_results)
+
+    def test_cdn_errors(self):
+        dos_alert.incremental_update(self.now, [
+            {'kind': 'cdn_error', 'minute_bucket': '2020-01-02 11:58:00',
+             'ip': None, 'url': None, 'user_agent': None,
+             'count': 10000, 'err_count': 2000},
+            {'kind': 'cdn_error', 'minute_bucket': '2020-01-02 11:59:00',
+             'ip': None, 'url': None, 'user_agent': None,
+             'count': 10000, 'err_count': 10},
+        ])
+        (_, _, cdn_results) = dos_alert.incremental_results(self.now)
+        self.assertEqual([{'minute_bucket': '2020-01-02 11:58:00',
+                           'traffic_count': 10000, 'err_count': 2000}],
+                         cdn_results)
+
+    def test_old_counts_are_dropped(self):
+        dos_alert.incremental_update(self.now, [
+            self._dos_row('2020-01-02 11:57:00', 5000)])
+        much_later = self.now + datetime.timedelta(hours=1)
+        dos_alert.incremental_update(much_later, [])
+        self.assertEqual(([], [], []),
+                         dos_alert.incremental_results(much_later))
+
+    def test_scans_from_the_end_of_the_last_run(self):
+        dos_alert.incremental_update(self.now)
+        dos_alert.incremental_update(self.now + datetime.timedelta(minutes=1))
+        (first_query, second_query) = self.backend.queries
+        # The first run starts as far back as any check looks.
+        self.assertIn('@1577965830000-1577966430000]', first_query)
+        self.assertIn('@1577966430000-1577966490000]', second_query)
+
+    def test_overlapping_runs_do_not_double_count(self):
+        later = self.now + datetime.timedelta(minutes=1)
+        row = self._dos_row('2020-01-02 11:59:00', 2000)
+
+        # While this run is querying, another run starts, and finishes
+        # first, having read the same logs.
+        def query_bigquery(*args, **kwargs):
+            dos_alert.incremental_update(later, [row])
+            return [row]
+
+        orig_query_bigquery = bq_util.query_bigquery
+        bq_util.query_bigquery = query_bigquery
+        self.addCleanup(lambda: setattr(bq_util, 'query_bigquery',
+                                        orig_query_bigquery))
+        dos_alert.incremental_update(self.now)
+
+        with dos_alert._incremental_state_db() as db:
+            self.assertEqual([(2000,)],
+                             db.execute('SELECT count FROM dos_counts')
+                             .fetchall())
+            # The next run starts where the other run stopped.
+            self.assertEqual([(later.strftime(dos_alert.TS_FORMAT),)],
+                             db.execute('SELECT until FROM scanned_until')
+                             .fetchall())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -80,14 +80,13 @@ def _convert_table_rows_to_lists(table, order):
     through the table and convert each dict to a list.  Finally, we
     add a row to the top of the table that has the key-names
     (csv-style).
+
+    'table' can be any iterable of rows, such as what
+    bq_util.iter_query_rows() returns; we only go through it once.
     """
-    retval = []
+    retval = [list(order)]
     for row in table:
-        row_contents = list(row.items())
-        row_contents.sort(key=lambda k_v: order.index(k_v[0]))
-        retval.append([v for (k, v) in row_contents])
-
-    retval.insert(0, list(order))
+        retval.append([row[k] for k in order])
     return retval
 
 
@@ -429,9 +428,7 @@ _MODULE_CPU_COUNT = {
 }
 
 
-def email_instance_hours(date, dry_run=False):
-    """Email instance hours report for the given datetime.date object."""
-    yyyymmdd = date.strftime("%Y%m%d")
+def _instance_hours_query(yyyymmdd):
     cost_fn = '\n'.join("WHEN module_id == '%s' THEN latency * %s" % kv
                         for kv in _MODULE_CPU_COUNT.items())
     query = """\
@@ -455,10 +452,23 @@ WHERE url_map_entry != "" # omit static files
 GROUP BY url_route
 ORDER BY instance_hours DESC
 """ % (cost_fn, yyyymmdd)
-    data = bq_util.query_bigquery(query)
+    return query
+
+
+def email_instance_hours(date, dry_run=False, data=None):
+    """Email instance hours report for the given datetime.date object.
+
+    If `data` is None, we run the query ourselves; otherwise it should
+    be the results of running _instance_hours_query().
+    """
+    yyyymmdd = date.strftime("%Y%m%d")
+    if data is None:
+        data = bq_util.query_bigquery(_instance_hours_query(yyyymmdd))
     bq_util.save_daily_data(data, "instance_hours", yyyymmdd)
     historical_data = bq_util.process_past_data(
-        "instance_hours", date, 14, lambda row: row['url_route'])
+        "instance_hours", date, 14, lambda row: row['url_route'],
+        columns=('url_route', 'instance_hours', 'count_'),
+        keys=[row['url_route'] for row in data])
 
     # Munge the table by adding a few columns.
     total_instance_hours = 0.0
@@ -506,12 +516,7 @@ ORDER BY instance_hours DESC
                                dry_run=dry_run)
 
 
-def email_out_of_memory_errors(date, dry_run=False):
-    # This sends two emails, for two different ways of seeing the data.
-    # But we'll have them share the same subject so they thread together.
-    yyyymmdd = date.strftime("%Y%m%d")
-    subject = 'OOM errors - '
-
+def _out_of_memory_errors_by_module_query(yyyymmdd):
     # Out-of-memory errors for python look like:
     #   Exceeded soft memory limit of 2048 MB with 2078 MB after servicing 1497 requests total. Consider setting a larger instance class in app.yaml.  #@Nolint
     # Out-of-memory errors for kotlin look like:
@@ -535,11 +540,55 @@ WHERE (app_logs.message CONTAINS 'Exceeded soft memory limit'
 GROUP BY module_id
 ORDER BY count_ DESC
 """ % (numreqs, numreqs, numreqs, yyyymmdd)
-    data = bq_util.query_bigquery(query)
+    return query
+
+
+def _out_of_memory_errors_by_route_query(yyyymmdd):
+    query = """\
+SELECT COUNT(1) AS count_,
+       module_id,
+       elog_url_route AS url_route
+FROM (
+    SELECT IFNULL(FIRST(module_id), 'default') AS module_id,
+           FIRST(elog_url_route) AS elog_url_route,
+           SUM(IF(
+               app_logs.message CONTAINS 'Exceeded soft memory limit'
+               OR app_logs.message CONTAINS 'OutOfMemoryError',
+               1, 0)) AS oom_message_count
+    FROM [logs.requestlogs_%s]
+    WHERE LEFT(version_id, 3) != 'znd' # ignore znds
+    GROUP BY request_id
+    HAVING oom_message_count > 0
+)
+GROUP BY module_id, url_route
+ORDER BY count_ DESC
+""" % yyyymmdd
+    return query
+
+
+def email_out_of_memory_errors(date, dry_run=False, module_data=None,
+                               route_data=None):
+    """Email out-of-memory reports for the given datetime.date object.
+
+    If `module_data` or `route_data` is None, we run the corresponding
+    query ourselves; otherwise they should be the results of running
+    _out_of_memory_errors_by_module_query() and
+    _out_of_memory_errors_by_route_query(), respectively.
+    """
+    # This sends two emails, for two different ways of seeing the data.
+    # But we'll have them share the same subject so they thread together.
+    yyyymmdd = date.strftime("%Y%m%d")
+    subject = 'OOM errors - '
+
+    data = module_data
+    if data is None:
+        data = bq_util.query_bigquery(
+            _out_of_memory_errors_by_module_query(yyyymmdd))
     bq_util.save_daily_data(data, "out_of_memory_errors_by_module", yyyymmdd)
     historical_data = bq_util.process_past_data(
         "out_of_memory_errors_by_module", date, 14,
-        lambda row: row['module_id'])
+        lambda row: row['module_id'], columns=('module_id', 'count_'),
+        keys=[row['module_id'] for row in data])
 
     for row in data:
         sparkline_data = []
@@ -564,30 +613,16 @@ ORDER BY count_ DESC
     heading = 'OOM errors by module for %s' % _pretty_date(yyyymmdd)
     email_content = {heading: data}
 
-    query = """\
-SELECT COUNT(1) AS count_,
-       module_id,
-       elog_url_route AS url_route
-FROM (
-    SELECT IFNULL(FIRST(module_id), 'default') AS module_id,
-           FIRST(elog_url_route) AS elog_url_route,
-           SUM(IF(
-               app_logs.message CONTAINS 'Exceeded soft memory limit'
-               OR app_logs.message CONTAINS 'OutOfMemoryError',
-               1, 0)) AS oom_message_count
-    FROM [logs.requestlogs_%s]
-    WHERE LEFT(version_id, 3) != 'znd' # ignore znds
-    GROUP BY request_id
-    HAVING oom_message_count > 0
-)
-GROUP BY module_id, url_route
-ORDER BY count_ DESC
-""" % yyyymmdd
-    data = bq_util.query_bigquery(query)
+    data = route_data
+    if data is None:
+        data = bq_util.query_bigquery(
+            _out_of_memory_errors_by_route_query(yyyymmdd))
     bq_util.save_daily_data(data, "out_of_memory_errors_by_route", yyyymmdd)
     historical_data = bq_util.process_past_data(
         "out_of_memory_errors_by_route", date, 14,
-        lambda row: (row['module_id'], row['url_route']))
+        lambda row: (row['module_id'], row['url_route']),
+        columns=('module_id', 'url_route', 'count_'),
+        keys=[(row['module_id'], row['url_route']) for row in data])
 
     for row in data:
         sparkline_data = []
@@ -624,10 +659,7 @@ ORDER BY count_ DESC
                     dry_run=dry_run)
 
 
-def email_client_api_usage(date, dry_run=False):
-    """Emails a report of API usage, segmented by client and build version."""
-    yyyymmdd = date.strftime("%Y%m%d")
-
+def _client_api_usage_query(yyyymmdd):
     ios_user_agent_regex = (r'^Khan%20Academy\.(.*)/(.*) CFNetwork/([.0-9]*)'
                             r' Darwin/([.0-9]*)$')
 
@@ -650,7 +682,18 @@ WHERE REGEXP_MATCH(elog_url_route, '^api.main:/api/internal')
 GROUP BY client, build, route
 ORDER BY client DESC, build DESC, request_count DESC;
 """ % {'ios_user_agent_regex': ios_user_agent_regex, 'date_format': yyyymmdd}
-    data = bq_util.query_bigquery(query)
+    return query
+
+
+def email_client_api_usage(date, dry_run=False, data=None):
+    """Emails a report of API usage, segmented by client and build version.
+
+    If `data` is None, we run the query ourselves; otherwise it should
+    be the results of running _client_api_usage_query().
+    """
+    yyyymmdd = date.strftime("%Y%m%d")
+    if data is None:
+        data = bq_util.query_bigquery(_client_api_usage_query(yyyymmdd))
     bq_util.save_daily_data(data, "client_api_usage", yyyymmdd)
 
     _ORDER = ('client', 'build', 'route', 'request_count')
@@ -673,17 +716,7 @@ ORDER BY client DESC, build DESC, request_count DESC;
                     dry_run=dry_run)
 
 
-def email_applog_sizes(date, dry_run=False):
-    """Email app-log report for the given datetime.date object.
-
-    This report says how much we are logging (via logging.info()
-    and friends), grouped by the first word of the log message.
-    (Which usually, but not always, is a good proxy for a single
-    log-message in our app.)  Since we pay per byte logged, we
-    want to make sure we're not accidentally logging a single
-    log message a ton, which is really easy to do.
-    """
-    yyyymmdd = date.strftime("%Y%m%d")
+def _applog_sizes_query(yyyymmdd):
     query = """\
 SELECT
   REGEXP_EXTRACT(app_logs.message, r'^([a-zA-Z0-9_-]*)') AS firstword,
@@ -702,11 +735,31 @@ GROUP BY
 ORDER BY
   cost_usd DESC
 """ % (yyyymmdd)
-    data = bq_util.query_bigquery(query)
+    return query
+
+
+def email_applog_sizes(date, dry_run=False, data=None):
+    """Email app-log report for the given datetime.date object.
+
+    This report says how much we are logging (via logging.info()
+    and friends), grouped by the first word of the log message.
+    (Which usually, but not always, is a good proxy for a single
+    log-message in our app.)  Since we pay per byte logged, we
+    want to make sure we're not accidentally logging a single
+    log message a ton, which is really easy to do.
+
+    If `data` is None, we run the query ourselves; otherwise it should
+    be the results of running _applog_sizes_query().
+    """
+    yyyymmdd = date.strftime("%Y%m%d")
+    if data is None:
+        data = bq_util.query_bigquery(_applog_sizes_query(yyyymmdd))
     data = [row for row in data if row['firstword'] not in (None, '(None)')]
     bq_util.save_daily_data(data, "log_bytes", yyyymmdd)
     historical_data = bq_util.process_past_data(
-        "log_bytes", date, 14, lambda row: row['firstword'])
+        "log_bytes", date, 14, lambda row: row['firstword'],
+        columns=('firstword', 'size_mb'),
+        keys=[row['firstword'] for row in data])
 
     # Munge the table by adding a few columns.
     total_bytes = 0.0
@@ -781,17 +834,39 @@ def main():
         print('Emailing %s info' % args.report)
         report_method(date, dry_run=args.dry_run)
     else:
+        # The queries are independent, so we run them all at once, and
+        # then build the reports from the results.
+        print('Running all report queries')
+        yyyymmdd = date.strftime("%Y%m%d")
+        (instance_hours_data, oom_module_data, oom_route_data,
+         client_api_usage_data, applog_sizes_data) = bq_util.query_many([
+             _instance_hours_query(yyyymmdd),
+             _out_of_memory_errors_by_module_query(yyyymmdd),
+             _out_of_memory_errors_by_route_query(yyyymmdd),
+             _client_api_usage_query(yyyymmdd),
+             _applog_sizes_query(yyyymmdd),
+         ])
+
         print('Emailing instance hour info')
-        email_instance_hours(date, dry_run=args.dry_run)
+        email_instance_hours(date, dry_run=args.dry_run,
+                             data=instance_hours_data)
 
         print('Emailing out-of-memory info')
-        email_out_of_memory_errors(date, dry_run=args.dry_run)
+        email_out_of_memory_errors(date, dry_run=args.dry_run,
+                                   module_data=oom_module_data,
+                                   route_data=oom_route_data)
 
         print('Emailing client API usage info')
-        email_client_api_usage(date, dry_run=args.dry_run)
+        email_client_api_usage(date, dry_run=args.dry_run,
+                               data=client_api_usage_data)
 
         print('Emailing app-log sizes')
-        email_applog_sizes(date, dry_run=args.dry_run)
+        email_applog_sizes(date, dry_run=args.dry_run,
+                           data=applog_sizes_data)
+
+    print('Sending query stats to stackdriver')
+    bq_util.send_query_stats_to_cloudmonitoring(_GOOGLE_PROJECT_ID,
+                                                dry_run=args.dry_run)
 
 
 if __name__ == '__main__':
@@ -8,10 +8,25 @@ but are not available in Cloud Monitoring. This script collects GCE instance
 metrics and sends them to cloud monitoring.
 
 It's expected this script will be run periodically as a cron job every 5
-minutes.
+minutes.  So that a run doesn't take longer than that, we fetch the
+instances' serial port output in parallel, and give up on instances that
+haven't answered by a deadline; we report those as "unknown".
+
+Between runs, we remember (in SERIAL_PORT_STATE_FILE) how far into each
+instance's serial port output we've read, and its most recent statuses,
+so each run only needs to fetch and look at the output that's new.
 """
 
+import array
+import concurrent.futures
+import contextlib
+import json
+import logging
+import os
+import queue
 import re
+import sqlite3
+import threading
 import time
 
 import apiclient.errors
@@ -25,6 +40,77 @@ class GCEInstance(object):
         self.zone_name = zone_name
 
 
+# How many of an instance's most recent statuses we remember between runs.
+# We only need unhealthy_count_threshold of them, but this lets us raise it.
+_MAX_STATUSES = 100
+
+_TIMESTAMP_RE = re.compile(r'TIME=(\d+)')
+
+
+def _parse_statuses(serial_port_output):
+    """Return the statuses in the given serial port output lines.
+
+    We return a pair of arrays, with an entry for each status line, in
+    the order we got them: the line's TIME=... value (or -1 if it has
+    none), and whether the status is unhealthy.
+    """
+    status_lines = [line for line in serial_port_output if 'STATUS=' in line]
+    # We search each line on its own: one search over all of them can't
+    # tell which line each TIME=... came from.
+    timestamps = [m.group(1) if m else -1
+                  for m in map(_TIMESTAMP_RE.search, status_lines)]
+    return (array.array('q', map(int, timestamps)),
+            array.array('b', ['STATUS=HEALTH_CHECK_UNHEALTHY' in line
+                              for line in status_lines]))
+
+
+def _newest_indices(statuses, n):
+    """Return the indices of the n most recent statuses, newest first.
+
+    Statuses with the same timestamp are in the order we got them.
+    """
+    (timestamps, _) = statuses
+    if len(timestamps) <= n:
+        candidates = range(len(timestamps))
+    else:
+        # Sorting the timestamps themselves is fast; then we only need to
+        # sort the statuses at least as new as the nth newest.
+        cutoff = sorted(timestamps)[-n]
+        candidates = [i for (i, timestamp) in enumerate(timestamps)
+                      if timestamp >= cutoff]
+    return sorted(candidates, key=timestamps.__getitem__, reverse=True)[:n]
+
+
+def _update_statuses(statuses, serial_port_output):
+    """Return the most recent statuses, given new serial port output lines.
+
+    `statuses` is what we last returned for this instance, or what
+    _parse_statuses() returns; we return the newest _MAX_STATUSES of
+    those and the new lines' statuses, newest first.
+    """
+    (new_timestamps, new_unhealthy) = _parse_statuses(serial_port_output)
+    timestamps = statuses[0] + new_timestamps
+    unhealthy = statuses[1] + new_unhealthy
+    newest = _newest_indices((timestamps, unhealthy), _MAX_STATUSES)
+    return (array.array('q', (timestamps[i] for i in newest)),
+            array.array('b', (unhealthy[i] for i in newest)))
+
+
+def _statuses_are_failed(statuses, unhealthy_count_threshold):
+    """Return true if the `unhealthy_count_threshold` most recent statuses
+    are all unhealthy.
+    """
+    newest = _newest_indices(statuses, unhealthy_count_threshold)
+    return (len(newest) >= unhealthy_count_threshold and
+            all(statuses[1][i] for i in newest))
+
+
+def _instances_are_failed(statuses_list, unhealthy_count_threshold):
+    """Return, for each instance's statuses, whether it's failed."""
+    return [_statuses_are_failed(statuses, unhealthy_count_threshold)
+            for statuses in statuses_list]
+
+
 def _instance_is_failed(serial_port_output, unhealthy_count_threshold):
     """Return true if instance is considered failed.
 
@@ -34,29 +120,30 @@ def _instance_is_failed(serial_port_output, unhealthy_count_threshold):
     uninterrupted by a healthy status message when sorted by timestamp.
     """
     # only look at last (most recent) 1000 entries in serial port output so
-    # that the full serial port output history isn't sorted
-    serial_port_output = serial_port_output[-1000:]
-    timestamp_re = re.compile(r'TIME=(\d+)')
-    serial_port_output.sort(key=lambda line: timestamp_re.findall(line),
-                            reverse=True)
+    # that the full serial port output history isn't searched
+    return _statuses_are_failed(_parse_statuses(serial_port_output[-1000:]),
+                                unhealthy_count_threshold)
 
-    num_consecutive_unhealthy = 0
-    for line in serial_port_output:
-        if 'STATUS=HEALTH_CHECK_UNHEALTHY' in line:
-            num_consecutive_unhealthy += 1
-        elif 'STATUS=' in line:  # probably 'ALL_COMMANDS_SUCCEEDED'
-            break
 
-    return num_consecutive_unhealthy >= unhealthy_count_threshold
+# How many times we retry a serial port fetch, and how long, in seconds,
+# we wait on the network for each try.  We have a lot of instances to
+# get through by the deadline, so we'd rather give up on one.
+_SERIAL_PORT_NUM_RETRIES = 2
+_SERIAL_PORT_TIMEOUT = 20
 
 
 def _get_serial_port_output_lines_from_cloud_compute(service, project_id,
-                                                     gce_instance):
-    """Return a list of serial port output lines for the gce instance.
+                                                     gce_instance,
+                                                     start=None):
+    """Return serial port output lines for the gce instance, and where to
+    start next time.
 
     List of serial port output lines for the gce instance is ordered from
     least recent to most recent. With each port output as a separate list
-    entry.
+    entry.  If `start` is not None, we only get the output from that
+    byte offset on -- or from as far back as the instance still has, if
+    that's later.  We return the offset to pass as `start` next time,
+    so that we get only lines we haven't seen.
 
     Documentation: cloud.google.com/compute/docs/reference/latest/instances
     Examples of expected serial_port_output lines:
@@ -77,15 +164,95 @@ def _get_serial_port_output_lines_from_cloud_compute(service, project_id,
         gcm-Heartbeat:1467830699000
         gcm-StatusUpdate:TIME=1467826034000;STATUS=ALL_COMMANDS_SUCCEEDED
     """
+    kwargs = {} if start is None else {'start': start}
     request = service.instances().getSerialPortOutput(
         project=project_id, zone=gce_instance.zone_name,
-        instance=gce_instance.instance_name)
+        instance=gce_instance.instance_name, **kwargs)
     try:
-        response = cloudmonitoring_util.execute_with_retries(request)
+        response = cloudmonitoring_util.execute_with_retries(
+            request, num_retries=_SERIAL_PORT_NUM_RETRIES)
     # This can fail, for example when an instance is spinning up.
     except apiclient.errors.HttpError:
-        return []
-    return response['contents'].split('\n')
+        return ([], start)
+    lines = response['contents'].split('\n')
+    next_start = response.get('next')
+    if next_start is not None:
+        # If the last line isn't done yet, we'll get all of it next time.
+        next_start = int(next_start) - len(lines.pop().encode('utf-8'))
+    return (lines, next_start)
+
+
+# How many instances to fetch serial port output for at once.
+_MAX_PARALLEL_FETCHES = 16
+
+# How long, in seconds, we give all the serial port fetches in a run.
+_SERIAL_PORT_DEADLINE = 120
+
+
+def _get_serial_port_output_lines_in_thread(project_id, gce_instance, start):
+    # Each thread gets its own service, since they aren't thread-safe.
+    service = cloudmonitoring_util.get_cloud_service(
+        'compute', 'v1', timeout=_SERIAL_PORT_TIMEOUT)
+    return _get_serial_port_output_lines_from_cloud_compute(
+        service, project_id, gce_instance, start)
+
+
+def _get_serial_port_output_lines_by_instance(project_id, gce_instances,
+                                              deadline, starts):
+    """Return a map from gce instance to its new serial port output lines.
+
+    We fetch the lines for all the instances in parallel, starting each
+    at starts[instance_name] if it's there.  The map's values are (lines,
+    where to start next time), as returned by
+    _get_serial_port_output_lines_from_cloud_compute().  Instances we
+    don't have the lines for by `deadline` (a time_t), or whose fetch
+    failed, map to None.
+    """
+    futures = {concurrent.futures.Future(): gce_instance
+               for gce_instance in gce_instances}
+    todo = queue.Queue()
+    for (future, gce_instance) in futures.items():
+        todo.put((future, gce_instance))
+
+    def fetch():
+        while True:
+            try:
+                (future, gce_instance) = todo.get_nowait()
+            except queue.Empty:
+                return
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                future.set_result(_get_serial_port_output_lines_in_thread(
+                    project_id, gce_instance,
+                    starts.get(gce_instance.instance_name)))
+            except Exception as e:
+                future.set_exception(e)
+
+    # We use daemon threads rather than a ThreadPoolExecutor, whose
+    # threads python waits for when it exits: this way, fetches still
+    # going at the deadline don't keep the run going.
+    for _ in range(min(_MAX_PARALLEL_FETCHES, len(futures))):
+        threading.Thread(target=fetch, daemon=True).start()
+    (done, _) = concurrent.futures.wait(
+        futures, timeout=max(deadline - time.time(), 0))
+    # The fetches that haven't started yet, we don't start.
+    for future in futures:
+        future.cancel()
+
+    retval = {}
+    for (future, gce_instance) in futures.items():
+        if future not in done:
+            logging.warning('Timed out getting serial port output for %s',
+                            gce_instance.instance_name)
+            retval[gce_instance] = None
+        elif future.exception() is not None:
+            logging.warning('Error getting serial port output for %s: %s',
+                            gce_instance.instance_name, future.exception())
+            retval[gce_instance] = None
+        else:
+            retval[gce_instance] = future.result()
+    return retval
 
 
 def _get_instances_matching_name_from_response(instances_list_response,
@@ -109,6 +276,43 @@ def _get_instances_matching_name_from_response(instances_list_response,
     return gce_instances
 
 
+# Where we keep, between runs, how far we've read into each instance's
+# serial port output, and its most recent statuses.
+SERIAL_PORT_STATE_FILE = os.path.join(os.getenv('HOME'), 'bq_data',
+                                      'fetch_instance_stats_state.sqlite')
+
+
+def _statuses_to_json(statuses):
+    (timestamps, unhealthy) = statuses
+    return json.dumps({'timestamps': timestamps.tolist(),
+                       'unhealthy': unhealthy.tolist()})
+
+
+def _statuses_from_json(value):
+    value = json.loads(value)
+    return (array.array('q', value['timestamps']),
+            array.array('b', value['unhealthy']))
+
+
+@contextlib.contextmanager
+def _serial_port_state_db():
+    """Yield a connection to the serial port state, in a transaction."""
+    dirname = os.path.dirname(SERIAL_PORT_STATE_FILE)
+    if not os.path.isdir(dirname):
+        os.makedirs(dirname)
+    db = sqlite3.connect(SERIAL_PORT_STATE_FILE)
+    try:
+        with db:
+            db.execute('CREATE TABLE IF NOT EXISTS serial_port_state ('
+                       '  instance_name TEXT PRIMARY KEY,'
+                       '  next_start INTEGER,'
+                       '  statuses TEXT'      # from _statuses_to_json()
+                       ') WITHOUT ROWID')
+            yield db
+    finally:
+        db.close()
+
+
 def _get_instances_list_from_cloud_compute(service, project_id):
     """Get the aggregated GCE instances list via cloud compute API."""
     request = service.instances().aggregatedList(project=project_id)
@@ -116,7 +320,7 @@ def _get_instances_list_from_cloud_compute(service, project_id):
     return response
 
 
-def main(project_id, dry_run):
+def main(project_id, dry_run, deadline=_SERIAL_PORT_DEADLINE):
     now = time.time()
 
     service = cloudmonitoring_util.get_cloud_service('compute', 'v1')
@@ -130,36 +334,125 @@ def main(project_id, dry_run):
     # that module in GCE instance names.
     module_id_to_name_substring = {'react-render': 'gae-react--render',
                                    'vm': 'gae-vm-'}
-    for module_id, name_substring in module_id_to_name_substring.items():
-        instances = _get_instances_matching_name_from_response(
+    instances_by_module = {
+        module_id: _get_instances_matching_name_from_response(
             instance_list_response, name_substring)
-
-        serial_port_output_lines = [
-            _get_serial_port_output_lines_from_cloud_compute(
-                service, project_id, instance)
-            for instance in instances
-        ]
-
-        # Number of consecutive "unhealthy" instance statuses required to
-        # consider that instance "failed".
-        unhealthy_count_threshold = 5
-
-        num_failed_instances = len(
-            [line for line in serial_port_output_lines
-             if _instance_is_failed(line, unhealthy_count_threshold)])
+        for module_id, name_substring in module_id_to_name_substring.items()
+    }
+
+    all_instances = [instance for instances in instances_by_module.values()
+                     for instance in instances]
+
+    with _serial_port_state_db() as db:
+        state = {instance_name: (next_start, _statuses_from_json(statuses))
+                 for (instance_name, next_start, statuses) in db.execute(
+                     'SELECT instance_name, next_start, statuses'
+                     '  FROM serial_port_state')}
+
+        # We fetch the serial port output for all the modules' instances
+        # at once, so they all share the deadline.
+        serial_port_output_lines_by_instance = (
+            _get_serial_port_output_lines_by_instance(
+                project_id, all_instances, now + deadline,
+                {instance_name: next_start
+                 for (instance_name, (next_start, _)) in state.items()}))
+
+        # Map each instance we heard from to its most recent statuses.
+        statuses_by_instance = {}
+        for instance in all_instances:
+            output = serial_port_output_lines_by_instance[instance]
+            if output is None:
+                continue
+            (lines, next_start) = output
+            (_, old_statuses) = state.get(instance.instance_name,
+                                          (None, _parse_statuses([])))
+            statuses = _update_statuses(old_statuses, lines)
+            statuses_by_instance[instance] = statuses
+            db.execute('INSERT OR REPLACE INTO serial_port_state'
+                       '  VALUES (?, ?, ?)',
+                       (instance.instance_name, next_start,
+                        _statuses_to_json(statuses)))
+
+        # Forget about instances that are gone.
+        instance_names = set(instance.instance_name
+                             for instance in all_instances)
+        for instance_name in state:
+            if instance_name not in instance_names:
+                db.execute('DELETE FROM serial_port_state'
+                           '  WHERE instance_name = ?', (instance_name,))
+
+    # Number of consecutive "unhealthy" instance statuses required to
+    # consider that instance "failed".
+    unhealthy_count_threshold = 5
+
+    # We send all the modules' metrics to Stackdriver at once.
+    data = []
+    for module_id, instances in instances_by_module.items():
+        known_instances = [instance for instance in instances
+                           if instance in statuses_by_instance]
+        failed_instances = [
+            instance for (instance, is_failed) in zip(
+                known_instances,
+                _instances_are_failed(
+                    [statuses_by_instance[instance]
+                     for instance in known_instances],
+                    unhealthy_count_threshold))
+            if is_failed]
+        # The instances we didn't hear from in time.
+        unknown_instances = [instance for instance in instances
+                             if instance not in statuses_by_instance]
 
         if dry_run:
-            print('module=%s, num_failed_instances=%s'
-                  % (module_id, num_failed_instances))
-            continue
-
-        # Send metric to Stackdriver.
-        data = ('gce.failed_instance_count',
-                {'module_id': module_id},
-                num_failed_instances,
-                now)
+            print('module=%s, num_failed_instances=%s, '
+                  'num_unknown_instances=%s'
+                  % (module_id, len(failed_instances),
+                     len(unknown_instances)))
+
+        data.append(('gce.failed_instance_count',
+                     {'module_id': module_id},
+                     len(failed_instances),
+                     now))
+        data.append(('gce.unknown_instance_count',
+                     {'module_id': module_id},
+                     len(unknown_instances),
+                     now))
+
+        for zone_name in sorted(set(instance.zone_name
+                                    for instance in instances)):
+            labels = {'module_id': module_id, 'zone': zone_name}
+            data.append(('gce.zone_failed_instance_count',
+                         labels,
+                         len([instance for instance in failed_instances
+                              if instance.zone_name == zone_name]),
+                         now))
+            data.append(('gce.zone_unknown_instance_count',
+                         labels,
+                         len([instance for instance in unknown_instances
+                              if instance.zone_name == zone_name]),
+                         now))
+
+        # 1 if the instance is failed, 0 if not; we don't say anything
+        # about instances we didn't hear from.
+        failed_instances = set(failed_instances)
+        for instance in known_instances:
+            data.append(('gce.instance_is_failed',
+                         {'module_id': module_id,
+                          'zone': instance.zone_name,
+                          'instance_name': instance.instance_name},
+                         int(instance in failed_instances),
+                         now))
+
+    # How the API calls we made went: how many errors of each kind, and
+    # how many times we retried.
+    for (kind, count) in sorted(
+            cloudmonitoring_util.DEFAULT_RETRY_POLICY.stats().items()):
+        if dry_run:
+            print('api_calls %s=%s' % (kind, count))
+        data.append(('gce.api_call_stats', {'kind': kind}, count, now))
+
+    if not dry_run:
         cloudmonitoring_util.send_timeseries_to_cloudmonitoring(project_id,
-                                                                [data])
+                                                                data)
 
 
 if __name__ == '__main__':
@@ -170,5 +463,11 @@ if __name__ == '__main__':
                               'stats for (Default: %(default)s)'))
     parser.add_argument('-n', '--dry-run', action='store_true', default=False,
                         help='do not write metrics to Cloud Monitoring')
+    parser.add_argument('--deadline', type=float,
+                        default=_SERIAL_PORT_DEADLINE,
+                        help=('How many seconds to wait for instances\' '
+                              'serial port output; instances we haven\'t '
+                              'heard from by then are counted as unknown '
+                              '(Default: %(default)s)'))
     args = parser.parse_args()
-    main(args.project_id, args.dry_run)
+    main(args.project_id, args.dry_run, args.deadline)
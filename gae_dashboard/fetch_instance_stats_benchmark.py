@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+"""Time how long fetch_instance_stats takes to find the failed instances.
+
+For each instance, we look at up to 1000 lines of serial port output
+to see if its most recent statuses are unhealthy.  This makes up output
+like that for a bunch of instances, and times finding the failed ones
+the way we used to -- sorting all the lines by their TIME=... values --
+against fetch_instance_stats._instances_are_failed().  It also makes
+sure the two agree.
+
+Run it like:
+   python3 fetch_instance_stats_benchmark.py --instances 300
+"""
+
+import argparse
+import random
+import re
+import timeit
+
+import fetch_instance_stats
+
+
+_UNHEALTHY_COUNT_THRESHOLD = 5
+
+
+def _synthetic_output(num_lines, rand):
+    """Make up serial port output, with heartbeats between the statuses."""
+    now = 1467830173000
+    # Some instances are unhealthy for a while at the end.
+    unhealthy_from = rand.choice([num_lines, num_lines - 3, num_lines - 50])
+    lines = []
+    for i in range(num_lines):
+        t = now + i * 5000 + rand.randint(-10000, 10000)   # out of order
+        if i % 2:
+            lines.append('gcm-Heartbeat:%d' % t)
+        elif i >= unhealthy_from:
+            lines.append('gcm-StatusUpdate:TIME=%d;'
+                         'STATUS=HEALTH_CHECK_UNHEALTHY;STATUS_MESSAGE=0' % t)
+        else:
+            lines.append('gcm-StatusUpdate:TIME=%d;'
+                         'STATUS=ALL_COMMANDS_SUCCEEDED' % t)
+    return lines
+
+
+def _sort_every_line(serial_port_output, unhealthy_count_threshold):
+    """How _instance_is_failed() used to decide if an instance failed."""
+    serial_port_output = serial_port_output[-1000:]
+    timestamp_re = re.compile(r'TIME=(\d+)')
+    serial_port_output.sort(key=lambda line: timestamp_re.findall(line),
+                            reverse=True)
+
+    num_consecutive_unhealthy = 0
+    for line in serial_port_output:
+        if 'STATUS=HEALTH_CHECK_UNHEALTHY' in line:
+            num_consecutive_unhealthy += 1
+        elif 'STATUS=' in line:
+            break
+
+    return num_consecutive_unhealthy >= unhealthy_count_threshold
+
+
+def _classify_by_sorting(outputs):
+    return [_sort_every_line(output, _UNHEALTHY_COUNT_THRESHOLD)
+            for output in outputs]
+
+
+def _classify_in_batch(outputs):
+    return fetch_instance_stats._instances_are_failed(
+        [fetch_instance_stats._parse_statuses(output) for output in outputs],
+        _UNHEALTHY_COUNT_THRESHOLD)
+
+
+def main(num_instances, num_lines, repeat):
+    rand = random.Random(0)
+    outputs = [_synthetic_output(num_lines, rand)
+               for _ in range(num_instances)]
+
+    expected = _classify_by_sorting(outputs)
+    actual = _classify_in_batch(outputs)
+    assert actual == expected, '_instances_are_failed() disagrees'
+    print('%d of %d instances are failed' % (sum(actual), num_instances))
+
+    for (name, classify) in (
+            ('sorting every line', _classify_by_sorting),
+            ('_instances_are_failed', _classify_in_batch)):
+        best = min(timeit.repeat(lambda: classify(outputs),
+                                 number=1, repeat=repeat))
+        print('%-22s %8.2f ms for %d instances (%.1f us/instance)'
+              % (name, best * 1000, num_instances,
+                 best * 1e6 / num_instances))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--instances', type=int, default=300,
+                        help='How many instances to classify (default 300)')
+    parser.add_argument('--lines', type=int, default=1000,
+                        help=('How many lines of output each instance has '
+                              '(default 1000)'))
+    parser.add_argument('--repeat', type=int, default=5,
+                        help='Report the best of this many runs (default 5)')
+    args = parser.parse_args()
+    main(args.instances, args.lines, args.repeat)
@@ -1,5 +1,12 @@
+import os
+import shutil
+import tempfile
+import threading
+import time
 import unittest
 
+import apiclient.errors
+
 import cloudmonitoring_util
 import fetch_instance_stats
 
@@ -53,6 +60,60 @@ class TestInstanceIsFailed(unittest.TestCase):
             serial_port_output_lines, unhealthy_count_threshold))
 
 
+class TestParseStatuses(unittest.TestCase):
+    def test_timestamps_are_per_line(self):
+        (timestamps, unhealthy) = fetch_instance_stats._parse_statuses([
+            'TIME=10;STATUS=HEALTH_CHECK_UNHEALTHY;PREV_TIME=5',
+            'STATUS=ALL_COMMANDS_SUCCEEDED',
+            'gcm-Heartbeat:20',
+            'TIME=30;STATUS=ALL_COMMANDS_SUCCEEDED'])
+        self.assertEqual([10, -1, 30], timestamps.tolist())
+        self.assertEqual([1, 0, 0], unhealthy.tolist())
+
+
+class TestUpdateStatuses(unittest.TestCase):
+    def test_new_healthy_status_ends_failure(self):
+        statuses = fetch_instance_stats._update_statuses(
+            fetch_instance_stats._parse_statuses([]),
+            ['TIME=10;STATUS=HEALTH_CHECK_UNHEALTHY'] * 10)
+        self.assertTrue(fetch_instance_stats._statuses_are_failed(
+            statuses, 5))
+        statuses = fetch_instance_stats._update_statuses(
+            statuses, ['gcm-Heartbeat:20',
+                       'TIME=20;STATUS=ALL_COMMANDS_SUCCEEDED'])
+        self.assertFalse(fetch_instance_stats._statuses_are_failed(
+            statuses, 5))
+
+    def test_keeps_only_most_recent_statuses(self):
+        statuses = fetch_instance_stats._update_statuses(
+            fetch_instance_stats._parse_statuses([]),
+            ['TIME=%d;STATUS=HEALTH_CHECK_UNHEALTHY' % (100 + i)
+             for i in range(200)])
+        statuses = fetch_instance_stats._update_statuses(
+            statuses, ['TIME=50;STATUS=ALL_COMMANDS_SUCCEEDED'])
+        (timestamps, unhealthy) = statuses
+        self.assertEqual(fetch_instance_stats._MAX_STATUSES, len(timestamps))
+        self.assertEqual(list(range(299, 199, -1)), timestamps.tolist())
+        self.assertTrue(all(unhealthy))
+        self.assertTrue(fetch_instance_stats._statuses_are_failed(
+            statuses, 5))
+
+    def test_batch_and_one_at_a_time_agree(self):
+        outputs = [
+            ['TIME=%d;STATUS=%s' % ((i * 7 + j * 13) % 50,
+                                    'HEALTH_CHECK_UNHEALTHY' if (i + j) % 9
+                                    else 'ALL_COMMANDS_SUCCEEDED')
+             for j in range(40)]
+            for i in range(30)]
+        self.assertEqual(
+            [fetch_instance_stats._instance_is_failed(output, 5)
+             for output in outputs],
+            fetch_instance_stats._instances_are_failed(
+                [fetch_instance_stats._update_statuses(
+                    fetch_instance_stats._parse_statuses([]), output)
+                 for output in outputs], 5))
+
+
 class TestGetInstancesFromResponse(unittest.TestCase):
     def test_returns_only_instances_matching_name(self):
         instance_list_response = {
@@ -81,10 +142,24 @@ class TestMain(unittest.TestCase):
         self.sent_to_cloud_monitoring = {}
         self.mock_origs = {}   # used to unmock if needed
 
-        def new_send_to_stackdriver(alert, metric_name, value=1,
-                                    metric_labels=None, **kwargs):
-            module_id = metric_labels['module_id']
-            self.sent_to_cloud_monitoring[module_id] = (metric_name, value)
+        def new_write_timeseries(batcher, timeseries):
+            for one_timeseries in timeseries:
+                metric_name = one_timeseries['metric']['type'].split('/')[-1]
+                labels = dict(one_timeseries['metric']['labels'])
+                module_id = labels.pop('module_id', None)
+                key = ((module_id, metric_name)
+                       + tuple(sorted(labels.values())))
+                self.sent_to_cloud_monitoring[key] = (
+                    one_timeseries['points'][0]['value']['doubleValue'])
+
+        # How many times we sent metrics.
+        self.num_sends = 0
+        orig_send_timeseries = (
+            cloudmonitoring_util.send_timeseries_to_cloudmonitoring)
+
+        def new_send_timeseries_to_cloudmonitoring(*args, **kwargs):
+            self.num_sends += 1
+            return orig_send_timeseries(*args, **kwargs)
 
         def new_get_instances_list_from_cloud_compute(service, project_id):
             instance_list_response = {
@@ -93,28 +168,59 @@ class TestMain(unittest.TestCase):
                         'zones/1': {
                             'instances': [
                                 {'name': 'gae-react--render-instance1'},
-                                {'name': 'gae-react--render-instance2'},
+                                {'name': 'gae-react--render-slow'},
                                 {'name': 'err1'}, {'name': 'err2'}
                             ]
+                        },
+                        'zones/2': {
+                            'instances': [
+                                {'name': 'gae-react--render-instance2'},
+                                {'name': 'gae-react--render-ok'},
+                            ]
                         }
                     }
             }
             return instance_list_response
 
+        # Map from instance name to the starts it was fetched with.
+        self.fetch_starts = {}
+
         def new_get_serial_port_output_lines_from_cloud_compute(service,
                                                                 project_id,
-                                                                gce_instance):
+                                                                gce_instance,
+                                                                start=None):
+            self.fetch_starts.setdefault(
+                gce_instance.instance_name, []).append(start)
+            if 'slow' in gce_instance.instance_name:
+                self.slow_fetch_done.wait()
+                return ([], None)
+            if start is not None:
+                # Nothing new since last time.
+                return ([], start)
             if 'instance' in gce_instance.instance_name:
                 serial_port_output = 'STATUS=HEALTH_CHECK_UNHEALTHY\n' * 10
                 serial_port_output_lines = serial_port_output.split('\n')
-                return serial_port_output_lines
+                return (serial_port_output_lines, 1000)
 
             serial_port_output = 'STATUS=HEALTH_CHECK_UNHEALTHY\n' * 2
             serial_port_output_lines = serial_port_output.split('\n')
-            return serial_port_output_lines
+            return (serial_port_output_lines, 1000)
 
-        self.mock(cloudmonitoring_util.alertlib.Alert, 'send_to_stackdriver',
-                  new_send_to_stackdriver)
+        # The fetch for the slow instance takes until we're done.
+        self.slow_fetch_done = threading.Event()
+        self.addCleanup(self.slow_fetch_done.set)
+
+        self.mock(cloudmonitoring_util.TimeseriesBatcher, '_write_timeseries',
+                  new_write_timeseries)
+        self.mock(cloudmonitoring_util, 'get_cloud_service',
+                  lambda *args, **kwargs: None)
+        self.mock(cloudmonitoring_util, 'send_timeseries_to_cloudmonitoring',
+                  new_send_timeseries_to_cloudmonitoring)
+
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(lambda: shutil.rmtree(tmpdir))
+        self.mock(fetch_instance_stats, 'SERIAL_PORT_STATE_FILE',
+                  os.path.join(tmpdir, 'state.sqlite'))
         self.mock(fetch_instance_stats,
                   '_get_instances_list_from_cloud_compute',
                   new_get_instances_list_from_cloud_compute)
@@ -133,10 +239,59 @@ class TestMain(unittest.TestCase):
         setattr(container, var_str, new_value)
 
     def test_sent_errors_to_stackdriver(self):
-        fetch_instance_stats.main('proj_id', False)
-        self.assertEqual({'react-render': ('gce.failed_instance_count', 2),
-                          'vm': ('gce.failed_instance_count', 0)},
-                         self.sent_to_cloud_monitoring)
+        fetch_instance_stats.main('proj_id', False, deadline=1)
+        self.assertEqual(
+            {('react-render', 'gce.failed_instance_count'): 2,
+             ('react-render', 'gce.unknown_instance_count'): 1,
+             ('react-render', 'gce.zone_failed_instance_count', '1'): 1,
+             ('react-render', 'gce.zone_unknown_instance_count', '1'): 1,
+             ('react-render', 'gce.zone_failed_instance_count', '2'): 1,
+             ('react-render', 'gce.zone_unknown_instance_count', '2'): 0,
+             ('react-render', 'gce.instance_is_failed',
+              '1', 'gae-react--render-instance1'): 1,
+             ('react-render', 'gce.instance_is_failed',
+              '2', 'gae-react--render-instance2'): 1,
+             ('react-render', 'gce.instance_is_failed',
+              '2', 'gae-react--render-ok'): 0,
+             ('vm', 'gce.failed_instance_count'): 0,
+             ('vm', 'gce.unknown_instance_count'): 0},
+            self.sent_to_cloud_monitoring)
+        self.assertEqual(1, self.num_sends)
+
+    def test_fetch_errors_are_unknown(self):
+        def failing_fetch(service, project_id, gce_instance):
+            raise apiclient.errors.HttpError({'status': '500'}, b'')
+
+        self.mock(fetch_instance_stats,
+                  '_get_serial_port_output_lines_from_cloud_compute',
+                  failing_fetch)
+        fetch_instance_stats.main('proj_id', False, deadline=1)
+        self.assertEqual(
+            4, self.sent_to_cloud_monitoring[
+                ('react-render', 'gce.unknown_instance_count')])
+
+    def test_fetches_not_started_by_the_deadline_are_not_started(self):
+        self.mock(fetch_instance_stats, '_MAX_PARALLEL_FETCHES', 1)
+        fetch_instance_stats.main('proj_id', False, deadline=1)
+        # We got stuck on the slow instance, and gave up on the rest.
+        self.slow_fetch_done.set()
+        time.sleep(0.1)
+        self.assertIn('gae-react--render-slow', self.fetch_starts)
+        self.assertNotIn('gae-react--render-ok', self.fetch_starts)
+        self.assertEqual(
+            3, self.sent_to_cloud_monitoring[
+                ('react-render', 'gce.unknown_instance_count')])
+
+    def test_reads_only_new_output(self):
+        fetch_instance_stats.main('proj_id', False, deadline=1)
+        self.sent_to_cloud_monitoring.clear()
+        fetch_instance_stats.main('proj_id', False, deadline=1)
+        self.assertEqual([None, 1000],
+                         self.fetch_starts['gae-react--render-instance1'])
+        # We remember the instances' statuses, even with no new output.
+        self.assertEqual(
+            2, self.sent_to_cloud_monitoring[
+                ('react-render', 'gce.failed_instance_count')])
 
 if __name__ == '__main__':
     unittest.main()
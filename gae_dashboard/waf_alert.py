@@ -83,7 +83,6 @@ def waf_detect(endtime):
         FASTLY_LOG_TABLE_PREFIX + "_*"
     )
     start = endtime - datetime.timedelta(seconds=WAF_PERIOD)
-    date = endtime.date()
 
     start_ymd = start.strftime(TABLE_FORMAT)
     end_ymd = endtime.strftime(TABLE_FORMAT)
@@ -98,17 +97,7 @@ def waf_detect(endtime):
     blocked_results = bq_util.query_bigquery(blocked_info, project=BQ_PROJECT)
 
     # When an empty query is returned, these are of types ('None').
-    blocked = blocked_results[0]["blocked"]
-    ip = blocked_results[0]["ip"]
-    ip_percentage = blocked_results[0]["ip_percentage"]
-    request_user_agent = blocked_results[0]["request_user_agent"]
-    message = blocked_results[0]["message"]
-    message_percentage = blocked_results[0]["message_percentage"]
-    request_user_agent_percentage = (
-        blocked_results[0]["request_user_agent_percentage"]
-    )
-
-    if ip_percentage == "(None)":
+    if blocked_results[0]["ip_percentage"] == "(None)":
         return
 
     total_info = TOTAL_REQ.format(
@@ -121,13 +110,36 @@ def waf_detect(endtime):
     total_results = bq_util.query_bigquery(total_info, project=BQ_PROJECT)
 
     total = total_results[0]["total"]
+
+    msg = waf_alert_message(start, endtime, blocked_results[0], total)
+    if msg:
+        alertlib.Alert(msg).send_to_slack(ALERT_CHANNEL)
+
+
+def waf_alert_message(start, endtime, blocked_info, total):
+    """The slack message waf_detect() sends, or None if it sends nothing.
+
+    `blocked_info` is the row of BLOCKED_REQ's results, and `total` the
+    total number of requests, for the period from `start` to `endtime`.
+    """
+    blocked = blocked_info["blocked"]
+    ip = blocked_info["ip"]
+    ip_percentage = blocked_info["ip_percentage"]
+    request_user_agent = blocked_info["request_user_agent"]
+    message = blocked_info["message"]
+    message_percentage = blocked_info["message_percentage"]
+    request_user_agent_percentage = (
+        blocked_info["request_user_agent_percentage"]
+    )
+    date = endtime.date()
+
     percentage = float(100 * float(blocked) / float(total))
 
     start_time = start.strftime("%H:%M")
     end_time = endtime.strftime("%H:%M")
 
     if percentage > SPIKE_PERCENTAGE:
-        msg = """
+        return """
         :exclamation: *Spike in WAF blocking* :exclamation:
         *Date and Time:* {date} {start_time} - {end_time}
         *Blocked requests:* {percentage:.2f}% ({blocked} / {total})
@@ -149,8 +161,7 @@ def waf_detect(endtime):
             start_time=start_time,
             end_time=end_time,
         )
-
-        alertlib.Alert(msg).send_to_slack(ALERT_CHANNEL)
+    return None
 
 
 def main():
@@ -1,38 +1,920 @@
 #!/usr/bin/env python3
 
-"""Read a UDP packet on a given port and log it to a logfile."""
+"""Read a UDP packet on a given port and log it to a logfile.
 
+Each packet is logged on its own line, as the time, the sender's ip,
+and the packet's bytes as we got them (except for newlines; see
+_LogWriter).  With --rotate-bytes or --rotate-interval, we start a new
+logfile every so often, and compress the old ones in the background;
+--keep says how many of those to keep.  With --workers N, we receive
+packets in N processes, to use N cpus; see udp_logger_merge.py for
+combining the files they log to.
+
+With --detect, we also look for DoS attacks in the packets as they come
+in, assuming they are fastly log lines (a json object, possibly after a
+syslog header), and alert like gae_dashboard/dos_alert.py does -- but
+within seconds, rather than after the next cron run and however long it
+takes the logs to get to BigQuery.
+"""
+
+import argparse
+import asyncio
+import contextlib
 import datetime
+import functools
+import gzip
+import heapq
+import json
+import multiprocessing
+import os
+import queue
+import re
+import select
+import shutil
+import signal
 import socket
+import sys
+import threading
+import time
+
+try:
+    import zstandard
+except ImportError:
+    # Then we can only compress old logfiles with gzip.
+    zstandard = None
+
+
+def _import_dos_alert():
+    """dos_alert has the thresholds and alert messages we use for --detect.
+
+    It lives in gae_dashboard/, along with the alertlib it needs, so we
+    only import it if we're asked to --detect.
+    """
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(
+        __file__)), 'gae_dashboard'))
+    import dos_alert
+    return dos_alert
+
+
+class SpaceSaving(object):
+    """Approximate counts of the most common keys, in bounded memory.
+
+    This is the "space-saving" heavy-hitters algorithm: we keep counts
+    for at most `capacity` keys.  When we see a new key and we're full,
+    it takes the place of the key with the smallest count, and inherits
+    that count.  So counts can be too high, but never too low, and any
+    key that is more than 1/capacity of all we've seen is guaranteed to
+    be here.
+
+    To find the smallest count without keeping the keys sorted, we keep
+    a heap with an entry (count, key) for each key, but don't update it
+    when we count a key again: then each entry's count is at most the
+    key's real count.  So when the smallest entry's count is out of date
+    we put it back with the right count, and look again; when it isn't,
+    it's the smallest of all.
+    """
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.counts = {}
+        self._heap = []
+        # Breaks ties between heap entries with the same count, so we
+        # never compare keys, which may not be comparable.
+        self._entry_number = 0
+
+    def _push(self, key, count):
+        self._entry_number += 1
+        heapq.heappush(self._heap, (count, self._entry_number, key))
+
+    def add(self, key):
+        if key in self.counts:
+            self.counts[key] += 1
+            return
+        if len(self.counts) < self.capacity:
+            self.counts[key] = 1
+            self._push(key, 1)
+            return
+        while True:
+            (count, _, evicted_key) = heapq.heappop(self._heap)
+            if self.counts[evicted_key] == count:
+                break
+            self._push(evicted_key, self.counts[evicted_key])
+        self.counts[key] = self.counts.pop(evicted_key) + 1
+        self._push(key, self.counts[key])
+
+
+class StreamingDosDetector(object):
+    """Does what dos_alert's checks do, but continuously, on log lines.
+
+    We count each minute's log lines in a SpaceSaving per check, so
+    memory stays bounded no matter how many clients we see, and every
+    `check_interval` seconds we add up the last DOS_PERIOD worth of
+    minutes and alert on anything over dos_alert's thresholds.
+
+    Unlike the BigQuery checks, we can't group a request's log lines
+    together (we'd have to remember every request id), so we count the
+    lines fastly logs at the edge (when it tells us which those are) that
+    weren't cache hits.  We don't alert on the same thing more than once
+    per DOS_PERIOD.
+
+    Alerts are sent to slack from a background thread, so a slow slack
+    doesn't keep us from reading packets.
+    """
+    def __init__(self, sketch_size=10000, check_interval=10, dry_run=False):
+        self.dos_alert = _import_dos_alert()
+        self.sketch_size = sketch_size
+        self.check_interval = check_interval
+        self.dry_run = dry_run
+        self.num_unparseable = 0
+
+        # minute -> SpaceSaving of (ip, url, user-agent) for dos_detect,
+        # SpaceSaving of ip for scratchpad_detect, and [traffic, errors]
+        # for cdn_error_detect.
+        self._minutes = {}
+        self._next_check = 0
+        # What we've alerted on -> when we can alert on it again.
+        self._snoozed = {}
+        # (message, channel) pairs for _send_alerts to send to slack.
+        self._alerts = queue.Queue()
+        self._alert_sender = None
+
+    @staticmethod
+    def _parse(line):
+        """Parse a fastly log line, or return None if we can't."""
+        json_start = line.find('{')
+        if json_start == -1:
+            return None
+        try:
+            row = json.loads(line[json_start:])
+        except ValueError:
+            return None
+        return row if isinstance(row, dict) else None
+
+    @staticmethod
+    def _fields(row):
+        """The fields of a parsed log line we look at, as the types we want.
+
+        Returns (client_ip, url, user_agent, status, at_edge_node,
+        time_elapsed), or raises ValueError if a field has a value we
+        can't use.
+        """
+        def str_or_none(name):
+            value = row.get(name)
+            if value is not None and not isinstance(value, str):
+                raise ValueError('%s is %r, not a string' % (name, value))
+            return value
+
+        try:
+            time_elapsed = int(float(row.get('time_elapsed') or 0))
+        except (TypeError, OverflowError) as e:
+            raise ValueError('time_elapsed is %r: %s'
+                             % (row.get('time_elapsed'), e))
+        return (str_or_none('client_ip'),
+                str_or_none('url') or '',
+                str_or_none('request_user_agent'),
+                str(row.get('status')),
+                str(row.get('at_edge_node', True)).lower() in ('true', '1'),
+                time_elapsed)
+
+    def _counts_for(self, minute):
+        counts = self._minutes.get(minute)
+        if counts is None:
+            counts = self._minutes[minute] = (SpaceSaving(self.sketch_size),
+                                              SpaceSaving(self.sketch_size),
+                                              [0, 0])
+            # We only need DOS_PERIOD (and a minute) of these.
+            oldest = minute - self._num_minutes()
+            for old_minute in [m for m in self._minutes if m < oldest]:
+                del self._minutes[old_minute]
+        return counts
+
+    def _num_minutes(self):
+        return max(self.dos_alert.DOS_PERIOD,
+                   self.dos_alert.SCRATCHPAD_PERIOD,
+                   self.dos_alert.CDN_ERROR_PERIOD) // 60
+
+    def add_packet(self, data, now=None):
+        if now is None:
+            now = time.time()
+        (dos_counts, scratchpad_counts, cdn_counts) = self._counts_for(
+            int(now // 60))
+        for line in data.decode('utf-8', 'replace').splitlines():
+            row = self._parse(line)
+            try:
+                if row is None:
+                    raise ValueError('not a json object')
+                (client_ip, url, user_agent, status, at_edge_node,
+                 time_elapsed) = self._fields(row)
+            except ValueError:
+                self.num_unparseable += 1
+                continue
+
+            if at_edge_node:
+                cdn_counts[0] += 1
+                if status == '503' and row.get('request_id') in (None,
+                                                                 '(null)'):
+                    cdn_counts[1] += 1
+                if (status == '200' and row.get('request') == 'POST'
+                        and url.startswith('/api/internal/scratchpads')):
+                    scratchpad_counts.add(client_ip)
+
+            # See dos_alert.QUERY_TEMPLATE for what we skip, and why.
+            if (at_edge_node
+                    and row.get('cache_status') != 'HIT'
+                    and status != '308'
+                    and url[:5] != '/_ah/'
+                    and 'countBrandNewNotifications' not in url
+                    and not (status == '403' and time_elapsed <= 500)):
+                dos_counts.add((client_ip, url, user_agent))
+
+        if now >= self._next_check:
+            self.check(now)
+            self._next_check = now + self.check_interval
+
+    def _recent_minutes(self, now, period):
+        current_minute = int(now // 60)
+        return [self._minutes[m]
+                for m in range(current_minute - period // 60 + 1,
+                               current_minute + 1)
+                if m in self._minutes]
+
+    def _not_snoozed(self, key, now):
+        if self._snoozed.get(key, 0) > now:
+            return False
+        self._snoozed[key] = now + self.dos_alert.DOS_PERIOD
+        return True
+
+    def check(self, now):
+        """Alert on anything over dos_alert's thresholds, as of `now`."""
+        dos_alert = self.dos_alert
+        for (key, until) in list(self._snoozed.items()):
+            if until <= now:
+                del self._snoozed[key]
+
+        dos_totals = {}
+        for (dos_counts, _, _) in self._recent_minutes(now,
+                                                       dos_alert.DOS_PERIOD):
+            for (key, count) in dos_counts.counts.items():
+                dos_totals[key] = dos_totals.get(key, 0) + count
+        dos_results = []
+        for ((ip, url, user_agent), count) in sorted(
+                dos_totals.items(), key=lambda kv: kv[1], reverse=True):
+            max_reqs_sec = dos_alert.dos_max_reqs_sec(url)
+            if (max_reqs_sec is not None
+                    and count > max_reqs_sec * dos_alert.DOS_PERIOD
+                    and self._not_snoozed(('dos', ip, url, user_agent), now)):
+                dos_results.append({'ip': ip, 'url': url,
+                                    'user_agent': user_agent,
+                                    'count': count})
+
+        scratchpad_totals = {}
+        for (_, scratchpad_counts, _) in self._recent_minutes(
+                now, dos_alert.SCRATCHPAD_PERIOD):
+            for (ip, count) in scratchpad_counts.counts.items():
+                scratchpad_totals[ip] = scratchpad_totals.get(ip, 0) + count
+        scratchpad_results = [
+            {'ip': ip, 'count': count}
+            for (ip, count) in sorted(scratchpad_totals.items(),
+                                      key=lambda kv: kv[1], reverse=True)
+            if (count > dos_alert.MAX_SCRATCHPADS
+                and self._not_snoozed(('scratchpad', ip), now))]
+
+        cdn_results = []
+        current_minute = int(now // 60)
+        for minute in sorted(self._minutes):
+            if minute <= current_minute - dos_alert.CDN_ERROR_PERIOD // 60:
+                continue
+            (traffic_count, err_count) = self._minutes[minute][2]
+            if (err_count > dos_alert.MAX_CDN_ERROR
+                    and err_count > dos_alert.MAX_CDN_PERCENT * traffic_count
+                    and self._not_snoozed(('cdn_error', minute), now)):
+                cdn_results.append({
+                    'minute_bucket': datetime.datetime.utcfromtimestamp(
+                        minute * 60).strftime(dos_alert.TS_FORMAT),
+                    'traffic_count': traffic_count,
+                    'err_count': err_count})
+
+        for (msg, channel) in (
+                (dos_alert.dos_alert_message(dos_results),
+                 dos_alert.ALERT_CHANNEL_SECURITY),
+                (dos_alert.scratchpad_alert_message(scratchpad_results),
+                 dos_alert.ALERT_CHANNEL_SECURITY),
+                (dos_alert.cdn_error_alert_message(cdn_results),
+                 dos_alert.ALERT_CHANNEL_SRE)):
+            if not msg:
+                continue
+            if self.dry_run:
+                sys.stderr.write("WOULD SEND TO %s:\n%s\n" % (channel, msg))
+            else:
+                self._send_alert(msg, channel)
+
+    def _send_alert(self, msg, channel):
+        if self._alert_sender is None:
+            self._alert_sender = threading.Thread(target=self._send_alerts,
+                                                  daemon=True)
+            self._alert_sender.start()
+        self._alerts.put((msg, channel))
+
+    def _send_alerts(self):
+        while True:
+            (msg, channel) = self._alerts.get()
+            try:
+                self.dos_alert.alertlib.Alert(msg).send_to_slack(channel)
+            except Exception as e:
+                sys.stderr.write("Error sending alert to %s: %s\n"
+                                 % (channel, e))
+
+
+# The biggest a UDP packet can be (over IPv4).  Anything bigger than
+# --max-packet-size is truncated, and counted as such.
+_MAX_PACKET_SIZE = 65507
+
+
+def _kernel_drops(sock):
+    """How many packets the kernel has dropped for this socket, or None.
+
+    That's when its receive buffer (see SO_RCVBUF) fills up because we
+    aren't reading fast enough.  We only know how to tell on Linux.
+    """
+    inode = str(os.fstat(sock.fileno()).st_ino)
+    for filename in ('/proc/net/udp', '/proc/net/udp6'):
+        try:
+            with open(filename) as f:
+                for line in f:
+                    fields = line.split()
+                    # The fields are: ... uid timeout inode ref pointer drops
+                    if len(fields) >= 13 and fields[9] == inode:
+                        return int(fields[12])
+        except (IOError, OSError):
+            pass
+    return None
+
+
+class _Stats(object):
+    def __init__(self):
+        self.packets = 0
+        self.bytes = 0
+        self.truncated = 0
+        # Packets we dropped ourselves, because we couldn't write them out
+        # fast enough.
+        self.dropped = 0
+
+    def report(self, name, sock):
+        dropped_by_kernel = _kernel_drops(sock)
+        sys.stderr.write(
+            "udp_logger %s: %d packets (%d bytes) received, %d truncated, "
+            "%d dropped by us, %s dropped by the kernel\n"
+            % (name, self.packets, self.bytes, self.truncated, self.dropped,
+               "unknown" if dropped_by_kernel is None else dropped_by_kernel))
+        sys.stderr.flush()
+
+
+class RotatingLogFile(object):
+    """A binary logfile that we move aside, and compress, every so often.
+
+    Once `path` has `max_bytes` in it, or it's been open for
+    `rotate_interval` seconds, we rename it to path.YYYYMMDD-HHMMSS and
+    start a new one.  A background thread then compresses the old one,
+    with `compress` ("gzip" or "zstd", or None to leave it be), and
+    deletes all but the newest `keep` old logfiles.  None for max_bytes,
+    rotate_interval or keep means no limit.
+
+    We only rotate between lines, so a logfile only goes over max_bytes
+    if a single line is longer than that.
+    """
+    def __init__(self, path, max_bytes=None, rotate_interval=None,
+                 compress='gzip', keep=None):
+        if compress == 'zstd' and zstandard is None:
+            raise ValueError('Compressing with zstd needs the zstandard '
+                             'module; pip install zstandard')
+        self.path = path
+        self.max_bytes = max_bytes
+        self.rotate_interval = rotate_interval
+        self.compress = compress
+        self.keep = keep
+        self._compressors = []
+        # We compress and prune one old logfile at a time, so that we
+        # don't prune a logfile while another thread is compressing it.
+        self._compress_lock = threading.Lock()
+        # The name we last rotated to, and how many times we've added a
+        # number to it; see rotate().
+        self._last_base_path = None
+        self._last_seq = None
+        self._open()
+
+    def _open(self):
+        self._file = open(self.path, 'ab')
+        self._size = self._file.tell()
+        self._opened = time.time()
+
+    def write(self, data):
+        """Write `data`, which should be whole lines."""
+        if self._size and self.rotate_interval and (
+                time.time() - self._opened >= self.rotate_interval):
+            self.rotate()
+        while self.max_bytes and self._size + len(data) > self.max_bytes:
+            # Write as many whole lines as fit, and start a new logfile
+            # for the rest.
+            end = data.rfind(b'\n', 0, self.max_bytes - self._size) + 1
+            if not end and not self._size:
+                # Not even one line fits in an empty logfile, so the
+                # first line gets one to itself.
+                end = data.find(b'\n') + 1 or len(data)
+            self._file.write(data[:end])
+            self._size += end
+            data = data[end:]
+            self.rotate()
+        if data:
+            self._file.write(data)
+            self._size += len(data)
+
+    def flush(self):
+        self._file.flush()
+
+    def rotate(self):
+        self._file.close()
+        base_path = '%s.%s' % (self.path, time.strftime(
+            '%Y%m%d-%H%M%S', time.gmtime(self._opened)))
+        # If we rotate more than once a second, keep the names unique,
+        # and in order.  We can't just look for a free name: by now we
+        # may have pruned the older logfiles of this second.
+        seq = self._last_seq + 1 if base_path == self._last_base_path else 0
+        while any(os.path.exists(self._numbered(base_path, seq) + suffix)
+                  for suffix in ('', '.gz', '.zst')):
+            seq += 1
+        old_path = self._numbered(base_path, seq)
+        self._last_base_path = base_path
+        self._last_seq = seq
+        os.rename(self.path, old_path)
+        self._open()
 
+        self._compressors = [t for t in self._compressors if t.is_alive()]
+        compressor = threading.Thread(target=self._compress_and_prune,
+                                      args=(old_path,))
+        compressor.start()
+        self._compressors.append(compressor)
 
-def listen_and_log(interface, port, logfile):
-    """interface should be "127.0.0.1", or "0.0.0.0"."""
+    @staticmethod
+    def _numbered(base_path, seq):
+        return '%s-%d' % (base_path, seq) if seq else base_path
+
+    def _compress_and_prune(self, old_path):
+        with self._compress_lock:
+            if os.path.exists(old_path):
+                self._compress(old_path)
+            # (Otherwise, we pruned it already.)
+            if self.keep is not None:
+                self._prune()
+
+    def _compress(self, old_path):
+        if self.compress == 'gzip':
+            with open(old_path, 'rb') as f_in:
+                with gzip.open(old_path + '.gz.tmp', 'wb') as f_out:
+                    shutil.copyfileobj(f_in, f_out)
+            os.rename(old_path + '.gz.tmp', old_path + '.gz')
+            os.unlink(old_path)
+        elif self.compress == 'zstd':
+            with open(old_path, 'rb') as f_in:
+                with open(old_path + '.zst.tmp', 'wb') as f_out:
+                    zstandard.ZstdCompressor().copy_stream(f_in, f_out)
+            os.rename(old_path + '.zst.tmp', old_path + '.zst')
+            os.unlink(old_path)
+
+    def _prune(self):
+        dirname = os.path.dirname(self.path) or '.'
+        old_log_re = re.compile(
+            r'%s\.(\d{8}-\d{6})(?:-(\d+))?(\.gz|\.zst)?$'
+            % re.escape(os.path.basename(self.path)))
+        matches = [old_log_re.match(f) for f in os.listdir(dirname)]
+        # Oldest first: by the time in the name, then by the number we
+        # added if we rotated more than once that second.
+        old_logs = [m.group(0) for m in sorted(
+            (m for m in matches if m),
+            key=lambda m: (m.group(1), int(m.group(2) or 0)))]
+        for f in old_logs[:max(len(old_logs) - self.keep, 0)]:
+            os.unlink(os.path.join(dirname, f))
+
+    def close(self):
+        self._file.close()
+        for compressor in self._compressors:
+            compressor.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class _LogWriter(object):
+    """Buffers the lines we log for packets, and writes them to a logfile.
+
+    `logfile` should be opened in binary mode: we write the packets as
+    the bytes we got, after the time and the sender's ip.  So that each
+    packet is one line, we drop a newline at the end of a packet, and
+    write any other newlines in it as a backslash and an 'n'.
+
+    Lines are written out when flush() is called, which callers should
+    do when should_flush() says to: every `flush_interval` seconds, or
+    whenever we have `flush_bytes` to write.  (A flush_interval of 0
+    means every time.)
+    """
+    def __init__(self, logfile, flush_interval=1.0, flush_bytes=64 * 1024):
+        self.logfile = logfile
+        self.flush_interval = flush_interval
+        self.flush_bytes = flush_bytes
+        self.stats = _Stats()
+        self.pending_bytes = 0
+        self._pending = []
+        self._last_flush = time.time()
+        self._timestamp_second = None
+        self._timestamp = None
+
+    def add(self, data, ip, now):
+        # We only format the time once a second.
+        if int(now) != self._timestamp_second:
+            self._timestamp_second = int(now)
+            self._timestamp = time.strftime(
+                "%Y-%m-%dT%H:%M:%SZ ",
+                time.gmtime(self._timestamp_second)).encode('ascii')
+        if data.endswith(b'\n'):
+            data = data[:-1]
+        if b'\n' in data:
+            data = data.replace(b'\n', b'\\n')
+        line = b''.join((self._timestamp, ip.encode('ascii'), b' ', data,
+                         b'\n'))
+        self._pending.append(line)
+        self.pending_bytes += len(line)
+
+    def should_flush(self, now):
+        return self._pending and (
+            self.pending_bytes >= self.flush_bytes
+            or now - self._last_flush >= self.flush_interval)
+
+    def take_pending(self):
+        """Return what we need to write, and forget about it."""
+        data = b''.join(self._pending)
+        self._pending = []
+        self.pending_bytes = 0
+        self._last_flush = time.time()
+        return data
+
+    def write(self, data):
+        self.logfile.write(data)
+        self.logfile.flush()
+
+    def flush(self):
+        self.write(self.take_pending())
+
+
+def listen_and_log(interface, port, logfile, detector=None,
+                   max_packet_size=_MAX_PACKET_SIZE, rcvbuf=None,
+                   flush_interval=1.0, flush_bytes=64 * 1024,
+                   stats_interval=60, reuse_port=False):
+    """interface should be "127.0.0.1", or "0.0.0.0".
+
+    If `detector` is not None, we also pass it each packet.
+
+    To keep up with lots of packets, each time we wake up we read all
+    the packets that are waiting (without blocking), and we buffer what
+    we write to `logfile`, flushing it every `flush_interval` seconds, or
+    whenever we have `flush_bytes` to write.  (A flush_interval of 0
+    flushes after every packet.)  `rcvbuf`, if set, is how much the
+    kernel should buffer for us (SO_RCVBUF) while we're busy; if it
+    fills up, the kernel drops packets.  Every `stats_interval` seconds,
+    we say on stderr how many packets we've seen, and how many were
+    truncated or dropped.
+
+    With `reuse_port`, other processes can listen on the same port too
+    (SO_REUSEPORT), and the kernel will share the packets between us.
+    """
     sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    if rcvbuf:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, rcvbuf)
+    if reuse_port:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
     sock.bind((interface, port))
-    while True:
-        (data, (ip, port)) = sock.recvfrom(1024)  # buffer size is 1024 bytes
-        now = datetime.datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%SZ")
-        logfile.write("%s %s %s\n" % (now, ip, data))
-        logfile.flush()
 
+    buf = bytearray(max_packet_size)
+    writer = _LogWriter(logfile, flush_interval, flush_bytes)
+    last_stats = time.time()
+    try:
+        while True:
+            # Wait for a packet, but not so long that we don't flush in
+            # time.
+            select.select([sock], [], [], flush_interval or None)
+            now = time.time()
+            while True:
+                try:
+                    # With MSG_TRUNC, we're told the packet's real size
+                    # even if it didn't all fit in buf.
+                    (size, (ip, _)) = sock.recvfrom_into(
+                        buf, 0, socket.MSG_DONTWAIT | socket.MSG_TRUNC)
+                except BlockingIOError:
+                    break
+                writer.stats.packets += 1
+                writer.stats.bytes += size
+                if size > max_packet_size:
+                    writer.stats.truncated += 1
+                    size = max_packet_size
+                data = bytes(buf[:size])
+                writer.add(data, ip, now)
+                if detector:
+                    detector.add_packet(data, now)
+
+            if writer.should_flush(now):
+                writer.flush()
+            if stats_interval and now - last_stats >= stats_interval:
+                writer.stats.report(port, sock)
+                last_stats = now
+    finally:
+        # Don't lose what we've buffered, if we're interrupted.
+        writer.flush()
+
+
+def worker_logfile(logfile, worker):
+    """The file that worker number `worker` logs to, with --workers."""
+    return '%s.worker%d' % (logfile, worker)
+
+
+def _listen_and_log_worker(interface, port, logfile, open_logfile, kwargs):
+    # We let the parent decide when we're done, which it tells us with
+    # SIGTERM; exiting lets listen_and_log() write out what it has.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, lambda *args: sys.exit(0))
+    with open_logfile(logfile) as f:
+        listen_and_log(interface, port, f, reuse_port=True, **kwargs)
 
-if __name__ == '__main__':
-    import argparse
-    import sys
 
+def listen_and_log_workers(num_workers, interface, port, logfile,
+                           open_logfile, **kwargs):
+    """Run listen_and_log() in `num_workers` processes, on the same port.
+
+    The kernel shares the packets between the processes, so we can use
+    more than one cpu.  Each process logs to its own file,
+    worker_logfile(logfile, i); use udp_logger_merge.py to combine them.
+    `open_logfile` is a function that takes a filename and returns a
+    context manager for the file to write to.  `kwargs` are passed to
+    listen_and_log().  We return when we get SIGTERM or SIGINT, after
+    stopping the workers, or when any worker dies.
+    """
+    workers = [
+        multiprocessing.Process(
+            target=_listen_and_log_worker,
+            args=(interface, port, worker_logfile(logfile, i), open_logfile,
+                  kwargs))
+        for i in range(num_workers)]
+    for worker in workers:
+        worker.start()
+
+    stop = threading.Event()
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        signal.signal(signum, lambda *args: stop.set())
+    while not stop.is_set() and all(w.is_alive() for w in workers):
+        stop.wait(1)
+
+    for worker in workers:
+        worker.terminate()
+    for worker in workers:
+        worker.join()
+
+
+class _LoggingProtocol(asyncio.DatagramProtocol):
+    """Logs the packets we get on one port, for serve()."""
+    def __init__(self, sock, writer, detector, max_pending_bytes):
+        self.sock = sock
+        self.writer = writer
+        self.detector = detector
+        self.max_pending_bytes = max_pending_bytes
+        self.transport = None
+        self._flushing = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        stats = self.writer.stats
+        stats.packets += 1
+        stats.bytes += len(data)
+        # If we can't write as fast as packets come in, we have to drop
+        # some; better here than running out of memory.
+        if self.writer.pending_bytes >= self.max_pending_bytes:
+            stats.dropped += 1
+            return
+        now = time.time()
+        self.writer.add(data, addr[0], now)
+        if self.detector:
+            self.detector.add_packet(data, now)
+        if self.writer.pending_bytes >= self.writer.flush_bytes:
+            self.start_flush()
+
+    def drain(self):
+        """Handle the packets the kernel has for us, without waiting."""
+        while True:
+            try:
+                (data, addr) = self.sock.recvfrom(_MAX_PACKET_SIZE,
+                                                  socket.MSG_DONTWAIT)
+            except BlockingIOError:
+                return
+            self.datagram_received(data, addr)
+
+    def start_flush(self):
+        """Write out what we have, in a thread, so we keep receiving.
+
+        We only write one batch at a time, so the lines stay in order.
+        Returns a future for when the write is done, or None if there's
+        nothing to write.
+        """
+        if self._flushing is not None and not self._flushing.done():
+            return self._flushing
+        if not self.writer.pending_bytes:
+            return None
+        loop = asyncio.get_running_loop()
+        self._flushing = loop.run_in_executor(None, self.writer.write,
+                                              self.writer.take_pending())
+        return self._flushing
+
+
+async def serve(listeners, detector=None, rcvbuf=None, flush_interval=1.0,
+                flush_bytes=64 * 1024, max_pending_bytes=64 * 1024 * 1024,
+                stats_interval=60):
+    """Log packets from many ports at once, until we get SIGTERM or SIGINT.
+
+    `listeners` is a list of (interface, port, logfile) triples; each
+    port's packets go to its own logfile, which has its own buffer, which
+    is written out in its own thread, so one slow disk doesn't hold up
+    the others.  If a port's buffer gets to `max_pending_bytes` (because
+    we can't write it out fast enough), we drop its packets until it's
+    written out.  `rcvbuf` and `stats_interval` are as for
+    listen_and_log().  When we're told to stop, we write out everything
+    we've got before returning.
+    """
+    loop = asyncio.get_running_loop()
+    stop = asyncio.Event()
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(signum, stop.set)
+
+    protocols = []
+    for (interface, port, logfile) in listeners:
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        if rcvbuf:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, rcvbuf)
+        sock.bind((interface, port))
+        writer = _LogWriter(logfile, flush_interval, flush_bytes)
+        (_, protocol) = await loop.create_datagram_endpoint(
+            lambda: _LoggingProtocol(sock, writer, detector,
+                                     max_pending_bytes),
+            sock=sock)
+        protocols.append((port, protocol))
+
+    last_stats = time.time()
+    while not stop.is_set():
+        try:
+            await asyncio.wait_for(stop.wait(), flush_interval or 1.0)
+        except asyncio.TimeoutError:
+            pass
+        now = time.time()
+        for (_, protocol) in protocols:
+            if protocol.writer.should_flush(now):
+                protocol.start_flush()
+        if stats_interval and now - last_stats >= stats_interval:
+            for (port, protocol) in protocols:
+                protocol.writer.stats.report(port, protocol.sock)
+            last_stats = now
+
+    for (_, protocol) in protocols:
+        protocol.drain()
+        protocol.transport.close()
+    # Wait for any writes in progress, then write out the rest.
+    for (_, protocol) in protocols:
+        while True:
+            flushing = protocol.start_flush()
+            if flushing is None:
+                break
+            await flushing
+
+
+def _parse_listener(value):
+    """Parse an --listen value, of the form [INTERFACE:]PORT:LOGFILE."""
+    parts = value.split(':', 2)
+    if len(parts) == 2:
+        parts.insert(0, '0.0.0.0')
+    if len(parts) != 3 or not parts[1].isdigit():
+        raise argparse.ArgumentTypeError(
+            'expected [INTERFACE:]PORT:LOGFILE, not %r' % value)
+    return (parts[0], int(parts[1]), parts[2])
+
+
+if __name__ == '__main__':
     parser = argparse.ArgumentParser()
-    parser.add_argument('logfile',
+    parser.add_argument('logfile', nargs='?',
                         help=('The logfile to write the UDP packets to, '
                               'or "-" for stdout'))
     parser.add_argument('-p', '--port', type=int, default=60000,
                         help='The port to listen on (default: %(default)s)')
     parser.add_argument('-i', '--interface', default='0.0.0.0',
                         help='The interface to listen to; 127.0.0.1 is safest')
+    parser.add_argument('--listen', action='append', type=_parse_listener,
+                        metavar='[INTERFACE:]PORT:LOGFILE',
+                        help=('Log the packets on PORT to LOGFILE; can be '
+                              'given many times, to listen on many ports '
+                              'at once.  Use this instead of a logfile, '
+                              '-p and -i.'))
+    parser.add_argument('--workers', type=int, default=1,
+                        help=('How many processes to receive packets in; '
+                              'with more than one, worker N logs to '
+                              'LOGFILE.workerN (default: %(default)s)'))
+    parser.add_argument('--detect', action='store_true',
+                        help=('Look for DoS attacks in the packets, which '
+                              'should be fastly log lines'))
+    parser.add_argument('--detect-dry-run', action='store_true',
+                        help=('With --detect, print alerts to stderr '
+                              'instead of sending them to slack'))
+    parser.add_argument('--sketch-size', type=int, default=10000,
+                        help=('With --detect, how many clients to keep '
+                              'counts for, per minute (default: '
+                              '%(default)s)'))
+    parser.add_argument('--max-packet-size', type=int,
+                        default=_MAX_PACKET_SIZE,
+                        help=('Packets bigger than this are truncated '
+                              '(default: %(default)s)'))
+    parser.add_argument('--rcvbuf', type=int, default=None,
+                        help=('How many bytes of packets the kernel should '
+                              'buffer for us (default: the system default)'))
+    parser.add_argument('--flush-interval', type=float, default=1.0,
+                        help=('Flush the logfile at least this often, in '
+                              'seconds; 0 flushes after every packet '
+                              '(default: %(default)s)'))
+    parser.add_argument('--rotate-bytes', type=int, default=None,
+                        help=('Start a new logfile once the current one '
+                              'has this many bytes (default: never)'))
+    parser.add_argument('--rotate-interval', type=float, default=None,
+                        help=('Start a new logfile once the current one '
+                              'is this many seconds old (default: never)'))
+    parser.add_argument('--compress', choices=('gzip', 'zstd', 'none'),
+                        default='gzip',
+                        help=('How to compress old logfiles (default: '
+                              '%(default)s)'))
+    parser.add_argument('--keep', type=int, default=None,
+                        help=('How many old logfiles to keep (default: '
+                              'all of them)'))
+    parser.add_argument('--stats-interval', type=float, default=60,
+                        help=('Report packet counts to stderr this often, '
+                              'in seconds; 0 to never (default: '
+                              '%(default)s)'))
     args = parser.parse_args()
 
-    if args.logfile == '-':
-        listen_and_log(args.interface, args.port, sys.stdout)
+    detector = None
+    if args.detect:
+        detector = StreamingDosDetector(sketch_size=args.sketch_size,
+                                        dry_run=args.detect_dry_run)
+
+    if args.compress == 'zstd' and zstandard is None:
+        parser.error('--compress zstd needs the zstandard module; '
+                     'pip install zstandard')
+
+    open_rotating_logfile = functools.partial(
+        RotatingLogFile, max_bytes=args.rotate_bytes,
+        rotate_interval=args.rotate_interval,
+        compress=None if args.compress == 'none' else args.compress,
+        keep=args.keep)
+
+    def open_logfile(logfile):
+        if logfile == '-':
+            return contextlib.nullcontext(sys.stdout.buffer)
+        return open_rotating_logfile(logfile)
+
+    if args.listen:
+        if args.logfile:
+            parser.error('Give either a logfile or --listen, not both')
+        if args.workers > 1:
+            parser.error('--workers does not work with --listen')
+        with contextlib.ExitStack() as files:
+            listeners = [
+                (interface, port, files.enter_context(open_logfile(logfile)))
+                for (interface, port, logfile) in args.listen]
+            asyncio.run(serve(listeners, detector, rcvbuf=args.rcvbuf,
+                              flush_interval=args.flush_interval,
+                              stats_interval=args.stats_interval))
+        sys.exit(0)
+    if not args.logfile:
+        parser.error('Give a logfile, or --listen')
+
+    kwargs = {'detector': detector,
+              'max_packet_size': args.max_packet_size,
+              'rcvbuf': args.rcvbuf,
+              'flush_interval': args.flush_interval,
+              'stats_interval': args.stats_interval}
+    if args.workers > 1:
+        if args.logfile == '-':
+            parser.error('With --workers, give a logfile, not "-"')
+        if args.detect:
+            parser.error('--detect needs to see every packet, so it '
+                         'does not work with --workers')
+        listen_and_log_workers(args.workers, args.interface, args.port,
+                               args.logfile, open_rotating_logfile, **kwargs)
     else:
-        with open(args.logfile, 'a') as f:
-            listen_and_log(args.interface, args.port, f)
+        # Exiting on SIGTERM lets listen_and_log() write out what it has
+        # buffered, and the logfile be closed properly.
+        signal.signal(signal.SIGTERM, lambda *args: sys.exit(0))
+        with open_logfile(args.logfile) as f:
+            listen_and_log(args.interface, args.port, f, **kwargs)
@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+
+"""Blast UDP packets at a local udp_logger, and see how many it logs.
+
+This starts udp_logger.py on a local port, sends it packets as fast as
+we can, waits for it to write them out, and reports how many of the
+packets made it into the logfile, and how fast.  Any arguments after
+"--" are passed to udp_logger.py, so you can compare settings:
+   ./udp_logger_benchmark.py --packets 200000
+   ./udp_logger_benchmark.py --packets 200000 -- --flush-interval 0
+   ./udp_logger_benchmark.py --senders 4 -- --rcvbuf 8388608
+   ./udp_logger_benchmark.py --senders 4 -- --workers 4
+"""
+
+import argparse
+import glob
+import multiprocessing
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+
+def _free_port():
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def _send(port, num_packets, packet_size):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    packet = b'x' * packet_size
+    for _ in range(num_packets):
+        sock.sendto(packet, ('127.0.0.1', port))
+
+
+def _count_lines(filename):
+    with open(filename, 'rb') as f:
+        return sum(chunk.count(b'\n')
+                   for chunk in iter(lambda: f.read(1 << 20), b''))
+
+
+def _logfiles(logfile):
+    """The files udp_logger logs to; with --workers, there's one each."""
+    return [logfile] + glob.glob(logfile + '.worker*')
+
+
+def main(num_packets, packet_size, num_senders, logger_args):
+    port = _free_port()
+    (fd, logfile) = tempfile.mkstemp(suffix='.log')
+    os.close(fd)
+    logger = subprocess.Popen(
+        [sys.executable,
+         os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                      'udp_logger.py'),
+         '-i', '127.0.0.1', '-p', str(port), '--stats-interval', '0',
+         logfile] + logger_args)
+    try:
+        time.sleep(1)     # give it time to start listening
+
+        start = time.time()
+        senders = [multiprocessing.Process(
+            target=_send, args=(port, num_packets // num_senders, packet_size))
+            for _ in range(num_senders)]
+        for sender in senders:
+            sender.start()
+        for sender in senders:
+            sender.join()
+        send_time = time.time() - start
+        num_sent = num_packets // num_senders * num_senders
+
+        # Wait for the logger to write out everything it's going to.
+        last_size = -1
+        while sum(os.path.getsize(f) for f in _logfiles(logfile)) != last_size:
+            last_size = sum(os.path.getsize(f) for f in _logfiles(logfile))
+            time.sleep(2)
+        num_logged = sum(_count_lines(f) for f in _logfiles(logfile))
+    finally:
+        logger.terminate()
+        logger.wait()
+        for f in _logfiles(logfile):
+            os.unlink(f)
+
+    print("Sent %d packets of %d bytes in %.2fs (%d/sec)"
+          % (num_sent, packet_size, send_time, num_sent / send_time))
+    print("Logged %d of them (%.1f%%)"
+          % (num_logged, 100.0 * num_logged / num_sent))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('--packets', type=int, default=100000,
+                        help='How many packets to send (default: %(default)s)')
+    parser.add_argument('--size', type=int, default=512,
+                        help='How big each packet is (default: %(default)s)')
+    parser.add_argument('--senders', type=int, default=1,
+                        help=('How many processes to send packets from '
+                              '(default: %(default)s)'))
+    parser.add_argument('logger_args', nargs='*',
+                        help='Arguments for udp_logger.py, after a "--"')
+    args = parser.parse_args()
+    main(args.packets, args.size, args.senders, args.logger_args)
@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+
+"""Combine udp_logger logfiles into one, in time order.
+
+With --workers, udp_logger logs each worker's packets to its own file,
+LOGFILE.workerN.  This merges files like that -- including old ones it
+rotated and compressed -- and writes the lines in time order to stdout:
+   ./udp_logger_merge.py /var/log/udp.log.worker* > /tmp/udp.log
+
+Each file is already in time order, so we only need to keep one line
+from each in memory.  Times are only to the second, so lines from the
+same second are in the order of the files we were given.
+
+You can give a logfile along with the old logfiles it was rotated to;
+we read those oldest first, then the logfile itself.
+"""
+
+import argparse
+import collections
+import gzip
+import heapq
+import itertools
+import re
+import sys
+
+try:
+    import zstandard
+except ImportError:
+    # Then we can only read gzipped logfiles.
+    zstandard = None
+
+
+# udp_logger's names for old logfiles end with this.
+_ROTATED_SUFFIX_RE = re.compile(
+    r'\.(\d{8}-\d{6})(?:-(\d+))?(?:\.gz|\.zst)?$')
+
+# Lines start with a time like 2020-01-02T12:00:00Z.
+_TIMESTAMP_LEN = len('2020-01-02T12:00:00Z')
+_TIMESTAMP_RE = re.compile(rb'\d{4}-\d\d-\d\dT\d\d:\d\d:\d\dZ ')
+
+
+def _read_lines(filename):
+    if filename.endswith('.gz'):
+        with gzip.open(filename, 'rb') as f:
+            yield from f
+    elif filename.endswith('.zst'):
+        if zstandard is None:
+            raise ValueError('Reading %s needs the zstandard module; '
+                             'pip install zstandard' % filename)
+        with open(filename, 'rb') as f:
+            with zstandard.ZstdDecompressor().stream_reader(f) as reader:
+                yield from _split_lines(reader)
+    else:
+        with open(filename, 'rb') as f:
+            yield from f
+
+
+def _split_lines(reader):
+    leftover = b''
+    for chunk in iter(lambda: reader.read(1 << 20), b''):
+        lines = (leftover + chunk).split(b'\n')
+        leftover = lines.pop()
+        for line in lines:
+            yield line + b'\n'
+    if leftover:
+        yield leftover
+
+
+def _records(lines):
+    """Yield the lines logged for each packet.
+
+    Older versions of udp_logger wrote a packet with a newline in it as
+    more than one line; the ones after the first don't start with a
+    time.  We keep those with the line before them.
+    """
+    record = None
+    for line in lines:
+        if record is not None and not _TIMESTAMP_RE.match(line):
+            record += line
+            continue
+        if record is not None:
+            yield record
+        record = line
+    if record is not None:
+        yield record
+
+
+def merge(filenames):
+    """Yield the lines of the given logfiles, in time order.
+
+    A logfile and the old logfiles udp_logger rotated it to are read one
+    after another, as though they were one file.  The lines for one
+    packet stay together; see _records().
+    """
+    by_logfile = collections.OrderedDict()
+    for filename in filenames:
+        m = _ROTATED_SUFFIX_RE.search(filename)
+        if m:
+            # The time it was rotated, and the number udp_logger added
+            # if it rotated more than once that second.
+            order = (0, m.group(1), int(m.group(2) or 0))
+            logfile = filename[:m.start()]
+        else:
+            order = (1,)
+            logfile = filename
+        by_logfile.setdefault(logfile, []).append((order, filename))
+
+    streams = [_records(itertools.chain.from_iterable(
+        _read_lines(f) for (_, f) in sorted(files)))
+        for files in by_logfile.values()]
+    return heapq.merge(*streams, key=lambda line: line[:_TIMESTAMP_LEN])
+
+
+def main(filenames):
+    out = sys.stdout.buffer
+    for line in merge(filenames):
+        out.write(line)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('logfiles', nargs='+',
+                        help='The logfiles to merge')
+    args = parser.parse_args()
+    main(args.logfiles)
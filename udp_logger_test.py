@@ -0,0 +1,258 @@
+import collections
+import gzip
+import json
+import os
+import random
+import re
+import shutil
+import tempfile
+import unittest
+
+import udp_logger
+import udp_logger_merge
+
+
+class TestSpaceSaving(unittest.TestCase):
+    def test_exact_under_capacity(self):
+        counts = udp_logger.SpaceSaving(3)
+        for key in 'abacab':
+            counts.add(key)
+        self.assertEqual({'a': 3, 'b': 2, 'c': 1}, counts.counts)
+
+    def test_evicts_smallest_count(self):
+        counts = udp_logger.SpaceSaving(2)
+        for key in 'aaab':
+            counts.add(key)
+        counts.add('c')
+        # 'c' takes the place of 'b', and gets its count, plus one.
+        self.assertEqual({'a': 3, 'c': 2}, counts.counts)
+        counts.add('a')
+        counts.add('d')
+        self.assertEqual({'a': 4, 'd': 3}, counts.counts)
+
+    def test_bounds(self):
+        rand = random.Random(42)
+        capacity = 10
+        keys = list(range(100))
+        weights = [1.0 / (i + 1) for i in keys]
+        counts = udp_logger.SpaceSaving(capacity)
+        real_counts = collections.Counter()
+        for n in range(1, 5001):
+            key = rand.choices(keys, weights)[0]
+            counts.add(key)
+            real_counts[key] += 1
+            if n % 100 == 0:
+                self.assertEqual(n, sum(counts.counts.values()))
+                for (key, count) in counts.counts.items():
+                    # Counts are never too low, and at most n/capacity
+                    # too high.
+                    self.assertGreaterEqual(count, real_counts[key])
+                    self.assertLessEqual(count - real_counts[key],
+                                         n / capacity)
+                for (key, real_count) in real_counts.items():
+                    if real_count > n / capacity:
+                        self.assertIn(key, counts.counts)
+
+
+def _log_line(**fields):
+    row = {'url': '/api/internal/user', 'status': 200,
+           'client_ip': '1.2.3.4', 'request_user_agent': 'curl',
+           'cache_status': 'MISS', 'at_edge_node': 'true',
+           'request': 'GET', 'time_elapsed': 100}
+    row.update(fields)
+    return '<134>2020-01-01T00:00:00Z cache-sjc fastly[1]: %s' % (
+        json.dumps(row))
+
+
+class TestStreamingDosDetector(unittest.TestCase):
+    def setUp(self):
+        self.detector = udp_logger.StreamingDosDetector(check_interval=0)
+        self.dos_alert = self.detector.dos_alert
+        self.alerts = []
+        self.detector._send_alert = (
+            lambda msg, channel: self.alerts.append((channel, msg)))
+        self.now = 1577836800
+
+    def add_lines(self, lines, now=None):
+        self.detector.add_packet('\n'.join(lines).encode('utf-8'),
+                                 now or self.now)
+
+    def dos_threshold(self, url='/api/internal/user'):
+        return (self.dos_alert.dos_max_reqs_sec(url)
+                * self.dos_alert.DOS_PERIOD)
+
+    def test_alerts_over_threshold(self):
+        self.add_lines([_log_line()] * (self.dos_threshold() + 1))
+        self.assertEqual([self.dos_alert.ALERT_CHANNEL_SECURITY],
+                         [channel for (channel, _) in self.alerts])
+        self.assertIn('1.2.3.4', self.alerts[0][1])
+
+    def test_no_alert_at_threshold(self):
+        self.add_lines([_log_line()] * self.dos_threshold())
+        self.assertEqual([], self.alerts)
+
+    def test_cache_hits_do_not_count(self):
+        self.add_lines([_log_line(cache_status='HIT')]
+                       * (self.dos_threshold() + 1))
+        self.assertEqual([], self.alerts)
+
+    def test_counts_add_up_over_minutes(self):
+        half = self.dos_threshold() // 2 + 1
+        self.add_lines([_log_line()] * half)
+        self.add_lines([_log_line()] * half, now=self.now + 60)
+        self.assertEqual(1, len(self.alerts))
+
+    def test_alerts_are_snoozed(self):
+        self.add_lines([_log_line()] * (self.dos_threshold() + 1))
+        self.add_lines([_log_line()] * 10, now=self.now + 1)
+        self.assertEqual(1, len(self.alerts))
+        # Once the snooze is up, we alert again if it's still going on.
+        self.add_lines([_log_line()] * (self.dos_threshold() + 1),
+                       now=self.now + self.dos_alert.DOS_PERIOD)
+        self.assertEqual(2, len(self.alerts))
+
+    def test_scratchpad_alert(self):
+        self.add_lines([_log_line(url='/api/internal/scratchpads',
+                                  request='POST')]
+                       * (self.dos_alert.MAX_SCRATCHPADS + 1))
+        self.assertEqual(1, len(self.alerts))
+        self.assertIn('1.2.3.4', self.alerts[0][1])
+
+    def test_unparseable_rows_are_counted(self):
+        self.add_lines([
+            'not json',
+            '<134>fastly[1]: [1, 2]',
+            _log_line(time_elapsed='abc'),
+            _log_line(url=5),
+            _log_line(client_ip=['1.2.3.4']),
+            _log_line(time_elapsed='1.5'),
+            _log_line(),
+        ])
+        self.assertEqual(5, self.detector.num_unparseable)
+        (dos_counts, _, _) = self.detector._minutes[self.now // 60]
+        self.assertEqual(
+            2, dos_counts.counts[('1.2.3.4', '/api/internal/user', 'curl')])
+
+
+class TestLogWriter(unittest.TestCase):
+    def test_each_packet_is_one_line(self):
+        with tempfile.TemporaryFile() as f:
+            writer = udp_logger._LogWriter(f)
+            for data in (b'one\n', b'{"a": 1}\n{"b": 2}', b''):
+                writer.add(data, '1.2.3.4', 1577836800)
+            writer.flush()
+            f.seek(0)
+            self.assertEqual(
+                [b'2020-01-01T00:00:00Z 1.2.3.4 one\n',
+                 b'2020-01-01T00:00:00Z 1.2.3.4 {"a": 1}\\n{"b": 2}\n',
+                 b'2020-01-01T00:00:00Z 1.2.3.4 \n'],
+                f.readlines())
+
+
+class TempDirTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(lambda: shutil.rmtree(self.tmpdir))
+
+    def path(self, filename):
+        return os.path.join(self.tmpdir, filename)
+
+    def read(self, filename):
+        opener = gzip.open if filename.endswith('.gz') else open
+        with opener(self.path(filename), 'rb') as f:
+            return f.read()
+
+
+class TestRotatingLogFile(TempDirTestCase):
+    def old_logfiles(self):
+        """The rotated logfiles, oldest first."""
+        def order(filename):
+            m = re.match(r'log\.(\d{8}-\d{6})(?:-(\d+))?', filename)
+            return (m.group(1), int(m.group(2) or 0))
+        return sorted((f for f in os.listdir(self.tmpdir) if f != 'log'),
+                      key=order)
+
+    def test_rotates_between_lines(self):
+        lines = [b'line %02d\n' % i for i in range(20)]
+        with udp_logger.RotatingLogFile(self.path('log'), max_bytes=35,
+                                        compress=None) as f:
+            f.write(b''.join(lines[:15]))
+            f.write(b''.join(lines[15:]))
+        filenames = self.old_logfiles() + ['log']
+        for filename in filenames:
+            data = self.read(filename)
+            self.assertLessEqual(len(data), 35)
+            self.assertTrue(data.endswith(b'\n'))
+        self.assertEqual(b''.join(lines),
+                         b''.join(self.read(f) for f in filenames))
+
+    def test_long_line_gets_its_own_file(self):
+        with udp_logger.RotatingLogFile(self.path('log'), max_bytes=10,
+                                        compress=None) as f:
+            f.write(b'short\n' + b'x' * 20 + b'\n' + b'end\n')
+        self.assertEqual([b'short\n', b'x' * 20 + b'\n', b'end\n'],
+                         [self.read(f)
+                          for f in self.old_logfiles() + ['log']])
+
+    def test_compresses_and_keeps_the_newest(self):
+        with udp_logger.RotatingLogFile(self.path('log'), max_bytes=6,
+                                        compress='gzip', keep=2) as f:
+            for i in range(5):
+                f.write(b'line%d\n' % i)
+        filenames = self.old_logfiles()
+        self.assertEqual(2, len(filenames))
+        self.assertTrue(all(f.endswith('.gz') for f in filenames))
+        self.assertEqual([b'line2\n', b'line3\n', b'line4\n'],
+                         [self.read(f) for f in filenames + ['log']])
+
+
+class TestMerge(TempDirTestCase):
+    def write(self, filename, lines):
+        opener = gzip.open if filename.endswith('.gz') else open
+        with opener(self.path(filename), 'wb') as f:
+            f.write(b''.join(lines))
+        return self.path(filename)
+
+    def test_merges_in_time_order(self):
+        filenames = [
+            self.write('log.worker0', [b'2020-01-01T00:00:05Z a 3\n']),
+            self.write('log.worker0.20200101-000002.gz',
+                       [b'2020-01-01T00:00:01Z a 1\n',
+                        b'2020-01-01T00:00:02Z a 2\n']),
+            self.write('log.worker1', [b'2020-01-01T00:00:01Z b 1\n',
+                                       b'2020-01-01T00:00:04Z b 2\n']),
+        ]
+        self.assertEqual([b'2020-01-01T00:00:01Z a 1\n',
+                          b'2020-01-01T00:00:01Z b 1\n',
+                          b'2020-01-01T00:00:02Z a 2\n',
+                          b'2020-01-01T00:00:04Z b 2\n',
+                          b'2020-01-01T00:00:05Z a 3\n'],
+                         list(udp_logger_merge.merge(filenames)))
+
+    def test_rotated_logfiles_are_read_oldest_first(self):
+        filenames = [
+            self.write('log', [b'2020-01-01T00:00:03Z a 3\n']),
+            self.write('log.20200101-000000-1',
+                       [b'2020-01-01T00:00:02Z a 2\n']),
+            self.write('log.20200101-000000', [b'2020-01-01T00:00:01Z a 1\n']),
+        ]
+        self.assertEqual([b'2020-01-01T00:00:01Z a 1\n',
+                          b'2020-01-01T00:00:02Z a 2\n',
+                          b'2020-01-01T00:00:03Z a 3\n'],
+                         list(udp_logger_merge.merge(filenames)))
+
+    def test_continuation_lines_stay_with_their_packet(self):
+        filenames = [
+            self.write('log.worker0', [b'2020-01-01T00:00:01Z a {"a":1}\n',
+                                       b'{"b":2}\n',
+                                       b'2020-01-01T00:00:05Z a x\n']),
+            self.write('log.worker1', [b'2020-01-01T00:00:02Z b y\n']),
+        ]
+        self.assertEqual([b'2020-01-01T00:00:01Z a {"a":1}\n{"b":2}\n',
+                          b'2020-01-01T00:00:02Z b y\n',
+                          b'2020-01-01T00:00:05Z a x\n'],
+                         list(udp_logger_merge.merge(filenames)))
+
+
+if __name__ == '__main__':
+    unittest.main()